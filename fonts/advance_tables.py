@@ -0,0 +1,103 @@
+from __future__ import print_function
+import argparse
+import glob
+import os
+import re
+import struct
+import codept_props
+import pfo_merge
+
+# Generates the advance widths of each built font's glyphs in the scratch range (the shaped Arabic forms)
+# and the Hebrew block, as C - so a measuring path on the watch could read a character's width directly,
+# rather than walking the PFO hash chain to its glyph header.
+# Each range is trimmed to the codepts some font has, and laid end to end - FONT_ADVANCE_INDEX(cp) - giving
+# every font a table of the same shape. Fonts with identical tables share one.
+# A codept that a font lacks is NO_ADVANCE (the firmware draws its wildcard glyph - measure that the slow way).
+
+HEBREW_BLOCK = (0x590, 0x600)
+ADVANCE_RANGES = codept_props.SCRATCH_CODEPOINT_RANGES + (HEBREW_BLOCK,)
+NO_ADVANCE = 0xff
+
+def font_advances(font):
+    # {codept: advance} for the codepts in ADVANCE_RANGES.
+    advances = {}
+    for glyph in font.glyphs.values():
+        # The advance is signed - but the table can't hold a negative one (font_advance returns -1 for "none").
+        advance = struct.unpack("<b", glyph.data[4:5])[0]
+        for cpt in glyph.codepoints:
+            if any(start <= cpt < end for start, end in ADVANCE_RANGES):
+                assert advance >= 0, "Negative advance %d of U+%04X" % (advance, cpt)
+                advances[cpt] = advance
+    return advances
+
+def table_segments(fonts_advances):
+    # [start, end) of each range, trimmed to the codepts some font has.
+    segments = []
+    for start, end in ADVANCE_RANGES:
+        cpts = [cpt for advances in fonts_advances for cpt in advances if start <= cpt < end]
+        if cpts:
+            segments.append((min(cpts), max(cpts) + 1))
+    return segments
+
+def font_define(pfo_path):
+    # 002_GOTHIC_14.pfo -> FONT_ADVANCES_GOTHIC_14
+    name = re.sub(r"^\d+_", "", os.path.splitext(os.path.basename(pfo_path))[0])
+    return "FONT_ADVANCES_%s" % re.sub(r"\W", "_", name).upper()
+
+def write_advance_tables(pfo_paths, out_dir):
+    pfo_paths = sorted(pfo_paths)
+    fonts_advances = [font_advances(pfo_merge.font_read(pfo_path)) for pfo_path in pfo_paths]
+    segments = table_segments(fonts_advances)
+    span = sum(end - start for start, end in segments)
+
+    table_offsets = {}
+    advance_data = []
+    font_offsets = []
+    for advances in fonts_advances:
+        table = tuple(advances.get(cpt, NO_ADVANCE) for start, end in segments for cpt in range(start, end))
+        if table not in table_offsets:
+            table_offsets[table] = len(advance_data)
+            advance_data += table
+        font_offsets.append(table_offsets[table])
+    assert len(advance_data) <= 0xffff, "Advance tables too large"
+    print("FONT_ADVANCES: %d bytes (%d fonts, %d distinct tables of %d codepts)" % (
+        len(advance_data), len(pfo_paths), len(table_offsets), span))
+
+    # As ARABIC_UNSHAPE_INDEX - -1 outside the segments.
+    advance_index = "-1"
+    offset = span
+    for start, end in reversed(segments):
+        offset -= end - start
+        advance_index = "RANGE(cp, %d, %d) ? (cp) - %d%s : %s" % (start, end, start,
+                                                                  " + %d" % offset if offset else "", advance_index)
+
+    adv_h = open(os.path.join(out_dir, "font_advances.h"), "w")
+    adv_h.write("// THIS FILE IS AUTOMATICALLY GENERATED\n#pragma once\n#include \"pebble.h\"\n#include \"range.h\"\n\n")
+    adv_h.write("extern const uint8_t FONT_ADVANCES[];\n")
+    adv_h.write("#define FONT_ADVANCES_SIZE %d\n" % len(advance_data))
+    adv_h.write("#define NO_ADVANCE 0x%x\n" % NO_ADVANCE)
+    adv_h.write("#define FONT_ADVANCE_INDEX(cp) (%s)\n" % advance_index)
+    for pfo_path, font_offset in zip(pfo_paths, font_offsets):
+        adv_h.write("#define %s %d\n" % (font_define(pfo_path), font_offset))
+    adv_h.write("""
+// The advance of cp in the font whose table starts at font_table (one of the FONT_ADVANCES_* above),
+// or -1 if it's not in the table.
+static inline int font_advance(uint16_t font_table, uint16_t cp) {
+  int idx = FONT_ADVANCE_INDEX(cp);
+  if (idx < 0 || FONT_ADVANCES[font_table + idx] == NO_ADVANCE) {
+    return -1;
+  }
+  return FONT_ADVANCES[font_table + idx];
+}
+""")
+    adv_h.close()
+    with open(os.path.join(out_dir, "font_advances.c"), "w") as adv_c:
+        adv_c.write("#include \"font_advances.h\"\n// THIS FILE IS AUTOMATICALLY GENERATED\n\n")
+        adv_c.write("const uint8_t FONT_ADVANCES[] = {%s};\n" % ", ".join("0x%x" % x for x in advance_data))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate per-font advance width tables for the shaped and Hebrew ranges")
+    parser.add_argument("pfo_dir", help="directory of built fonts (compose.py's output)")
+    parser.add_argument("output_code_dir")
+    args = parser.parse_args()
+    write_advance_tables(glob.glob(os.path.join(args.pfo_dir, "*.pfo")), args.output_code_dir)
@@ -0,0 +1,137 @@
+from __future__ import print_function
+import os
+
+# Every per-character test the runtime makes (is this zero-width? shaped? RTL?...) is answered by one
+# generated table of flags, written by text_shaper.py - it's the last stage to know which codepts it shaped into.
+# The table is two-level: codept >> CODEPT_PROPS_PAGE_SHIFT picks an entry in CODEPT_PROPS_PAGE_INDEX,
+# naming the page of CODEPT_PROPS_PAGES that holds the codept's flags. Identical pages (mostly empty ones)
+# are stored once. So classifying a character on the watch is two memory reads, rather than a chain of RANGE()s.
+# The ranges are [start, end).
+
+CODEPT_ZERO_WIDTH = 1 << 0
+CODEPT_SHAPED = 1 << 1
+CODEPT_RTL = 1 << 2
+CODEPT_NEUTRAL = 1 << 3
+CODEPT_WEAK_LTR = 1 << 4
+CODEPT_SCRATCH = 1 << 5
+CODEPT_FLAGS = (("CODEPT_ZERO_WIDTH", CODEPT_ZERO_WIDTH), ("CODEPT_SHAPED", CODEPT_SHAPED),
+                ("CODEPT_RTL", CODEPT_RTL), ("CODEPT_NEUTRAL", CODEPT_NEUTRAL),
+                ("CODEPT_WEAK_LTR", CODEPT_WEAK_LTR), ("CODEPT_SCRATCH", CODEPT_SCRATCH))
+
+# The RTL system doesn't support diacritics, especially crazy stacked harakat in Arabic.
+# So we silently drop them from rendering by assigning them zero-width that don't break the RTL scheme
+ZERO_WIDTH_CODEPOINT_RANGES = (
+    (0x591, 0x5C0), # Hebrew diacritics
+    (0x5C1, 0x5C3), # ...
+    (0x5C4, 0x5C6), # ...
+    (0x5C7, 0x5C8), # ...
+    (0x610, 0x61B), # Arabic diacritics
+    (0x64B, 0x660), # ...
+    (0x6D6, 0x6DC), # ...
+    (0x6DF, 0x6E9), # ...
+    (0x6EA, 0x6EE), # ...
+    (0x8B6, 0x8FF)  # Arabic Extended-A diacritics
+)
+
+# The shaper recycles some of the dustier blocks in the 2-byte UTF8 range for its glyphs.
+SCRATCH_CODEPOINT_RANGES = ((0x700, 0x750), (0x780, 0x7FF + 1))
+
+# The shaper's codepts are RTL too - since the RTL routine runs after the shaper.
+RTL_RANGES = (
+    (0x60E, 0x660), # First part of Arabic block - up to numerals
+    (0x66D, 0x700), # Balance of Arabic block
+    (0x750, 0x780), # Arabic-Extended - not that it's supported.
+    (0x590, 0x600)  # Hebrew
+)
+
+# Zero-width codepts are neutral too - so invisible characters don't break stuff.
+NEUTRAL_RANGES = (
+    (0x20, 0x23),  # Latin punctuation - excl #$% etc.
+    (0x26, 0x30),  # ...
+    (0x3A, 0x41),  # ...
+    (0x5B, 0x61),  # ...
+    (0x7B, 0xA2),  # ...
+    (0xA6, 0xA7),  # ...
+    (0xA8, 0xB0),  # ...
+    (0xB7, 0xBF),  # ...
+    (0x600, 0x60E) # Arabic punctuation & stuff.
+)
+
+# "Weak" LTR doesn't break an RTL span, but is itself laid out LTR.
+WEAK_LTR_RANGES = (
+    (0x30, 0x3A),  # Arabic numerals
+    (0x660, 0x66D) # Indic numerals
+)
+
+def build_props(shaped_ranges):
+    # The flags of every codept up to the last one with any - shaped_ranges are the shaper's, [start, end).
+    flag_ranges = [(CODEPT_ZERO_WIDTH, ZERO_WIDTH_CODEPOINT_RANGES),
+                   (CODEPT_SHAPED, shaped_ranges),
+                   (CODEPT_RTL, RTL_RANGES + tuple(shaped_ranges)),
+                   (CODEPT_NEUTRAL, NEUTRAL_RANGES + ZERO_WIDTH_CODEPOINT_RANGES),
+                   (CODEPT_WEAK_LTR, WEAK_LTR_RANGES),
+                   (CODEPT_SCRATCH, SCRATCH_CODEPOINT_RANGES)]
+    props = [0] * max(end for _, ranges in flag_ranges for _, end in ranges)
+    for flag, ranges in flag_ranges:
+        for start, end in ranges:
+            for codept in range(start, end):
+                props[codept] |= flag
+    return props
+
+def pack_props(props, page_shift):
+    # Returns (page index, pages) - each page 1 << page_shift flag bytes.
+    page_size = 1 << page_shift
+    padded = props + [0] * (-len(props) % page_size)
+    page_numbers = {}
+    page_index = []
+    pages = []
+    for start in range(0, len(padded), page_size):
+        page = tuple(padded[start:start + page_size])
+        if page not in page_numbers:
+            page_numbers[page] = len(page_numbers)
+            pages += page
+        page_index.append(page_numbers[page])
+    return page_index, pages
+
+def smallest_packing(props):
+    # Returns (page shift, page index, pages) for whichever page size makes the smallest table.
+    packings = []
+    for page_shift in range(2, 9):
+        page_index, pages = pack_props(props, page_shift)
+        if max(page_index) <= 0xff:
+            packings.append((len(page_index) + len(pages), page_shift, page_index, pages))
+    _, page_shift, page_index, pages = min(packings)
+    return page_shift, page_index, pages
+
+CODEPT_PROPS_ACCESSOR_H = """
+// The CODEPT_* flags of cp.
+static inline uint8_t codept_props(uint16_t cp) {
+  if (cp >= CODEPT_PROPS_LIMIT) {
+    return 0;
+  }
+  return CODEPT_PROPS_PAGES[(CODEPT_PROPS_PAGE_INDEX[cp >> CODEPT_PROPS_PAGE_SHIFT] << CODEPT_PROPS_PAGE_SHIFT) |
+                            (cp & ((1 << CODEPT_PROPS_PAGE_SHIFT) - 1))];
+}
+"""
+
+def write_props(shaped_ranges, out_dir):
+    props = build_props(shaped_ranges)
+    page_shift, page_index, pages = smallest_packing(props)
+    print("CODEPT_PROPS: %d bytes (%d byte pages, %d of %d distinct, up to U+%04X)" % (
+        len(page_index) + len(pages), 1 << page_shift, len(pages) >> page_shift, len(page_index), len(props) - 1))
+
+    props_h = open(os.path.join(out_dir, "codept_props.h"), "w")
+    props_h.write("// THIS FILE IS AUTOMATICALLY GENERATED\n#pragma once\n#include \"pebble.h\"\n\n")
+    props_c = open(os.path.join(out_dir, "codept_props.c"), "w")
+    props_c.write("#include \"codept_props.h\"\n// THIS FILE IS AUTOMATICALLY GENERATED\n\n")
+    for name, flag in CODEPT_FLAGS:
+        props_h.write("#define %s 0x%x\n" % (name, flag))
+    props_h.write("#define CODEPT_PROPS_LIMIT 0x%x\n" % len(props))
+    props_h.write("#define CODEPT_PROPS_PAGE_SHIFT %d\n" % page_shift)
+    for name, elements in (("CODEPT_PROPS_PAGE_INDEX", page_index), ("CODEPT_PROPS_PAGES", pages)):
+        props_h.write("extern const uint8_t %s[];\n" % name)
+        props_h.write("#define %s_SIZE %d\n" % (name, len(elements)))
+        props_c.write("const uint8_t %s[] = {%s};\n" % (name, ", ".join("0x%x" % x for x in elements)))
+    props_h.write(CODEPT_PROPS_ACCESSOR_H)
+    props_h.close()
+    props_c.close()
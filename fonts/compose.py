@@ -1,21 +1,28 @@
 from collections import namedtuple
-import sys
+import argparse
 import glob
+import multiprocessing
 import os
 import subprocess
 import tempfile
 import json
 import itertools
+from codept_props import ZERO_WIDTH_CODEPOINT_RANGES
+import advance_tables
 # This file drives the process of generating a single merged font.
 # It takes a directory of PFO files (from find_system_fonts.py) and produces a second directory
 
-if len(sys.argv) < 5:
-    print("compose.py input_pfo_dir subset size_shift output_pfo_dir output_code_dir")
-    sys.exit(0)
-
 MergeMember = namedtuple("MergeMember", "ttf_path size with_shaper codepts threshold fix_ijam")
 MergeMember.__new__.__defaults__ = (None,) * len(MergeMember._fields)
 ShaperResult = namedtuple("ShaperResult", "map_tf labels_tf")
+# How a template's merged PFO stores its glyphs: "raw", "RLE4", "system" (whatever the PFO being
+# replaced uses), or "auto" to have pfo_merge encode both ways and pick one within the budgets.
+EncodingPolicy = namedtuple("EncodingPolicy", "encoding flash_budget max_rle_units")
+EncodingPolicy.__new__.__defaults__ = (None,) * len(EncodingPolicy._fields)
+# A member, ready to build: its fontgen command line, plus the glyph archive it dumps into (if any).
+MemberJob = namedtuple("MemberJob", "font_idx fontgen_params dump_path")
+# Everything needed to build one merged font. The tempfiles must stay open until it's merged.
+FontPlan = namedtuple("FontPlan", "input_pfo_name members merge_params tempfiles")
 
 ARABIC_FONT = "/Library/Fonts/Tahoma.ttf"
 ARABIC_FONT_BOLD = "/Library/Fonts/Tahoma Bold.ttf"
@@ -27,20 +34,6 @@ HEBREW_FONT_BOLD_SERIF = ARABIC_FONT_BOLD_SERIF
 
 HEBREW_CODEPT_LIST = [0x5c0, 0x5c3, 0x5c6, 0x20aa] + list(range(0x5d0, 0x5f5))
 
-# The RTL system doesn't support diacritics, especially crazy stacked harakat in Arabic.
-# So we silently drop them from rendering by assigning them zero-width that don't break the RTL scheme
-ZERO_WIDTH_CODEPOINT_RANGES = (
-    (0x591, 0x5C0), # Hebrew diacritics
-    (0x5C1, 0x5C3), # ...
-    (0x5C4, 0x5C6), # ...
-    (0x5C7, 0x5C8), # ...
-    (0x610, 0x61B), # Arabic diacritics
-    (0x64B, 0x660), # ...
-    (0x6D6, 0x6DC), # ...
-    (0x6DF, 0x6E9), # ...
-    (0x6EA, 0x6EE), # ...
-    (0x8B6, 0x8FF)  # Arabic Extended-A diacritics
-)
 ZERO_WIDTH_CODEPOINTS = list(itertools.chain.from_iterable((range(*r) for r in ZERO_WIDTH_CODEPOINT_RANGES)))
 
 blacklist = ("NUMBERS", "SUBSET", "EMOJI")
@@ -138,7 +131,30 @@ def select_template(size, variant, size_shift_key):
 
     return TEMPLATES[(size, variant)]
 
-def compose_font(input_pfo_path, subset_key, size_shift_key, output_pfo_path):
+def select_encoding_policy(size, variant):
+    # RLE4 rarely pays for itself at small sizes - the runs are too short.
+    ENCODING_POLICIES = {
+        (9, None): EncodingPolicy("raw"),
+        (14, None): EncodingPolicy("raw"),
+        (14, "BOLD"): EncodingPolicy("raw")
+    }
+    # Otherwise, take the smaller encoding - so long as RLE4 doesn't make glyphs too slow to decode.
+    return ENCODING_POLICIES.get((size, variant), EncodingPolicy("auto", max_rle_units=64))
+
+def glyph_collect_path(bitmaps_dir, size):
+    # The archive of hand-edited glyphs for a face & size - or, failing that, the directory of .txt files
+    # they were kept in before there were archives.
+    archive_path = os.path.join(bitmaps_dir, "%d.glyphs" % size)
+    legacy_dir = os.path.join(bitmaps_dir, str(size))
+    if not os.path.exists(archive_path) and os.path.isdir(legacy_dir):
+        print("Collecting glyphs from %s - pack them into an archive with: python pebblesdk/glyph_archive.py import %s %s" % (
+            legacy_dir, legacy_dir, archive_path))
+        return legacy_dir
+    return archive_path
+
+def plan_font(input_pfo_path, subset_key, size_shift_key, output_pfo_path, font_idx, shaper_cache_dir, dump_bitmaps,
+              optimize_hash_table):
+    # Works out how to build a merged font, without building it (bar running the text shaper, once).
     global shaper_result
     input_pfo_name = os.path.basename(input_pfo_path)
     input_split = input_pfo_name.split(".")[0].split("_")
@@ -163,21 +179,11 @@ def compose_font(input_pfo_path, subset_key, size_shift_key, output_pfo_path):
         template = select_template(size, variant, size_shift_key)
     except KeyError:
         print("No template for %s!" % os.path.basename(input_pfo_path))
-        return
-
-    # Check the original PFO to see if we need to generate compressed PFOs.
-    # The merge tool can't fix this afterwards.
-    compressed = False
-    with open(input_pfo_path, "rb") as input_pfo_fd:
-        pfo_ver = ord(input_pfo_fd.read(1))
-        if pfo_ver == 3:
-            FEATURE_RLE4 = 0x02
-            input_pfo_fd.seek(9)
-            features = ord(input_pfo_fd.read(1))
-            compressed = features & FEATURE_RLE4
+        return None
 
     merge_params = [input_pfo_path]
     tempfiles = []
+    members = []
     for member in template:
         pfo_tf = tempfile.NamedTemporaryFile()
         tempfiles.append(pfo_tf)
@@ -192,18 +198,20 @@ def compose_font(input_pfo_path, subset_key, size_shift_key, output_pfo_path):
             pfo_tf.name
         ]
 
+        dump_path = None
         if member.fix_ijam:
-            collect_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "bitmaps", os.path.basename(member.ttf_path).split(".")[0], str(member.size))
-            dump_dir = os.path.join(collect_dir, "dump")
-            if not os.path.exists(dump_dir):
-                os.makedirs(dump_dir)
+            # fontgen fixes the glyphs as it renders them. Hand-edited glyphs are collected from one archive
+            # per face & size - see pebblesdk/glyph_archive.py to export them for editing.
+            bitmaps_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "bitmaps", os.path.basename(member.ttf_path).split(".")[0])
             fontgen_params += [
-                "--dump-bitmaps", dump_dir,
-                "--collect-bitmaps", collect_dir
+                "--postprocess", os.path.join(os.path.dirname(os.path.realpath(__file__)), "fix_ijam.py"),
+                "--collect-bitmaps", glyph_collect_path(bitmaps_dir, member.size)
             ]
-
-        if compressed:
-            fontgen_params += ["--compress", "RLE4"]
+            if dump_bitmaps:
+                if not os.path.exists(bitmaps_dir):
+                    os.makedirs(bitmaps_dir)
+                dump_path = os.path.join(bitmaps_dir, "%d.dump.glyphs" % member.size)
+                fontgen_params += ["--dump-bitmaps", dump_path]
 
         if member.size != size:
             fontgen_params += ["--shift", "%d,%d" % (0, size - member.size)]
@@ -222,7 +230,8 @@ def compose_font(input_pfo_path, subset_key, size_shift_key, output_pfo_path):
                     subset_key,
                     map_tf.name,
                     labels_tf.name,
-                    os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "runtime")
+                    os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "runtime"),
+                    "--cache-dir", shaper_cache_dir
                 ])
 
                 shaper_result = ShaperResult(map_tf, labels_tf)
@@ -230,71 +239,165 @@ def compose_font(input_pfo_path, subset_key, size_shift_key, output_pfo_path):
             fontgen_params += ["--codept-labels", shaper_result.labels_tf.name]
 
         zwc_tf = tempfile.NamedTemporaryFile(mode="w")
+        tempfiles.append(zwc_tf)
         json.dump({"codepoints": ZERO_WIDTH_CODEPOINTS}, zwc_tf)
         zwc_tf.flush()
 
-        cpt_list_tf = None
         if member.codepts:
             cpt_list_tf = tempfile.NamedTemporaryFile(mode="w")
+            tempfiles.append(cpt_list_tf)
             json.dump({"codepoints": member.codepts}, cpt_list_tf)
             cpt_list_tf.flush()
             fontgen_params += ["--list", cpt_list_tf.name]
 
         fontgen_params += ["--zero-width-codept-list", zwc_tf.name]
-
-        if member.fix_ijam:
-            # We must dump the glyphs first.
-            if not glob.glob(os.path.join(dump_dir, "*.txt")):
-                try:
-                    subprocess.check_call(fontgen_params)
-                except subprocess.CalledProcessError:
-                    pass
-            subprocess.check_call([
-                "python",
-                os.path.join(os.path.dirname(os.path.realpath(__file__)), "fix_ijam.py"),
-                dump_dir,
-                collect_dir
-            ])
-
-        try:
-            subprocess.check_call(fontgen_params)
-        except subprocess.CalledProcessError:
-            print("Failed generating member for %s - it will not be output!" % input_pfo_name)
-            return
+        members.append(MemberJob(font_idx, fontgen_params, dump_path))
+
+    encoding_policy = select_encoding_policy(size, variant)
+    encoding = encoding_policy.encoding
+    if encoding == "system":
+        # The members are generated uncompressed - pfo_merge keeps the encoding of its first font, the original.
+        encoding = "keep"
+    # Options go before the fonts - pfo_merge can't tell where its list of inputs ends otherwise.
+    merge_options = ["--compress", encoding]
+    if encoding_policy.flash_budget is not None:
+        merge_options += ["--flash-budget", str(encoding_policy.flash_budget)]
+    if encoding_policy.max_rle_units is not None:
+        merge_options += ["--max-rle-units", str(encoding_policy.max_rle_units)]
+    if optimize_hash_table:
+        merge_options.append("--optimize-hash-table")
+    merge_params = merge_options + merge_params
 
     merge_params.append(output_pfo_path)
-    subprocess.check_call([
+    merge_params = [
         "python",
         os.path.join(os.path.dirname(os.path.realpath(__file__)), "pfo_merge.py")
-    ] + merge_params)
-
-in_dir = sys.argv[1]
-subset_key = sys.argv[2]
-size_shift_key = sys.argv[3]
-out_dir = sys.argv[4]
-out_code_dir = sys.argv[5]
-
-# Top quality codegen
-code = """// THIS FILE IS AUTOMATICALLY GENERATED
-#include "range.h"
-#include "font_ranges.h"
-
-bool is_zero_width(uint16_t codept) {
-    return %s;
-}
-""" % " || ".join(("RANGE(codept, %d, %d)" % r for r in ZERO_WIDTH_CODEPOINT_RANGES))
-open(os.path.join(out_code_dir, "font_ranges.c"), "w").write(code)
-
-header = """// THIS FILE IS AUTOMATICALLY GENERATED
+    ] + merge_params
+    return FontPlan(input_pfo_name, members, merge_params, tempfiles)
+
+def build_member(job):
+    try:
+        subprocess.check_call(job.fontgen_params)
+    except subprocess.CalledProcessError:
+        return False
+    return True
+
+def build_member_group(jobs):
+    # Returns [(font_idx, success)] - see member_groups.
+    return [(job.font_idx, build_member(job)) for job in jobs]
+
+def merge_font(merge_params):
+    try:
+        subprocess.check_call(merge_params)
+    except subprocess.CalledProcessError:
+        return False
+    return True
+
+def member_groups(plans):
+    # Members that dump into the same glyph archive (same face & size) are built one after another,
+    # so they don't write it at once. Everything else is independent.
+    groups = []
+    archive_groups = {}
+    for plan in plans:
+        for job in plan.members:
+            if job.dump_path in archive_groups:
+                archive_groups[job.dump_path].append(job)
+                continue
+            groups.append([job])
+            if job.dump_path:
+                archive_groups[job.dump_path] = groups[-1]
+    return groups
+
+def report_failure(plan, step="generating member"):
+    print("Failed %s for %s - it will not be output!" % (step, plan.input_pfo_name))
+
+def compose_fonts(plans, jobs):
+    # Fans every font's members out to a pool, and merges each font as soon as its last member is built.
+    pending = [len(plan.members) for plan in plans]
+    failed = [False] * len(plans)
+    pool = multiprocessing.Pool(jobs)
+    merges = []
+    try:
+        for results in pool.imap_unordered(build_member_group, member_groups(plans)):
+            for font_idx, success in results:
+                pending[font_idx] -= 1
+                failed[font_idx] = failed[font_idx] or not success
+                if pending[font_idx]:
+                    continue
+                if failed[font_idx]:
+                    report_failure(plans[font_idx])
+                else:
+                    merges.append((plans[font_idx], pool.apply_async(merge_font, (plans[font_idx].merge_params,))))
+        for plan, merge in merges:
+            if not merge.get():
+                report_failure(plan, "merging")
+    finally:
+        pool.close()
+        pool.join()
+
+def compose_fonts_serial(plans):
+    for plan in plans:
+        for job in plan.members:
+            if not build_member(job):
+                report_failure(plan)
+                break
+        else:
+            if not merge_font(plan.merge_params):
+                report_failure(plan, "merging")
+
+def main():
+    parser = argparse.ArgumentParser(description="Build merged fonts for each system font in a directory")
+    parser.add_argument("input_pfo_dir")
+    parser.add_argument("subset")
+    parser.add_argument("size_shift")
+    parser.add_argument("output_pfo_dir")
+    parser.add_argument("output_code_dir")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="build this many members (and merges) at once")
+    parser.add_argument("--shaper-cache-dir", default=os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "cache", "text_shaper"),
+                        help="where to keep text_shaper.py outputs between runs (default: cache/text_shaper)")
+    parser.add_argument("--dump-bitmaps", action="store_true",
+                        help="write the rendered Arabic glyphs to fonts/bitmaps, to hand-edit them")
+    parser.add_argument("--optimize-hash-table", action="store_true",
+                        help="size each merged font's hash table to minimize glyph lookup cost (changes the font layout)")
+    parser.add_argument("--advance-tables", action="store_true",
+                        help="also generate font_advances.c/.h - the built fonts' advances in the shaped & Hebrew ranges")
+    args = parser.parse_args()
+
+    in_dir = args.input_pfo_dir
+    subset_key = args.subset
+    size_shift_key = args.size_shift
+    out_dir = args.output_pfo_dir
+    out_code_dir = args.output_code_dir
+
+    # Top quality codegen
+    # (Which codepts are zero-width is in the codept property table - see codept_props.py.)
+    header = """// THIS FILE IS AUTOMATICALLY GENERATED
 #pragma once
 #include "pebble.h"
-bool is_zero_width(uint16_t codept);
 #define ZERO_WIDTH_CODEPT %d
 """ % ZERO_WIDTH_CODEPOINTS[0]
-open(os.path.join(out_code_dir, "font_ranges.h"), "w").write(header)
+    open(os.path.join(out_code_dir, "font_ranges.h"), "w").write(header)
+
+    plans = []
+    out_files = []
+    for in_file in glob.glob(os.path.join(in_dir, "*.pfo")):
+        if any(b in in_file for b in blacklist):
+            continue
+        out_file = os.path.join(out_dir, os.path.basename(in_file))
+        plan = plan_font(in_file, subset_key, size_shift_key, out_file, len(plans), args.shaper_cache_dir, args.dump_bitmaps,
+                         args.optimize_hash_table)
+        if plan:
+            plans.append(plan)
+            out_files.append(out_file)
+
+    if args.jobs > 1:
+        compose_fonts(plans, args.jobs)
+    else:
+        compose_fonts_serial(plans)
+
+    if args.advance_tables:
+        advance_tables.write_advance_tables([out_file for out_file in out_files if os.path.exists(out_file)], out_code_dir)
 
-for in_file in glob.glob(os.path.join(in_dir, "*.pfo")):
-    if any(b in in_file for b in blacklist):
-        continue
-    out_file = os.path.join(out_dir, os.path.basename(in_file))
-    compose_font(in_file, subset_key, size_shift_key, out_file)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+from __future__ import division, print_function
+import argparse
+from collections import Counter
+import io
+import json
+import os
+import lut_shaper
+from pfo_merge import font_read
+
+# This file picks the glyphs worth keeping in the langpack fonts, based on what real text needs.
+# It shapes a corpus exactly as the watch would (via lut_shaper.py, using the generated LUTs),
+# counts which codepoints and shaped forms come out, and keeps the most common ones until they
+# cover the requested fraction of all occurrences.
+# The results are a --map (for the shaped Arabic member) and a --list (for the others) for fontgen.
+
+def count_codepoints(lut, corpus_paths):
+    counts = Counter()
+    for corpus_path in corpus_paths:
+        with io.open(corpus_path, "r", encoding="utf-8") as fd:
+            for line in fd:
+                line = line.rstrip("\n")
+                if line:
+                    counts.update(lut_shaper.shape(lut, [ord(c) for c in line]))
+    return counts
+
+def select_codepoints(counts, candidates, coverage):
+    # The most frequent candidates, until they account for `coverage` of all candidate occurrences.
+    total = sum(counts[cp] for cp in candidates)
+    kept = set()
+    covered = 0
+    for cp in sorted(candidates, key=lambda cp: (-counts[cp], cp)):
+        if not counts[cp] or covered >= coverage * total:
+            break
+        kept.add(cp)
+        covered += counts[cp]
+    return kept, (covered / total) if total else 1
+
+def bytes_saved(pfo_path, dropped):
+    # Glyph records whose codepoints are all dropped go entirely; every dropped codepoint also
+    # frees its hash table chain entry.
+    font = font_read(pfo_path)
+    saved = 0
+    for glyph in font.glyphs.values():
+        dropped_cps = [cp for cp in glyph.codepoints if cp in dropped]
+        saved += len(dropped_cps) * 4
+        if len(dropped_cps) == len(glyph.codepoints):
+            saved += len(glyph.data)
+    return saved
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Subset langpack fonts to the glyphs a text corpus uses")
+    parser.add_argument("code_dir", help="directory with the generated text_shaper_lut.c/.h, codept_props.c/.h and font_ranges.h")
+    parser.add_argument("shaper_map", help="codept->glyph map written by text_shaper.py")
+    parser.add_argument("corpus", nargs="+", help="UTF-8 text files, one message per line")
+    parser.add_argument("--coverage", type=float, default=0.999,
+                        help="fraction of character occurrences the kept glyphs must cover (default 0.999)")
+    parser.add_argument("--list", help="json list of the unshaped codepoints to consider (e.g. Hebrew)")
+    parser.add_argument("--map-out", help="where to write the subset codept->glyph map")
+    parser.add_argument("--list-out", help="where to write the subset codepoint list")
+    parser.add_argument("--pfo", action="append", default=[], help="a built font to report the savings for")
+    args = parser.parse_args()
+
+    lut = lut_shaper.load_lut(args.code_dir)
+    shaper_map = {int(k): v for k, v in json.load(open(args.shaper_map, "r")).items()}
+    list_codepts = set()
+    if args.list:
+        list_codepts = set(int(cp) for cp in json.load(open(args.list, "r"))["codepoints"])
+
+    counts = count_codepoints(lut, args.corpus)
+    candidates = set(shaper_map.keys()) | list_codepts
+    kept, covered = select_codepoints(counts, candidates, args.coverage)
+    dropped = candidates - kept
+    print("Keeping %d of %d glyph codepoints, covering %.4f of %d occurrences" % (
+        len(kept), len(candidates), covered, sum(counts[cp] for cp in candidates)))
+
+    if args.map_out:
+        json.dump({cp: glyph for cp, glyph in shaper_map.items() if cp in kept}, open(args.map_out, "w"))
+    if args.list_out:
+        json.dump({"codepoints": sorted(kept & list_codepts)}, open(args.list_out, "w"))
+
+    for pfo_path in args.pfo:
+        print("%s: %d bytes saved" % (os.path.basename(pfo_path), bytes_saved(pfo_path, dropped)))
@@ -1,32 +1,23 @@
 from __future__ import division
 import sys
 import os
-import glob
-import json
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "pebblesdk"))
+from glyph_archive import open_glyph_store
 # This file automatically fixes the consonant pointing marks to be more visible
 # (out of the box they're single pixels - even when the rest of the font is thicker)
-if len(sys.argv) < 3:
-    print("fix_ijam.py in_bitmap_dump out_bitmap_dump")
-    sys.exit(0)
 
-in_dir = sys.argv[1]
-out_dir = sys.argv[2]
-
-def process_glyph(in_path, out_path):
+def process_glyph(meta, bitmap):
+    # Returns the fixed (meta, bitmap), or None if the glyph doesn't need fixing.
     bmp_data = {}
-    width = height = bottom = left = None
-    with open(in_path, "r") as fd:
-        meta = json.loads(fd.readline())
-        width = meta["width"]
-        height = meta["height"]
-        bottom = meta["bottom"]
-        left = meta["left"]
-        advance = meta["advance"]
-        bmp_str = fd.read().replace("\n", "")
-        assert len(bmp_str) == width * height
-        for y in range(height):
-            for x in range(width):
-                bmp_data[(x, y)] = bmp_str[y * width + x] == "#"
+    width = meta["width"]
+    height = meta["height"]
+    bottom = meta["bottom"]
+    left = meta["left"]
+    advance = meta["advance"]
+    assert len(bitmap) == width * height
+    for y in range(height):
+        for x in range(width):
+            bmp_data[(x, y)] = bool(bitmap[y * width + x])
 
     # Find isolated points - the i'jam.
     def check_isolated(x, y, excepting=None):
@@ -68,7 +59,7 @@ def process_glyph(in_path, out_path):
             else:
                 other_points.append((x, y))
     if not isolated_points:
-        return
+        return None
 
     # Turn them from 1x1 squares to 2x2
     # And do so in a direction least likely to produce collisions.
@@ -153,21 +144,35 @@ def process_glyph(in_path, out_path):
             for xoff in range(hdx + sx):
                 bmp_data[(x + xoff - sx, y)] = True
 
-    with open(out_path, "w") as fd:
-        meta["width"] = width
-        meta["height"] = height
-        meta["left"] = left
-        meta["bottom"] = bottom
-        meta["advance"] = advance
-        fd.write("%s\n" % json.dumps(meta))
-        for y in range(height):
-            for x in range(width):
-                try:
-                    fd.write("#" if bmp_data[(x - sx, y - sy)] else " ")
-                except KeyError:
-                    fd.write(" ")
-            fd.write("\n")
+    meta = dict(meta)
+    meta["width"] = width
+    meta["height"] = height
+    meta["left"] = left
+    meta["bottom"] = bottom
+    meta["advance"] = advance
+    fixed_bitmap = []
+    for y in range(height):
+        for x in range(width):
+            fixed_bitmap.append(1 if bmp_data.get((x - sx, y - sy)) else 0)
+    return meta, fixed_bitmap
+
+def postprocess(name, meta, bitmap):
+    # The fontgen.py --postprocess hook: fixes Arabic glyphs in memory, as they're rendered.
+    if "ARABIC" not in name:
+        return None
+    return process_glyph(meta, bitmap)
 
-for file in glob.glob(os.path.join(in_dir, "*ARABIC*")):
-    process_glyph(file, os.path.join(out_dir, os.path.basename(file)))
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("fix_ijam.py in_bitmap_dump out_bitmap_dump")
+        sys.exit(0)
 
+    # Either may be a glyph archive (.glyphs) or a directory of text bitmaps.
+    in_store = open_glyph_store(sys.argv[1], "r")
+    out_store = open_glyph_store(sys.argv[2], "a")
+    for name in in_store.names():
+        fixed = postprocess(name, *in_store.get(name))
+        if fixed:
+            out_store.put(name, *fixed)
+    in_store.close()
+    out_store.close()
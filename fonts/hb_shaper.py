@@ -0,0 +1,117 @@
+import ctypes
+import ctypes.util
+import json
+import subprocess
+
+# Shapes strings with HarfBuzz, many at a time - either by feeding them all to one hb-shape process
+# (a string per input line, a JSON glyph list per output line), or by calling libharfbuzz in-process.
+# Both give glyph lists in hb-shape's JSON form: [{"g": glyph, "cl": cluster, "dx", "dy", "ax", "ay"}, ...],
+# with clusters as character indices into the string, as hb-shape reports them (without --utf8-clusters).
+
+class HBShapeShaper:
+    def __init__(self, font_path):
+        self.font_path = font_path
+
+    def version(self):
+        return subprocess.check_output(["hb-shape", "--version"]).decode("utf-8")
+
+    def shape(self, texts):
+        for txt in texts:
+            assert "\n" not in txt, "Can't batch-shape %r" % txt
+        if not texts:
+            return []
+        process = subprocess.Popen(["hb-shape", self.font_path, "--output-format=json", "--no-glyph-names"],
+                                   stdout=subprocess.PIPE, stdin=subprocess.PIPE)
+        out, _ = process.communicate(("\n".join(texts) + "\n").encode("utf-8"))
+        assert process.returncode == 0, "hb-shape failed"
+        results = [json.loads(line) for line in out.decode("utf-8").splitlines() if line.strip()]
+        assert len(results) == len(texts), "hb-shape gave %d results for %d strings" % (len(results), len(texts))
+        return results
+
+    def close(self):
+        pass
+
+class HBGlyphInfo(ctypes.Structure):
+    _fields_ = [("codepoint", ctypes.c_uint32), ("mask", ctypes.c_uint32), ("cluster", ctypes.c_uint32),
+                ("var1", ctypes.c_uint32), ("var2", ctypes.c_uint32)]
+
+class HBGlyphPosition(ctypes.Structure):
+    _fields_ = [("x_advance", ctypes.c_int32), ("y_advance", ctypes.c_int32),
+                ("x_offset", ctypes.c_int32), ("y_offset", ctypes.c_int32), ("var", ctypes.c_uint32)]
+
+class LibHarfBuzzShaper:
+    # The same calls hb-shape makes with its default options, minus the process.
+    def __init__(self, font_path, lib_path):
+        hb = self.hb = ctypes.CDLL(lib_path)
+        hb.hb_version_string.restype = ctypes.c_char_p
+        hb.hb_blob_create_from_file.restype = ctypes.c_void_p
+        hb.hb_blob_create_from_file.argtypes = [ctypes.c_char_p]
+        hb.hb_face_create.restype = ctypes.c_void_p
+        hb.hb_face_create.argtypes = [ctypes.c_void_p, ctypes.c_uint]
+        hb.hb_font_create.restype = ctypes.c_void_p
+        hb.hb_font_create.argtypes = [ctypes.c_void_p]
+        hb.hb_buffer_create.restype = ctypes.c_void_p
+        hb.hb_buffer_add_utf8.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int, ctypes.c_uint, ctypes.c_int]
+        hb.hb_buffer_guess_segment_properties.argtypes = [ctypes.c_void_p]
+        hb.hb_buffer_clear_contents.argtypes = [ctypes.c_void_p]
+        hb.hb_shape.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint]
+        hb.hb_buffer_get_glyph_infos.restype = ctypes.POINTER(HBGlyphInfo)
+        hb.hb_buffer_get_glyph_infos.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_uint)]
+        hb.hb_buffer_get_glyph_positions.restype = ctypes.POINTER(HBGlyphPosition)
+        hb.hb_buffer_get_glyph_positions.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_uint)]
+        for destroy in (hb.hb_buffer_destroy, hb.hb_font_destroy, hb.hb_face_destroy, hb.hb_blob_destroy):
+            destroy.argtypes = [ctypes.c_void_p]
+
+        blob = hb.hb_blob_create_from_file(font_path.encode("utf-8"))
+        face = hb.hb_face_create(blob, 0)
+        self.font = hb.hb_font_create(face)
+        # The font holds its own references.
+        hb.hb_face_destroy(face)
+        hb.hb_blob_destroy(blob)
+
+    def version(self):
+        return "libharfbuzz %s" % self.hb.hb_version_string().decode("ascii")
+
+    def shape_one(self, buf, txt):
+        hb = self.hb
+        utf8 = txt.encode("utf-8")
+        # HarfBuzz clusters are offsets into what it was given - UTF-8 bytes. Map them to characters.
+        char_indices = []
+        char_idx = -1
+        for byte in bytearray(utf8):
+            if byte & 0xc0 != 0x80:
+                char_idx += 1
+            char_indices.append(char_idx)
+        hb.hb_buffer_clear_contents(buf)
+        hb.hb_buffer_add_utf8(buf, utf8, len(utf8), 0, len(utf8))
+        hb.hb_buffer_guess_segment_properties(buf)
+        hb.hb_shape(self.font, buf, None, 0)
+        count = ctypes.c_uint()
+        infos = hb.hb_buffer_get_glyph_infos(buf, ctypes.byref(count))
+        positions = hb.hb_buffer_get_glyph_positions(buf, ctypes.byref(count))
+        return [{"g": infos[idx].codepoint, "cl": char_indices[infos[idx].cluster],
+                 "dx": positions[idx].x_offset, "dy": positions[idx].y_offset,
+                 "ax": positions[idx].x_advance, "ay": positions[idx].y_advance} for idx in range(count.value)]
+
+    def shape(self, texts):
+        buf = self.hb.hb_buffer_create()
+        try:
+            return [self.shape_one(buf, txt) for txt in texts]
+        finally:
+            self.hb.hb_buffer_destroy(buf)
+
+    def close(self):
+        if self.font:
+            self.hb.hb_font_destroy(self.font)
+            self.font = None
+
+SHAPER_BACKENDS = ("auto", "hb-shape", "libharfbuzz")
+
+def open_shaper(font_path, backend="auto", lib_path=None):
+    # "auto" uses libharfbuzz if it can be found, and hb-shape otherwise.
+    if backend != "hb-shape":
+        lib_path = lib_path or ctypes.util.find_library("harfbuzz")
+        if lib_path:
+            return LibHarfBuzzShaper(font_path, lib_path)
+        assert backend == "auto", "libharfbuzz not found - pass its path"
+    return HBShapeShaper(font_path)
@@ -0,0 +1,136 @@
+from __future__ import division, print_function
+import argparse
+from collections import Counter, namedtuple
+import glob
+import os
+import struct
+import sys
+import lut_shaper
+import pfo_diff
+import shaper_bench
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "pebblesdk"))
+from pfo import HASH_TABLE_ITEM, PFOReader
+import rle4
+
+# Simulates the work the watch does to draw each string of a corpus, in each font of a build: shape it
+# (given the generated LUTs - via lut_shaper.py), then for every codepoint hash into the PFO's directory,
+# walk the chain to its glyph (falling back to the wildcard glyph, as the firmware does), and decode the glyph.
+# Reports what that costs - chain probes, bytes of font read, pixels decoded - per font and for the costliest
+# strings, so font and LUT layouts can be compared without a watch.
+# Every glyph is decoded each time it's drawn - no glyph cache is modelled.
+
+StringCost = namedtuple("StringCost", "chars shaper_probes chain_probes bytes pixels rle_units wildcards")
+COST_FORMATS = (
+    ("shaper_probes", "LUT probes"),
+    ("chain_probes", "chain probes"),
+    ("bytes", "bytes read"),
+    ("pixels", "pixels"),
+    ("rle_units", "RLE4 units"),
+)
+
+def open_fonts(path, max_resources):
+    # [(name, PFOReader)] for a langpack (.pbl), a directory of .pfo files, or a .pfo - as pfo_diff takes them.
+    if os.path.isdir(path):
+        font_paths = sorted(glob.glob(os.path.join(path, "*.pfo")))
+    elif path.endswith(".pfo"):
+        font_paths = [path]
+    else:
+        buf = pfo_diff.open_buffer(path)
+        return [("%03d" % resid, PFOReader(buf, offset))
+                for resid, (offset, size) in sorted(pfo_diff.pbpack_resources(buf, max_resources).items())
+                if pfo_diff.is_pfo(buf, offset, size)]
+    return [(os.path.basename(font_path), PFOReader(pfo_diff.open_buffer(font_path))) for font_path in font_paths]
+
+def glyph_cost(reader, offset):
+    # (bytes read, pixels decoded, RLE4 units decoded) drawing the glyph at offset.
+    width, height = struct.unpack_from("<BB", reader.buf, reader.glyph_table_base + offset)
+    size = reader.glyph_size(offset)
+    if not (width and height):
+        return size, 0, 0
+    if reader.compressed:
+        # The height field is the unit count - the pixels are however many the units expand to.
+        glyph = reader.glyph(offset)
+        return size, len(rle4.decode(glyph[rle4.GLYPH_HEADER_SIZE:], height)), height
+    return size, width * height, 0
+
+class FontSimulator:
+    def __init__(self, reader):
+        self.reader = reader
+        self.glyph_costs = {}
+
+    def find(self, codepoint):
+        # (glyph offset or None, chain probes, bytes read) - a hash directory entry, then the chain items compared.
+        offset, probes = self.reader.find(codepoint)
+        return offset, probes, HASH_TABLE_ITEM.size + probes * self.reader.offset_item.size
+
+    def draw(self, codepts, shaper_probes=0):
+        chain_probes = read_bytes = pixels = rle_units = wildcards = 0
+        for codept in codepts:
+            offset, probes, lookup_bytes = self.find(codept)
+            if offset is None:
+                wildcards += 1
+                offset, wildcard_probes, wildcard_bytes = self.find(self.reader.info.wildcard_codepoint)
+                probes += wildcard_probes
+                lookup_bytes += wildcard_bytes
+            chain_probes += probes
+            read_bytes += lookup_bytes
+            if offset is None:
+                continue
+            if offset not in self.glyph_costs:
+                self.glyph_costs[offset] = glyph_cost(self.reader, offset)
+            glyph_bytes, glyph_pixels, glyph_units = self.glyph_costs[offset]
+            read_bytes += glyph_bytes
+            pixels += glyph_pixels
+            rle_units += glyph_units
+        return StringCost(len(codepts), shaper_probes, chain_probes, read_bytes, pixels, rle_units, wildcards)
+
+def shape_lines(lines, lut, layout):
+    # [(codepts as drawn, LUT probes)] - the lines unchanged if there's no LUT.
+    shaped = []
+    for line in lines:
+        codepts = [ord(c) for c in line]
+        if lut is None:
+            shaped.append((codepts, 0))
+            continue
+        probes = Counter()
+        shaped.append((lut_shaper.shape(lut, codepts, layout, probes), sum(probes.values())))
+    return shaped
+
+def print_font(name, costs, lines, show):
+    chars = sum(cost.chars for cost in costs)
+    print("%s: %d strings, %d chars, %d drawn with the wildcard" % (
+        name, len(costs), chars, sum(cost.wildcards for cost in costs)))
+    for field, label in COST_FORMATS:
+        total = sum(getattr(cost, field) for cost in costs)
+        print("  %-14s %10.2f/char %10d max/string" % (
+            label, total / chars if chars else 0, max(getattr(cost, field) for cost in costs) if costs else 0))
+    if show:
+        print("  Costliest strings (bytes read):")
+        for cost, line in sorted(zip(costs, lines), key=lambda x: -x[0].bytes)[:show]:
+            print("  %8d %s" % (cost.bytes, line))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate the glyph lookup & decode cost of drawing a corpus")
+    parser.add_argument("fonts", help="langpack (.pbl), directory of .pfo files, or a .pfo")
+    parser.add_argument("corpus", nargs="+", help="UTF-8 text files, one message per line")
+    parser.add_argument("--code-dir", help="directory with the generated LUTs (see lut_shaper.py) - to shape the strings first")
+    parser.add_argument("--layout", choices=lut_shaper.SHAPER_LAYOUTS, default=lut_shaper.LAYOUT_SCAN,
+                        help="LUT layout to count shaper probes for")
+    parser.add_argument("--max-resources", type=int, default=pfo_diff.LANGPACK_MAX_RESOURCES,
+                        help="resource table size of a langpack (default %d)" % pfo_diff.LANGPACK_MAX_RESOURCES)
+    parser.add_argument("--show", type=int, default=5, help="list this many of the costliest strings per font")
+    args = parser.parse_args()
+
+    lines = shaper_bench.read_corpus(args.corpus)
+    lut = lut_shaper.load_lut(args.code_dir) if args.code_dir else None
+    shaped = shape_lines(lines, lut, args.layout)
+    fonts = open_fonts(args.fonts, args.max_resources)
+    try:
+        for name, reader in fonts:
+            simulator = FontSimulator(reader)
+            print_font(name, [simulator.draw(codepts, probes) for codepts, probes in shaped], lines, args.show)
+    finally:
+        # A langpack's readers share its buffer - so they're closed once they're all done with.
+        for _, reader in fonts:
+            reader.close()
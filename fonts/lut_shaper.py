@@ -0,0 +1,243 @@
+from __future__ import division
+from collections import namedtuple
+import os
+import re
+import struct
+from codept_props import CODEPT_SHAPED, CODEPT_ZERO_WIDTH
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+# A host-side port of the contextual-form state machine in runtime/text_shaper.c.
+# It reads the LUTs straight out of the generated text_shaper_lut.c/.h, codept_props.c/.h and font_ranges.h,
+# so it shapes exactly what the watch would given the same build.
+# Lookups can be made the way either LUT layout is searched (see find_lut_entry_by_codept), and counted:
+# pass a Counter as `probes` to have the LUT elements each lookup reads added up by table.
+
+ShaperLUTEntry = namedtuple("ShaperLUTEntry", "true_codept isolated_codept initial_delta medial_delta final_delta")
+# index, index_base & exceptions are None unless the index was generated; unshape_lut is None for old builds.
+ShaperLUT = namedtuple("ShaperLUT", "entries ligatures ligature_roots ligature_roots_base ligature_trie "
+                                    "props zero_width_codept "
+                                    "index index_base exceptions unshape_lut shapable_ranges")
+
+SHAPER_LUT_ENTRY = struct.Struct("<HHbbb")
+LIG_REPLACEMENT_CODEPT_MASK = 1 << 15
+
+# Scanning the LUT for the true codept (aplite), or reading ARABIC_SHAPER_INDEX (-DARABIC_SHAPER_INDEXED).
+LAYOUT_SCAN = "scan"
+LAYOUT_INDEXED = "indexed"
+SHAPER_LAYOUTS = (LAYOUT_SCAN, LAYOUT_INDEXED)
+
+def read_c_array(c_source, name):
+    match = re.search(r"\b%s\[\]\s*=\s*\{([^}]*)\}" % re.escape(name), c_source)
+    assert match, "%s not found in generated code" % name
+    return [int(x, 0) for x in match.group(1).split(",") if x.strip()]
+
+def read_optional_c_array(c_source, name):
+    if not re.search(r"\b%s\[\]\s*=" % re.escape(name), c_source):
+        return None
+    return read_c_array(c_source, name)
+
+def count_probes(probes, table, count=1):
+    if probes is not None:
+        probes[table] += count
+
+def load_lut(code_dir):
+    lut_c = open(os.path.join(code_dir, "text_shaper_lut.c"), "r").read()
+    lut_data = bytearray(read_c_array(lut_c, "ARABIC_SHAPER_LUT"))
+    lig_data = bytearray(read_c_array(lut_c, "ARABIC_LIGATURE_LUT"))
+    lut_h = open(os.path.join(code_dir, "text_shaper_lut.h"), "r").read()
+    font_ranges_h = open(os.path.join(code_dir, "font_ranges.h"), "r").read()
+
+    entries = [ShaperLUTEntry(*SHAPER_LUT_ENTRY.unpack_from(bytes(lut_data), off))
+               for off in range(0, len(lut_data), SHAPER_LUT_ENTRY.size)]
+    ligatures = list(struct.unpack("<%dH" % (len(lig_data) // 2), bytes(lig_data)))
+    zero_width_codept = int(re.search(r"#define ZERO_WIDTH_CODEPT (\d+)", font_ranges_h).group(1))
+
+    ligature_roots = read_c_array(lut_c, "ARABIC_LIGATURE_ROOTS")
+    ligature_roots_base = int(re.search(r"#define ARABIC_LIGATURE_ROOTS_BASE (\w+)", lut_h).group(1), 0)
+    ligature_trie = read_c_array(lut_c, "ARABIC_LIGATURE_TRIE")
+
+    index = read_optional_c_array(lut_c, "ARABIC_SHAPER_INDEX")
+    index_base = exceptions = None
+    if index is not None:
+        index_base = int(re.search(r"#define ARABIC_SHAPER_INDEX_BASE (\w+)", lut_h).group(1), 0)
+        exceptions = read_c_array(lut_c, "ARABIC_SHAPER_EXCEPTIONS")
+    unshape_lut = read_optional_c_array(lut_c, "ARABIC_UNSHAPE_LUT")
+
+    # The codept property table, unpacked - props[codept] is codept_props(codept), for codepts below the limit.
+    props_c = open(os.path.join(code_dir, "codept_props.c"), "r").read()
+    props_h = open(os.path.join(code_dir, "codept_props.h"), "r").read()
+    page_shift = int(re.search(r"#define CODEPT_PROPS_PAGE_SHIFT (\d+)", props_h).group(1))
+    props_limit = int(re.search(r"#define CODEPT_PROPS_LIMIT (\w+)", props_h).group(1), 0)
+    page_index = read_c_array(props_c, "CODEPT_PROPS_PAGE_INDEX")
+    pages = read_c_array(props_c, "CODEPT_PROPS_PAGES")
+    props = [pages[(page_index[cp >> page_shift] << page_shift) | (cp & ((1 << page_shift) - 1))]
+             for cp in range(props_limit)]
+    shaped = [cp for cp in range(props_limit) if props[cp] & CODEPT_SHAPED]
+    shapable_ranges = [(start, end + 1) for start, end in contiguous_ranges(shaped)]
+    return ShaperLUT(entries, ligatures, ligature_roots, ligature_roots_base, ligature_trie,
+                     props, zero_width_codept,
+                     index, index_base, exceptions, unshape_lut, shapable_ranges)
+
+def contiguous_ranges(vals):
+    # (first, last) of each run of consecutive values.
+    runs = []
+    for val in sorted(vals):
+        if runs and runs[-1][1] + 1 == val:
+            runs[-1] = (runs[-1][0], val)
+        else:
+            runs.append((val, val))
+    return runs
+
+def codept_props(lut, codept):
+    return lut.props[codept] if codept < len(lut.props) else 0
+
+def is_zero_width(lut, codept):
+    return bool(codept_props(lut, codept) & CODEPT_ZERO_WIDTH)
+
+def find_lut_entry_by_codept(lut, codept, layout=LAYOUT_SCAN, probes=None):
+    if layout == LAYOUT_INDEXED:
+        assert lut.index is not None, "This build has no ARABIC_SHAPER_INDEX"
+        if lut.index_base <= codept < lut.index_base + len(lut.index):
+            count_probes(probes, "index")
+            entry_idx = lut.index[codept - lut.index_base]
+            return lut.entries[entry_idx - 1] if entry_idx else None
+        for entry_idx in lut.exceptions:
+            count_probes(probes, "lut")
+            if lut.entries[entry_idx].true_codept == codept:
+                return lut.entries[entry_idx]
+        return None
+    for entry in lut.entries:
+        count_probes(probes, "lut")
+        if entry.true_codept == codept:
+            return entry
+    return None
+
+def find_ligature(lut, codepts, pos, probes=None):
+    # Returns (the longest ligature starting at pos or 0, the index of its last character) - walking the trie.
+    codept = codepts[pos]
+    count_probes(probes, "ligature")
+    if not lut.ligature_roots_base <= codept < lut.ligature_roots_base + len(lut.ligature_roots):
+        return 0, None
+    node = lut.ligature_roots[codept - lut.ligature_roots_base]
+    ligature = last_idx = None
+    idx = pos + 1
+    while node and idx < len(codepts):
+        child_count = lut.ligature_trie[node - 1 + 1]
+        children = lut.ligature_trie[node - 1 + 2:node - 1 + 2 + 2 * child_count]
+        node = 0
+        for child_idx in range(child_count):
+            count_probes(probes, "ligature")
+            if children[2 * child_idx] == codepts[idx]:
+                node = children[2 * child_idx + 1]
+                break
+        if node and lut.ligature_trie[node - 1]:
+            # Keep going - a longer ligature wins.
+            ligature = lut.ligature_trie[node - 1]
+            last_idx = idx
+        idx += 1
+    return ligature or 0, last_idx
+
+def shape(lut, codepts, layout=LAYOUT_SCAN, probes=None):
+    # Returns the shaped codepoints - same length as the input, as the runtime shapes in-place.
+    STATE_INITIAL, STATE_MEDIAL = range(2)
+    THIS_CODEPT, NEXT_CODEPT = range(2)
+    out = list(codepts)
+    state = STATE_INITIAL
+    codept_buffer = [0, 0]
+    next_idx = this_idx = None
+    next_lut_entry = None
+    late_finalize_idx = None
+    late_finalize_lut_entry = None
+    pos = 0
+    while True:
+        # Read forward one.
+        codept_buffer[THIS_CODEPT] = codept_buffer[NEXT_CODEPT]
+        this_idx = next_idx
+        this_lut_entry = next_lut_entry
+        if pos < len(codepts):
+            # Check for a ligature starting here.
+            # It takes the place of its last character - the ones before are made zero-width, and skipped.
+            lig_codept, lig_last_idx = find_ligature(lut, codepts, pos, probes)
+            if lig_codept:
+                for idx in range(pos, lig_last_idx):
+                    out[idx] = lut.zero_width_codept
+                pos = lig_last_idx
+            next_idx = pos
+            codept_buffer[NEXT_CODEPT] = lig_codept or codepts[pos]
+            pos += 1
+
+            next_lut_entry = find_lut_entry_by_codept(lut, codept_buffer[NEXT_CODEPT], layout, probes)
+        else:
+            codept_buffer[NEXT_CODEPT] = 0
+            next_idx = None
+            next_lut_entry = None
+
+        if is_zero_width(lut, codept_buffer[THIS_CODEPT]):
+            # Don't do anything rash.
+            pass
+        elif this_lut_entry:
+            if ((not next_lut_entry and not is_zero_width(lut, codept_buffer[NEXT_CODEPT])) or
+                    (this_lut_entry.medial_delta == this_lut_entry.final_delta and this_lut_entry.final_delta)):
+                # Final, or isolated form.
+                if state == STATE_INITIAL:
+                    out[this_idx] = this_lut_entry.isolated_codept
+                else:
+                    out[this_idx] = this_lut_entry.isolated_codept + this_lut_entry.final_delta
+                late_finalize_idx = None
+                state = STATE_INITIAL
+            elif state == STATE_INITIAL:
+                late_finalize_idx = this_idx
+                late_finalize_lut_entry = this_lut_entry
+                state = STATE_MEDIAL
+                out[this_idx] = this_lut_entry.isolated_codept + this_lut_entry.initial_delta
+            else:
+                late_finalize_idx = this_idx
+                late_finalize_lut_entry = this_lut_entry
+                out[this_idx] = this_lut_entry.isolated_codept + this_lut_entry.medial_delta
+        else:
+            # Not a shapable character - reset the state.
+            # First, close any existing word.
+            if late_finalize_idx is not None:
+                if state == STATE_INITIAL:
+                    out[late_finalize_idx] = late_finalize_lut_entry.isolated_codept
+                else:
+                    out[late_finalize_idx] = late_finalize_lut_entry.isolated_codept + late_finalize_lut_entry.final_delta
+                late_finalize_idx = None
+            state = STATE_INITIAL
+
+        if not (codept_buffer[THIS_CODEPT] or codept_buffer[NEXT_CODEPT]):
+            break
+    return out
+
+def unshape(lut, codepts, probes=None):
+    # As unshape_text, with ARABIC_UNSHAPE_LUT: returns the codepoints shaped text came from.
+    assert lut.unshape_lut is not None, "This build has no ARABIC_UNSHAPE_LUT"
+    out = list(codepts)
+    for idx, codept in enumerate(codepts):
+        unshape_idx = 0
+        for start, end in lut.shapable_ranges:
+            if start <= codept < end:
+                break
+            unshape_idx += end - start
+        else:
+            continue
+        count_probes(probes, "unshape")
+        old_codept = lut.unshape_lut[unshape_idx + codept - start]
+        if old_codept & LIG_REPLACEMENT_CODEPT_MASK:
+            pattern_start = old_codept & ~LIG_REPLACEMENT_CODEPT_MASK
+            pattern_end = pattern_start
+            while not lut.ligatures[pattern_end] & LIG_REPLACEMENT_CODEPT_MASK:
+                pattern_end += 1
+            # The pattern ends where the ligature was.
+            first = idx - (pattern_end - pattern_start - 1)
+            out[first:idx + 1] = lut.ligatures[pattern_start:pattern_end]
+        elif old_codept:
+            out[idx] = old_codept
+    return out
+
+def shape_string(lut, text, layout=LAYOUT_SCAN):
+    return u"".join(unichr(c) for c in shape(lut, [ord(c) for c in text], layout))
@@ -0,0 +1,134 @@
+from __future__ import division, print_function
+import argparse
+from collections import namedtuple
+import glob
+import mmap
+import os
+import struct
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "pebblesdk"))
+from pfo import FONT_VERSION_2, FONT_VERSION_3, PFOReader
+from pfo_hashtable import hash_table_stats
+
+# Compares the fonts of two builds - langpacks (.pbl), directories of .pfo files, or single fonts -
+# by what matters on the watch: flash used, and the cost of looking up & decoding glyphs.
+# Fonts are read in place (a langpack is mmap'd once), and only their tables and glyph headers are touched.
+
+PBPACK_HEADER = struct.Struct("<III")
+PBPACK_TABLE_ITEM = struct.Struct("<IIII")
+PBPACK_TABLE_OFFSET = 0xC
+LANGPACK_MAX_RESOURCES = 256
+
+FontSummary = namedtuple("FontSummary", "codepoints records glyph_bytes table_bytes max_chain mean_chain "
+                                        "expected_probes rle_units")
+
+SUMMARY_FORMATS = (
+    ("codepoints", "%d"),
+    ("records", "%d"),
+    ("glyph_bytes", "%d"),
+    ("table_bytes", "%d"),
+    ("max_chain", "%d"),
+    ("mean_chain", "%.2f"),
+    ("expected_probes", "%.3f"),
+    ("rle_units", "%d"),
+)
+
+def pbpack_resources(buf, max_resources=LANGPACK_MAX_RESOURCES):
+    # {resource id: (offset in buf, size)} - the layout written by generator.pack_resources.
+    count, _, _ = PBPACK_HEADER.unpack_from(buf, 0)
+    data_base = PBPACK_TABLE_OFFSET + max_resources * PBPACK_TABLE_ITEM.size
+    resources = {}
+    for idx in range(count):
+        resid, offset, size, _ = PBPACK_TABLE_ITEM.unpack_from(buf, PBPACK_TABLE_OFFSET + idx * PBPACK_TABLE_ITEM.size)
+        resources[resid] = (data_base + offset, size)
+    return resources
+
+def is_pfo(buf, offset, size):
+    # Langpacks hold other resources too (e.g. the translation MO) - they won't look like a font.
+    return size > 0 and struct.unpack_from("<B", buf, offset)[0] in (FONT_VERSION_2, FONT_VERSION_3)
+
+def font_summary(reader, size):
+    codepoints = []
+    offsets = set()
+    for codepoint, offset in reader.items():
+        codepoints.append(codepoint)
+        offsets.add(offset)
+    rle_units = 0
+    if reader.compressed:
+        for offset in offsets:
+            width, height = struct.unpack_from("<BB", reader.buf, reader.glyph_table_base + offset)
+            if width and height:
+                rle_units += height  # The height field holds the unit count.
+    table_bytes = reader.glyph_table_base - reader.base
+    stats = hash_table_stats(codepoints, reader.info.hash_table_size)
+    return FontSummary(
+        codepoints=len(codepoints),
+        records=len(offsets),
+        glyph_bytes=size - table_bytes,
+        table_bytes=table_bytes,
+        max_chain=stats.max_chain,
+        mean_chain=stats.mean_chain,
+        expected_probes=stats.expected_probes,
+        rle_units=rle_units
+    )
+
+def open_buffer(path):
+    with open(path, "rb") as fd:
+        return mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+def build_summaries(path, max_resources):
+    # Returns ({font name: FontSummary}, total bytes).
+    summaries = {}
+    if os.path.isdir(path):
+        font_paths = sorted(glob.glob(os.path.join(path, "*.pfo")))
+    elif path.endswith(".pfo"):
+        font_paths = [path]
+    else:
+        buf = open_buffer(path)
+        for resid, (offset, size) in sorted(pbpack_resources(buf, max_resources).items()):
+            if is_pfo(buf, offset, size):
+                summaries["%03d" % resid] = font_summary(PFOReader(buf, offset), size)
+        total = len(buf)
+        buf.close()
+        return summaries, total
+
+    total = 0
+    for font_path in font_paths:
+        buf = open_buffer(font_path)
+        summaries[os.path.basename(font_path)] = font_summary(PFOReader(buf), len(buf))
+        total += len(buf)
+        buf.close()
+    return summaries, total
+
+def format_change(fmt, old, new):
+    if old is None:
+        return "(new) " + fmt % new
+    if new is None:
+        return fmt % old + " (removed)"
+    if old == new:
+        return fmt % new
+    return ("%s -> %s (%+" + fmt[1:] + ")") % (fmt % old, fmt % new, new - old)
+
+def print_diff(old_summaries, new_summaries, show_all):
+    for name in sorted(set(old_summaries) | set(new_summaries)):
+        old, new = old_summaries.get(name), new_summaries.get(name)
+        if old == new and not show_all:
+            continue
+        print("%s:" % name)
+        for field, fmt in SUMMARY_FORMATS:
+            print("  %-16s %s" % (field, format_change(fmt, old and getattr(old, field), new and getattr(new, field))))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare font size & lookup cost between two builds")
+    parser.add_argument("old", help="langpack (.pbl), directory of .pfo files, or a .pfo")
+    parser.add_argument("new", help="langpack (.pbl), directory of .pfo files, or a .pfo")
+    parser.add_argument("--max-resources", type=int, default=LANGPACK_MAX_RESOURCES,
+                        help="resource table size of the packs (default %d, as for langpacks)" % LANGPACK_MAX_RESOURCES)
+    parser.add_argument("--all", action="store_true", help="list unchanged fonts too")
+    args = parser.parse_args()
+
+    old_summaries, old_total = build_summaries(args.old, args.max_resources)
+    new_summaries, new_total = build_summaries(args.new, args.max_resources)
+    print_diff(old_summaries, new_summaries, args.all)
+    print("Total: %s bytes" % format_change("%d", old_total, new_total))
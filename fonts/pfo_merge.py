@@ -1,121 +1,242 @@
 from __future__ import division
-import math
-from collections import namedtuple, defaultdict
+import argparse
+import json
+from collections import namedtuple
+import os
 import struct
 import sys
 
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "pebblesdk"))
+from pfo import (FEATURE_OFFSET_16, FEATURE_RLE4, FONT_VERSION_3, FontInfo, GLYPH_TABLE_PADDING,
+                 offsets_fit_16, open_pfo, pack_pfo)
+from pfo_hashtable import hash_table_stats, optimal_hash_table_size, format_stats
+from glyph_stats import write_glyph_stats
+import rle4
+
 Font = namedtuple("Font", "max_height wildcard compressed glyphs")
 Glyph = namedtuple("Glyph", "codepoints data")
+EncodingReport = namedtuple("EncodingReport", "compressed feasible glyph_bytes mean_units max_units min_headroom")
 
 HASHTABLE_DIRECTORY_SIZE = 255
-HASHTABLE_DIRECTORY_ITEM_SIZE = 4
-OFFSET_TABLE_MAX_SIZE = 128
 
 def font_read(pfo_path):
-    HASHTABLE_CHAIN_ITEM = struct.Struct("<HH")
-    pfo = open(pfo_path, "rb").read()
-
-    pfo_ver = struct.unpack("<B", pfo[0])[0]
-    assert pfo_ver in (2, 3), "%s has unknown PFO version %d" % (pfo_path, pfo_ver)
-    if pfo_ver == 2:
-        HEADER_SIZE = 8
-        pfo_ver, max_height, codept_ct, wildcard, hashtable_sz, codept_sz = struct.unpack('<BBHHBB', pfo[:HEADER_SIZE])
-        compressed = False
-    else:
-        HEADER_SIZE = 10
-        pfo_ver, max_height, codept_ct, wildcard, hashtable_sz, codept_sz, s_size, features = struct.unpack('<BBHHBBBB', pfo[:HEADER_SIZE])
-        if not features & 1:
-            HASHTABLE_CHAIN_ITEM = struct.Struct("<HL")
-        compressed = features & 2
-    assert codept_sz == 2
-
-    glyphs = {}
-
-    glyphs_base = HEADER_SIZE + HASHTABLE_DIRECTORY_SIZE * HASHTABLE_DIRECTORY_ITEM_SIZE + codept_ct * HASHTABLE_CHAIN_ITEM.size
-
-    for directory_index in range(HASHTABLE_DIRECTORY_SIZE):
-        dir_addr = HEADER_SIZE + directory_index * HASHTABLE_DIRECTORY_ITEM_SIZE
-        _, table_size, offset = struct.unpack("<BBH", pfo[dir_addr:dir_addr + HASHTABLE_DIRECTORY_ITEM_SIZE])
-        chain_base = HEADER_SIZE + HASHTABLE_DIRECTORY_SIZE * HASHTABLE_DIRECTORY_ITEM_SIZE + offset
-        for item_idx in range(table_size):
-            item_addr = chain_base + item_idx * HASHTABLE_CHAIN_ITEM.size
-            codept, offset = HASHTABLE_CHAIN_ITEM.unpack(pfo[item_addr:item_addr + HASHTABLE_CHAIN_ITEM.size])
+    with open_pfo(pfo_path) as reader:
+        assert reader.info.codepoint_bytes == 2
+        glyphs = {}
+        for codept, offset in reader.items():
             if offset not in glyphs:
-                data_start = glyphs_base + offset
-                h, w = struct.unpack("<BB", pfo[data_start:data_start + 2])
-                bitmap_data_sz = int(math.ceil((h * w) / 8))
-                bitmap_data_sz = int(math.ceil(bitmap_data_sz / 4) * 4)
-                data_end = data_start + 5 + bitmap_data_sz
-                glyph_data = pfo[data_start:data_end]
-                glyphs[offset] = Glyph([codept], glyph_data)
+                glyphs[offset] = Glyph([codept], reader.glyph(offset))
             else:
                 glyphs[offset].codepoints.append(codept)
-    return Font(max_height, wildcard, compressed, glyphs)
+        return Font(reader.info.max_height, reader.info.wildcard_codepoint, reader.compressed, glyphs)
 
-def font_write(font, pfo_path):
-    bitmapdata_length = sum(len(g.data) for g in font.glyphs.values())
-    HASHTABLE_CHAIN_ITEM = struct.Struct("<HL")
-    features = 0
-    if bitmapdata_length < 65535:
-        HASHTABLE_CHAIN_ITEM = struct.Struct("<HH")
-        features |= 1
-    if font.compressed:
-        features |= 2
-    header = struct.pack('<BBHHBBBB', 3, font.max_height, sum((len(x.codepoints) for x in font.glyphs.values())), font.wildcard, HASHTABLE_DIRECTORY_SIZE, 2, 10, features)
-
-    # Generate hashtable chain lists
-    glyph_data = "\0\0\0\0"
-    codepoint_offset_pairs = []
+def font_write(font, pfo_path, hashtable_sz=HASHTABLE_DIRECTORY_SIZE):
+    # Lay the glyphs out in order of their first codepoint.
+    glyph_records = []
+    entries = []
+    offset = GLYPH_TABLE_PADDING
     for glyph in sorted(font.glyphs.values(), key=lambda x: x.codepoints[0]):
         for cpt in glyph.codepoints:
-            codepoint_offset_pairs.append((cpt, len(glyph_data)))
-        glyph_data += glyph.data
-
-    chains = ["" for i in range(HASHTABLE_DIRECTORY_SIZE)]
-    chain_counts = defaultdict(int)
-    for cpt, offset in sorted(codepoint_offset_pairs, key=lambda x: x[0]):
-        bin_no = cpt % HASHTABLE_DIRECTORY_SIZE
-        chains[bin_no] += HASHTABLE_CHAIN_ITEM.pack(cpt, offset)
-        chain_counts[bin_no] += 1
-        assert chain_counts[bin_no] < OFFSET_TABLE_MAX_SIZE
-
-    # Generate hashtable directory
-    hashtable_data = b''
-    off = 0
-    for x in range(HASHTABLE_DIRECTORY_SIZE):
-        hashtable_data += struct.pack("<BBH", x, chain_counts[x], off)
-        off += len(chains[x])
-
-    open(pfo_path, "wb").write(header + hashtable_data + "".join(chains) + glyph_data)
-
-def merge_fonts(font_1, font_2):
-    assert font_1.compressed == font_2.compressed
-    max_height = font_1.max_height
-
-    font_cpt_map = {}
-    for glyph in font_1.glyphs.values():
-        new_glyph = Glyph([], glyph.data)
-        for cpt in glyph.codepoints:
-            font_cpt_map[cpt] = new_glyph
-
-    for glyph in font_2.glyphs.values():
-        new_glyph = Glyph([], glyph.data)
-        for cpt in glyph.codepoints:
-            font_cpt_map[cpt] = new_glyph
+            entries.append((cpt, offset))
+        glyph_records.append(glyph.data)
+        offset += len(glyph.data)
 
+    features = 0
+    if offsets_fit_16(offset):
+        features |= FEATURE_OFFSET_16
+    if font.compressed:
+        features |= FEATURE_RLE4
+    info = FontInfo(FONT_VERSION_3, font.max_height, len(entries), font.wildcard, hashtable_sz, 2, features)
+    with open(pfo_path, "wb") as fd:
+        fd.write(pack_pfo(info, entries, glyph_records))
+
+def merge_fonts(fonts):
+    # Later fonts take precedence. Each codepoint is resolved once to the glyph of the last font that
+    # has it, then glyphs that pack to byte-identical records - e.g. digits, or zero-width glyphs, from
+    # different member fonts (or different glyph indices in the same font) - are stored once.
+    # Returns (font, bytes saved by deduplicating).
+    assert all(font.compressed == fonts[0].compressed for font in fonts)
+    cpt_owners = {}
+    for font_idx, font in enumerate(fonts):
+        for key, glyph in font.glyphs.items():
+            for cpt in glyph.codepoints:
+                cpt_owners[cpt] = (font_idx, key)
+
+    data_glyphs = {}
+    records = set()
+    for cpt in sorted(cpt_owners):
+        font_idx, key = cpt_owners[cpt]
+        data = fonts[font_idx].glyphs[key].data
+        records.add((font_idx, key))
+        try:
+            data_glyphs[data].codepoints.append(cpt)
+        except KeyError:
+            data_glyphs[data] = Glyph([cpt], data)
+
+    bytes_saved = (sum(len(fonts[font_idx].glyphs[key].data) for font_idx, key in records) -
+                   sum(len(data) for data in data_glyphs))
+    font_glyphs = {glyph.codepoints[0]: glyph for glyph in data_glyphs.values()}
+    return Font(fonts[0].max_height, fonts[0].wildcard, fonts[0].compressed, font_glyphs), bytes_saved
+
+def glyph_decode(data, compressed):
+    # Returns (width, height, bitmap), plus the rest of the header (left, top, advance) untouched.
+    width, height = struct.unpack("<BB", data[:2])
+    if not (width and height):
+        return width, height, [], data[2:5]
+    if compressed:
+        bitmap = rle4.decode(data[5:], height)
+        height = len(bitmap) // width
+    else:
+        bitmap = rle4.unpack_raw(data[5:], width * height)
+    return width, height, bitmap, data[2:5]
+
+def glyph_encode_checked(width, height, bitmap, header_tail, compressed):
+    # Returns the glyph data and its in-place decode headroom (None unless it's an RLE4 bitmap).
+    # Raises ValueError if the glyph can't be RLE4 encoded (or decoded in-place on the watch).
+    if not (width and height):
+        return struct.pack("<BB", width, height) + header_tail, None
+    if compressed:
+        packed, units = rle4.encode(bitmap)
+        if units > 255:
+            raise ValueError("more than 255 RLE4 units required")
+        headroom = rle4.decode_headroom(packed, units)
+        return struct.pack("<BB", width, units) + header_tail + packed, headroom
+    return struct.pack("<BB", width, height) + header_tail + rle4.pack_raw(bitmap), None
+
+def glyph_encode(width, height, bitmap, header_tail, compressed):
+    return glyph_encode_checked(width, height, bitmap, header_tail, compressed)[0]
+
+def transcode_font(font, compressed):
+    if bool(font.compressed) == bool(compressed):
+        return font
     font_glyphs = {}
-    for cpt, glyph in font_cpt_map.items():
-        glyph.codepoints.append(cpt)
-        if glyph not in font_glyphs.values():
-            font_glyphs[cpt] = glyph
-    return Font(max_height, font_1.wildcard, font_1.compressed, font_glyphs)
-
-if len(sys.argv) < 3:
-    print("pfo_merge.py (font.pfo)+ out.pfo")
-    sys.exit(0)
-
-fonts = [font_read(pfo_path) for pfo_path in sys.argv[1:-1]]
-font_accum = fonts[0]
-for font in fonts[1:]:
-    font_accum = merge_fonts(font_accum, font)
-font_write(font_accum, sys.argv[-1])
+    for key, glyph in font.glyphs.items():
+        width, height, bitmap, header_tail = glyph_decode(glyph.data, font.compressed)
+        font_glyphs[key] = Glyph(glyph.codepoints, glyph_encode(width, height, bitmap, header_tail, compressed))
+    return Font(font.max_height, font.wildcard, compressed, font_glyphs)
+
+def encoding_report(font, compressed):
+    # Glyph data size, plus the on-watch decode cost - RLE4 units per glyph, and how close the
+    # in-place decode comes to overrunning its input.
+    glyph_bytes = 0
+    units = []
+    min_headroom = None
+    for glyph in font.glyphs.values():
+        width, height, bitmap, header_tail = glyph_decode(glyph.data, font.compressed)
+        try:
+            data, headroom = glyph_encode_checked(width, height, bitmap, header_tail, compressed)
+        except ValueError:
+            return EncodingReport(compressed, False, None, None, None, None)
+        glyph_bytes += len(data)
+        if headroom is not None:
+            units.append(struct.unpack("<B", data[1:2])[0])
+            min_headroom = headroom if min_headroom is None else min(min_headroom, headroom)
+    return EncodingReport(
+        compressed=compressed,
+        feasible=True,
+        glyph_bytes=glyph_bytes,
+        mean_units=(sum(units) / len(units)) if units else 0,
+        max_units=max(units) if units else 0,
+        min_headroom=min_headroom
+    )
+
+def format_encoding_report(report):
+    name = "RLE4" if report.compressed else "raw"
+    if not report.feasible:
+        return "%s: not possible" % name
+    if not report.compressed:
+        return "%s: %d glyph bytes" % (name, report.glyph_bytes)
+    return "%s: %d glyph bytes, %.1f units/glyph (max %d), min in-place decode headroom %d bytes" % (
+        name, report.glyph_bytes, report.mean_units, report.max_units, report.min_headroom)
+
+def choose_encoding(font, flash_budget=None, max_mean_units=None):
+    # Of the encodings that fit the budgets: with a flash budget, take raw if it fits (it's free to
+    # decode), otherwise take whichever is smaller.
+    reports = [encoding_report(font, False), encoding_report(font, True)]
+    for report in reports:
+        print(format_encoding_report(report))
+    candidates = [r for r in reports if r.feasible and
+                  (flash_budget is None or r.glyph_bytes <= flash_budget) and
+                  (not r.compressed or max_mean_units is None or r.mean_units <= max_mean_units)]
+    if not candidates:
+        raise Exception("No glyph encoding fits the budget (%s bytes, %s RLE4 units/glyph)" % (flash_budget, max_mean_units))
+    if flash_budget is not None:
+        return min(candidates, key=lambda r: r.compressed).compressed
+    return min(candidates, key=lambda r: r.glyph_bytes).compressed
+
+def font_codepoints(font):
+    return [cpt for glyph in font.glyphs.values() for cpt in glyph.codepoints]
+
+def font_glyph_stats(font):
+    # Per-codepoint stats for glyph_stats.write_glyph_stats. Offsets are those font_write will assign.
+    stats = []
+    offset = GLYPH_TABLE_PADDING
+    for glyph in sorted(font.glyphs.values(), key=lambda x: x.codepoints[0]):
+        width, height, bitmap, _ = glyph_decode(glyph.data, font.compressed)
+        rle_units = None
+        if font.compressed and bitmap:
+            rle_units = struct.unpack("<B", glyph.data[1:2])[0]
+        for cpt in glyph.codepoints:
+            stats.append({
+                "codepoint": cpt,
+                "gindex": None,
+                "width": width,
+                "height": height,
+                "packed_bytes": len(glyph.data),
+                "rle_units": rle_units,
+                "render_ms": None,
+                "offset": offset
+            })
+        offset += len(glyph.data)
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge PFOs - later fonts take precedence")
+    parser.add_argument("input_pfo", nargs="+", help="font.pfo")
+    parser.add_argument("output_pfo", help="out.pfo")
+    parser.add_argument("--optimize-hash-table", action="store_true",
+                        help="pick the hash table size that minimizes glyph lookup cost")
+    parser.add_argument("--compress", choices=("keep", "raw", "RLE4", "auto"), default="keep",
+                        help="glyph encoding of the output - keep that of the first font, or pick one (default: keep)")
+    parser.add_argument("--flash-budget", type=int,
+                        help="with --compress auto: maximum glyph data bytes")
+    parser.add_argument("--max-rle-units", type=float,
+                        help="with --compress auto: maximum mean RLE4 units per glyph (i.e. decode cost)")
+    parser.add_argument("--stats", help="JSON file to write per-glyph size and hash table stats of the output into")
+    parser.add_argument("--codept-labels", help="JSON map of codept->name to label glyphs with in --stats")
+    args = parser.parse_args()
+
+    fonts = [font_read(pfo_path) for pfo_path in args.input_pfo]
+    first_compressed = fonts[0].compressed
+    # Merge as raw - any glyph can be - and settle on the output's encoding once, afterwards.
+    fonts = [transcode_font(font, False) for font in fonts]
+    font_accum, dedupe_bytes_saved = merge_fonts(fonts)
+    if dedupe_bytes_saved:
+        print("Deduplicated identical glyph records, saving %d bytes" % dedupe_bytes_saved)
+
+    if args.compress == "auto":
+        compressed = choose_encoding(font_accum, args.flash_budget, args.max_rle_units)
+    elif args.compress == "keep":
+        compressed = first_compressed
+    else:
+        compressed = args.compress == "RLE4"
+    try:
+        font_accum = transcode_font(font_accum, compressed)
+    except ValueError as e:
+        raise Exception("Can't RLE4 encode %s: %s - use --compress raw or auto" % (args.output_pfo, e))
+    print("Writing %s glyphs" % ("RLE4" if font_accum.compressed else "raw"))
+
+    hashtable_sz = HASHTABLE_DIRECTORY_SIZE
+    if args.optimize_hash_table:
+        codepoints = font_codepoints(font_accum)
+        print("Hash table %s" % format_stats(hash_table_stats(codepoints, hashtable_sz)))
+        best = optimal_hash_table_size(codepoints)
+        print("Optimized %s" % format_stats(best))
+        hashtable_sz = best.size
+    font_write(font_accum, args.output_pfo, hashtable_sz)
+
+    if args.stats:
+        labels = None
+        if args.codept_labels:
+            labels = {int(k): v for k, v in json.load(open(args.codept_labels, "r")).items()}
+        write_glyph_stats(args.stats, os.path.basename(args.output_pfo), font_glyph_stats(font_accum), hashtable_sz, labels)
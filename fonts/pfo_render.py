@@ -0,0 +1,199 @@
+from __future__ import division, print_function
+import argparse
+from collections import namedtuple
+import glob
+import os
+import sys
+import numpy
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "pebblesdk"))
+from pfo import GLYPH_HEADER, open_pfo
+
+# Renders PFOs to images without a watch, and diffs two builds of a font pixel by pixel.
+# Every glyph is expanded to a numpy array once; sheets, strings and diffs are then just array copies.
+# Images are arrays of 0 (paper) and 1 (ink), written out as PBM - or PGM for diff sheets.
+
+GlyphImage = namedtuple("GlyphImage", "left top advance bitmap")
+GlyphChange = namedtuple("GlyphChange", "codepoint status changed_pixels")
+
+DIFF_PAPER, DIFF_CHANGED, DIFF_INK = 255, 128, 0
+
+def unpack_bits_lsb(data):
+    # numpy.unpackbits is MSB-first (and too old here to take bitorder=) - flip each byte's bits.
+    return numpy.unpackbits(numpy.frombuffer(data, dtype=numpy.uint8)).reshape(-1, 8)[:, ::-1].ravel()
+
+def decode_glyph(record, compressed):
+    width, height, left, top, advance = GLYPH_HEADER.unpack_from(record, 0)
+    data = record[GLYPH_HEADER.size:]
+    if not (width and height):
+        return GlyphImage(left, top, advance, numpy.zeros((0, width), dtype=numpy.uint8))
+    if compressed:
+        # Two units per byte, low nibble first: (bit 3) colour, (bits 0-2) run length - 1.
+        packed = numpy.frombuffer(data, dtype=numpy.uint8)
+        units = numpy.column_stack((packed & 0x0f, packed >> 4)).ravel()[:height]
+        bitmap = numpy.repeat((units >> 3) & 1, (units & 0x07) + 1)
+        height = len(bitmap) // width
+    else:
+        bitmap = unpack_bits_lsb(data)
+    return GlyphImage(left, top, advance, bitmap[:width * height].reshape(height, width).astype(numpy.uint8))
+
+def decode_font(pfo_path):
+    # Returns (max height, wildcard codepoint, {codepoint: GlyphImage}). Shared records are decoded once.
+    with open_pfo(pfo_path) as reader:
+        images = {}
+        glyphs = {}
+        for codepoint, offset in reader.items():
+            if offset not in images:
+                images[offset] = decode_glyph(reader.glyph(offset), reader.compressed)
+            glyphs[codepoint] = images[offset]
+        return reader.info.max_height, reader.info.wildcard_codepoint, glyphs
+
+def glyph_box(glyphs, max_height):
+    # (x0, y0, x1, y1) enclosing all the glyphs placed at a common origin, and at least one line high.
+    x0 = min([0] + [g.left for g in glyphs])
+    y0 = min([0] + [g.top for g in glyphs])
+    x1 = max([1] + [g.left + g.bitmap.shape[1] for g in glyphs] + [g.advance for g in glyphs])
+    y1 = max([max_height] + [g.top + g.bitmap.shape[0] for g in glyphs])
+    return x0, y0, x1, y1
+
+def place(canvas, glyph, x, y):
+    height, width = glyph.bitmap.shape
+    canvas[y + glyph.top:y + glyph.top + height, x + glyph.left:x + glyph.left + width] |= glyph.bitmap
+
+def render_string(font, text):
+    max_height, wildcard, glyphs = font
+    line = [glyphs.get(ord(c), glyphs.get(wildcard)) for c in text]
+    line = [g for g in line if g is not None]
+    pens = []
+    x = 0
+    for glyph in line:
+        pens.append(x)
+        x += glyph.advance
+    x0 = min([0] + [pen + g.left for pen, g in zip(pens, line)])
+    x1 = max([1, x] + [pen + g.left + g.bitmap.shape[1] for pen, g in zip(pens, line)])
+    _, y0, _, y1 = glyph_box(line, max_height)
+    canvas = numpy.zeros((y1 - y0, x1 - x0), dtype=numpy.uint8)
+    for pen, glyph in zip(pens, line):
+        place(canvas, glyph, pen - x0, -y0)
+    return canvas
+
+def contact_sheet(font, columns=16, codepoints=None):
+    max_height, _, glyphs = font
+    if codepoints is None:
+        codepoints = sorted(glyphs)
+    cells = [glyphs[cp] for cp in codepoints]
+    x0, y0, x1, y1 = glyph_box(cells, max_height)
+    cell_width, cell_height = x1 - x0 + 1, y1 - y0 + 1
+    rows = (len(cells) + columns - 1) // columns
+    canvas = numpy.zeros((max(rows, 1) * cell_height, columns * cell_width), dtype=numpy.uint8)
+    for idx, glyph in enumerate(cells):
+        place(canvas, glyph, (idx % columns) * cell_width - x0, (idx // columns) * cell_height - y0)
+    return canvas
+
+def glyph_pixels(glyph, box):
+    x0, y0, x1, y1 = box
+    canvas = numpy.zeros((y1 - y0, x1 - x0), dtype=numpy.uint8)
+    if glyph is not None:
+        place(canvas, glyph, -x0, -y0)
+    return canvas
+
+def diff_fonts(old_font, new_font):
+    # One GlyphChange per codepoint in either font that isn't pixel-identical (advances count too).
+    max_height = max(old_font[0], new_font[0])
+    old_glyphs, new_glyphs = old_font[2], new_font[2]
+    changes = []
+    for codepoint in sorted(set(old_glyphs) | set(new_glyphs)):
+        old, new = old_glyphs.get(codepoint), new_glyphs.get(codepoint)
+        box = glyph_box([g for g in (old, new) if g is not None], max_height)
+        changed_pixels = int(numpy.count_nonzero(glyph_pixels(old, box) != glyph_pixels(new, box)))
+        if old is None:
+            changes.append(GlyphChange(codepoint, "added", changed_pixels))
+        elif new is None:
+            changes.append(GlyphChange(codepoint, "removed", changed_pixels))
+        elif changed_pixels or old.advance != new.advance:
+            changes.append(GlyphChange(codepoint, "changed", changed_pixels))
+    return changes
+
+def diff_sheet(old_font, new_font, codepoints, columns=16):
+    # Ink common to both builds is black, pixels that differ are grey.
+    max_height = max(old_font[0], new_font[0])
+    pairs = [(old_font[2].get(cp), new_font[2].get(cp)) for cp in codepoints]
+    x0, y0, x1, y1 = glyph_box([g for pair in pairs for g in pair if g is not None], max_height)
+    cell_width, cell_height = x1 - x0 + 1, y1 - y0 + 1
+    rows = (len(pairs) + columns - 1) // columns
+    canvas = numpy.full((max(rows, 1) * cell_height, columns * cell_width), DIFF_PAPER, dtype=numpy.uint8)
+    for idx, (old, new) in enumerate(pairs):
+        old_pixels, new_pixels = glyph_pixels(old, (x0, y0, x1, y1)), glyph_pixels(new, (x0, y0, x1, y1))
+        cell = numpy.full(old_pixels.shape, DIFF_PAPER, dtype=numpy.uint8)
+        cell[(old_pixels & new_pixels) == 1] = DIFF_INK
+        cell[old_pixels != new_pixels] = DIFF_CHANGED
+        y, x = (idx // columns) * cell_height, (idx % columns) * cell_width
+        canvas[y:y + cell.shape[0], x:x + cell.shape[1]] = cell
+    return canvas
+
+def write_pbm(path, image):
+    with open(path, "wb") as fd:
+        fd.write(("P4\n%d %d\n" % (image.shape[1], image.shape[0])).encode("ascii"))
+        fd.write(numpy.packbits(image, axis=1).tobytes())
+
+def write_pgm(path, image):
+    with open(path, "wb") as fd:
+        fd.write(("P5\n%d %d\n255\n" % (image.shape[1], image.shape[0])).encode("ascii"))
+        fd.write(image.astype(numpy.uint8).tobytes())
+
+def font_pairs(old_path, new_path):
+    # Either two fonts, or two directories of fonts matched up by name.
+    if not os.path.isdir(old_path):
+        return [(os.path.basename(new_path), old_path, new_path)]
+    names = sorted(set(os.path.basename(p) for p in glob.glob(os.path.join(old_path, "*.pfo"))) |
+                   set(os.path.basename(p) for p in glob.glob(os.path.join(new_path, "*.pfo"))))
+    return [(name, os.path.join(old_path, name), os.path.join(new_path, name)) for name in names]
+
+def cmd_diff(args):
+    regressions = 0
+    for name, old_path, new_path in font_pairs(args.old, args.new):
+        if not (os.path.exists(old_path) and os.path.exists(new_path)):
+            print("%s: only in %s" % (name, args.old if os.path.exists(old_path) else args.new))
+            regressions += 1
+            continue
+        old_font, new_font = decode_font(old_path), decode_font(new_path)
+        changes = diff_fonts(old_font, new_font)
+        over = [c for c in changes if c.status != "changed" or c.changed_pixels > args.tolerance]
+        print("%s: %d glyphs, %d changed (%d over tolerance), %d pixels" % (
+            name, len(new_font[2]), len(changes), len(over), sum(c.changed_pixels for c in changes)))
+        for change in over:
+            print("  U+%04X %s: %d pixels" % (change.codepoint, change.status, change.changed_pixels))
+        if args.sheet_dir and changes:
+            if not os.path.exists(args.sheet_dir):
+                os.makedirs(args.sheet_dir)
+            write_pgm(os.path.join(args.sheet_dir, os.path.splitext(name)[0] + ".pgm"),
+                      diff_sheet(old_font, new_font, [c.codepoint for c in changes]))
+        regressions += len(over)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render PFO fonts to images, or diff two builds of them")
+    subparsers = parser.add_subparsers(dest="which")
+    sheet_parser = subparsers.add_parser("sheet", help="Render every glyph of a font into a PBM")
+    sheet_parser.add_argument("pfo")
+    sheet_parser.add_argument("out_pbm")
+    sheet_parser.add_argument("--columns", type=int, default=16)
+    text_parser = subparsers.add_parser("text", help="Render a (UTF-8) string into a PBM")
+    text_parser.add_argument("pfo")
+    text_parser.add_argument("text")
+    text_parser.add_argument("out_pbm")
+    diff_parser = subparsers.add_parser("diff", help="Compare two fonts (or directories of them) pixel by pixel. "
+                                                     "Exits 1 if any glyph changed by more than the tolerance.")
+    diff_parser.add_argument("old")
+    diff_parser.add_argument("new")
+    diff_parser.add_argument("--tolerance", type=int, default=0, help="changed pixels allowed per glyph")
+    diff_parser.add_argument("--sheet-dir", help="write a PGM of the changed glyphs per font here")
+    args = parser.parse_args()
+
+    if args.which == "sheet":
+        write_pbm(args.out_pbm, contact_sheet(decode_font(args.pfo), args.columns))
+    elif args.which == "text":
+        text = args.text if not isinstance(args.text, bytes) else args.text.decode("utf-8")
+        write_pbm(args.out_pbm, render_string(decode_font(args.pfo), text))
+    else:
+        sys.exit(cmd_diff(args))
@@ -0,0 +1,123 @@
+from __future__ import division, print_function
+import argparse
+from collections import Counter, namedtuple
+import io
+import json
+import sys
+import time
+import hb_shaper
+import lut_shaper
+
+# Measures the generated shaper LUTs without a watch: shapes a corpus as the watch would (via lut_shaper.py)
+# with each LUT layout, reporting throughput and the LUT elements read per character.
+# Given the font and the map from text_shaper.py, it also checks the shaped words against HarfBuzz,
+# and that unshaping gives back the original text.
+# (Throughput is the Python port's - only useful to compare layouts. The probe counts are the watch's.)
+
+LayoutResult = namedtuple("LayoutResult", "layout chars seconds probes")
+
+def read_corpus(corpus_paths):
+    lines = []
+    for corpus_path in corpus_paths:
+        with io.open(corpus_path, "r", encoding="utf-8") as fd:
+            lines += [line.rstrip("\n") for line in fd if line.strip()]
+    return lines
+
+def bench_layout(lut, lines, layout, repeat):
+    codept_lines = [[ord(c) for c in line] for line in lines]
+    start = time.time()
+    for _ in range(repeat):
+        for codepts in codept_lines:
+            lut_shaper.shape(lut, codepts, layout)
+    seconds = (time.time() - start) / repeat
+    # Counted separately, so the counting isn't timed.
+    probes = Counter()
+    for codepts in codept_lines:
+        lut_shaper.shape(lut, codepts, layout, probes)
+    return LayoutResult(layout, sum(len(codepts) for codepts in codept_lines), seconds, probes)
+
+def shapable_words(lut, line):
+    # Runs of letters the LUT shapes (and the zero-width marks between them, which don't break a join).
+    letters = set(entry.true_codept for entry in lut.entries)
+    letters.update(cp for cp in lut.ligatures if not cp & lut_shaper.LIG_REPLACEMENT_CODEPT_MASK)
+    words = []
+    word = []
+    for c in line + u" ":
+        if ord(c) in letters or (word and lut_shaper.is_zero_width(lut, ord(c))):
+            word.append(c)
+        elif word:
+            words.append(u"".join(word))
+            word = []
+    return words
+
+def check_against_harfbuzz(lut, lines, shaper, shaper_map):
+    # Returns [(word, LUT glyphs, HarfBuzz glyphs)] for the words that shape differently.
+    words = sorted(set(word for line in lines for word in shapable_words(lut, line)))
+    # The runtime drops the zero-width marks - so leave them out of HarfBuzz's input too.
+    hb_texts = [u"".join(c for c in word if not lut_shaper.is_zero_width(lut, ord(c))) for word in words]
+    mismatches = []
+    for word, hb_glyphs in zip(words, shaper.shape(hb_texts)):
+        shaped = lut_shaper.shape(lut, [ord(c) for c in word])
+        lut_glyphs = [shaper_map.get(cp) for cp in shaped if not lut_shaper.is_zero_width(lut, cp)]
+        # HarfBuzz gives glyphs in visual order - right to left.
+        hb_glyphs = [glyph["g"] for glyph in reversed(hb_glyphs)]
+        if lut_glyphs != hb_glyphs:
+            mismatches.append((word, lut_glyphs, hb_glyphs))
+    return mismatches, len(words)
+
+def check_unshape(lut, lines):
+    # Returns the lines that don't survive being shaped and unshaped.
+    failures = []
+    for line in lines:
+        codepts = [ord(c) for c in line]
+        if lut_shaper.unshape(lut, lut_shaper.shape(lut, codepts)) != codepts:
+            failures.append(line)
+    return failures
+
+def print_results(results):
+    tables = sorted(set(table for result in results for table in result.probes))
+    print("%-8s %12s" % ("layout", "chars/sec") + "".join(" %14s" % ("%s/char" % table) for table in tables))
+    for result in results:
+        print("%-8s %12.0f" % (result.layout, result.chars / result.seconds if result.seconds else 0) +
+              "".join(" %14.3f" % (result.probes[table] / result.chars) for table in tables))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark and check the generated shaper LUTs against a corpus")
+    parser.add_argument("code_dir", help="directory with the generated text_shaper_lut.c/.h, codept_props.c/.h and font_ranges.h")
+    parser.add_argument("corpus", nargs="+", help="UTF-8 text files, one message per line")
+    parser.add_argument("--layout", action="append", choices=lut_shaper.SHAPER_LAYOUTS,
+                        help="LUT layout to benchmark (default: every one this build has)")
+    parser.add_argument("--repeat", type=int, default=1, help="shape the corpus this many times per layout")
+    parser.add_argument("--font", help="the font text_shaper.py shaped with - to check against HarfBuzz")
+    parser.add_argument("--shaper-map", help="codept->glyph map written by text_shaper.py (needed with --font)")
+    parser.add_argument("--shaper-backend", choices=hb_shaper.SHAPER_BACKENDS, default="auto")
+    parser.add_argument("--harfbuzz-lib", help="path to libharfbuzz (default: search the library path)")
+    parser.add_argument("--show", type=int, default=10, help="list this many of the words that differ")
+    args = parser.parse_args()
+
+    lut = lut_shaper.load_lut(args.code_dir)
+    lines = read_corpus(args.corpus)
+    layouts = args.layout or [layout for layout in lut_shaper.SHAPER_LAYOUTS
+                              if layout != lut_shaper.LAYOUT_INDEXED or lut.index is not None]
+    print_results([bench_layout(lut, lines, layout, args.repeat) for layout in layouts])
+
+    failed = False
+    if lut.unshape_lut is not None:
+        unshape_failures = check_unshape(lut, lines)
+        print("Unshaping: %d of %d lines differ from the original" % (len(unshape_failures), len(lines)))
+        for line in unshape_failures[:args.show]:
+            print("  %s" % line)
+        failed = failed or bool(unshape_failures)
+
+    if args.font:
+        assert args.shaper_map, "--font needs --shaper-map"
+        shaper_map = {int(k): v for k, v in json.load(open(args.shaper_map, "r")).items()}
+        shaper = hb_shaper.open_shaper(args.font, args.shaper_backend, args.harfbuzz_lib)
+        mismatches, word_count = check_against_harfbuzz(lut, lines, shaper, shaper_map)
+        shaper.close()
+        print("HarfBuzz: %d of %d distinct words shape differently" % (len(mismatches), word_count))
+        for word, lut_glyphs, hb_glyphs in mismatches[:args.show]:
+            print("  %s: LUT %s, HarfBuzz %s" % (word, lut_glyphs, hb_glyphs))
+        failed = failed or bool(mismatches)
+
+    sys.exit(1 if failed else 0)
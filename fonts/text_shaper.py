@@ -1,29 +1,49 @@
 from itertools import chain
-import subprocess
+import argparse
+import hashlib
+import shutil
+import tempfile
 import json
 import struct
 import sys
 import os
 import unicodedata
+import codept_props
+import hb_shaper
 
 # This file generates the code that drives the Arabic text shaper SM.
 # It also generates the glyph-codepoint mapping used to produce the Arabic fonts.
-# It requires the hb-shape CLI tool.
+# It requires HarfBuzz - libharfbuzz, or else the hb-shape CLI tool (see hb_shaper.py).
 # NB when generating multiple fonts for the same firmware image, they must have the same glyph mapping.
 #  It would be possible to force this - but at time of writing I'm planning on using the same family everywhere.
 #  So it's not a problem.
+# Every string is shaped in one batch, and with --cache-dir the outputs are kept, keyed by everything
+# that goes into them - see shaper_cache_key.
 
-if len(sys.argv) < 6:
-    print("text_shaper.py font.ttf subset map_out.json labels_out.json code_out_dir/")
-    sys.exit(0)
+parser = argparse.ArgumentParser(description="Generate the Arabic text shaper LUTs and font glyph map")
+parser.add_argument("font_path", metavar="font.ttf")
+parser.add_argument("subset_key", metavar="subset")
+parser.add_argument("map_path", metavar="map_out.json")
+parser.add_argument("labels_path", metavar="labels_out.json")
+parser.add_argument("codegen_path", metavar="code_out_dir/")
+parser.add_argument("--cache-dir", help="directory to keep (and reuse) shaper outputs in")
+parser.add_argument("--shaper-backend", choices=hb_shaper.SHAPER_BACKENDS, default="auto",
+                    help="shape in-process with libharfbuzz, or with one hb-shape run (default: libharfbuzz if found)")
+parser.add_argument("--harfbuzz-lib", help="path to libharfbuzz (default: search the library path)")
+parser.add_argument("--ligatures", metavar="ligatures.json",
+                    help="JSON list of the ligatures to form - strings of any length (default: lam-alef)")
+parser.add_argument("--index-budget", type=int, default=512,
+                    help="most bytes to spend on the directly-indexed LUT (built with -DARABIC_SHAPER_INDEXED)")
+args = parser.parse_args()
 
-font_path = sys.argv[1]
-subset_key = sys.argv[2]
-map_path = sys.argv[3]
-labels_path = sys.argv[4]
-codegen_path = sys.argv[5]
+font_path = args.font_path
+subset_key = args.subset_key
+map_path = args.map_path
+labels_path = args.labels_path
+codegen_path = args.codegen_path
 
-scratch_codepoint_ranges = ((0x700, 0x750), (0x780, 0x7FF + 1))
+scratch_codepoint_ranges = codept_props.SCRATCH_CODEPOINT_RANGES
+arabic_block = (0x600, 0x700)
 
 kashida = "ـ"
 
@@ -37,12 +57,27 @@ for ch in shaped_alphabet:
 
 supplemental_alphabet = "١٢٣٤٥٦٧٨٩٠؟؛،"
 ligatures = ["لا"]
+if args.ligatures:
+    with open(args.ligatures, "r", encoding="utf-8") as ligatures_fd:
+        ligatures = json.load(ligatures_fd)
+for lig in ligatures:
+    assert len(lig) >= 2, "Ligature %s is a single character" % lig
+    for ch in lig:
+        assert len(ch.encode("utf-8")) == 2, "Ligature member %s (%x) not encoded in 2 bytes" % (ch, ord(ch))
+
+shaper = hb_shaper.open_shaper(font_path, args.shaper_backend, args.harfbuzz_lib)
+shaped_texts = {}
+def shape_texts(texts):
+    # Shapes (in one batch) any of the strings not shaped already.
+    pending = sorted(set(txt for txt in texts if txt not in shaped_texts))
+    for txt, glyphs in zip(pending, shaper.shape(pending)):
+        shaped_texts[txt] = glyphs
 
 missing_glyph = None
 def shape_text(txt):
-    process = subprocess.Popen(['hb-shape', font_path, '--output-format=json', '--no-glyph-names'], stdout=subprocess.PIPE, stdin=subprocess.PIPE)
-    out, err = process.communicate(txt.encode("utf-8"))
-    glyphs = list(json.loads(out.decode("utf-8")))
+    if txt not in shaped_texts:
+        shape_texts([txt])
+    glyphs = shaped_texts[txt]
     # Check for missing glyphs
     missing_chars = set()
     for glyph in glyphs:
@@ -54,31 +89,35 @@ def shape_text(txt):
         raise Exception("The following characters are missing from the font: %s (%s)" % (missing_chars, [hex(ord(x)) for x in missing_chars]))
     return glyphs
 
-missing_glyph = shape_text("ᓄ")[0]["g"]
-kashida_glyph = shape_text(kashida)[0]["g"]
+def form_texts(ch):
+    # Isolated, initial, medial and final forms - the kashida forces the joins.
+    return [ch, ch + kashida, kashida + ch + kashida, kashida + ch]
 
 def generate_forms(alphabet, ligatures):
     forms = {}
     for ch in [ch for ch in alphabet] + ligatures:
-        ch_comps = [ch, ch + kashida, kashida + ch + kashida, kashida + ch]
         ch_forms = []
-        for ch_comp in ch_comps:
+        for ch_comp in form_texts(ch):
             if ch == kashida:
                 target_glyph = kashida_glyph
             else:
                 shaped = shape_text(ch_comp)
                 target_glyphs = [x for x in shaped if x["g"] != kashida_glyph]
-                assert len(target_glyphs) == 1
+                assert len(target_glyphs) == 1, "%r doesn't shape to a single glyph in this font" % ch_comp
                 target_glyph = target_glyphs[0]["g"]
             ch_forms.append(target_glyph)
         forms[ch] = ch_forms
     return forms
 
+SHAPER_LUT_ENTRY_SIZE = struct.calcsize("<HHbbb")
+LIG_REPLACEMENT_CODEPT_MASK = 1 << 15
+
 def pack_lut(forms):
     # LUT is simply repeated <true codept, isolated codept, initialDelta, medialDelta, finalDelta>
     # The runtime automatically detects characters like alef that restart the SM.
     # Ligatures are assigned their own "true" codepoints.
     # The ligature table is of form <prefixn>,...,<prefix0>,<replacement> (where replacement has its MSB set)
+    # - unshaping expands ligatures from it; shaping matches them with the trie built from it (see compile_ligature_trie).
     # We recycle some of the dustier blocks in the 2-byte UTF8 range.
     available_codepts = chain(*(range(*p) for p in scratch_codepoint_ranges))
     selected_glyphs = {}
@@ -92,13 +131,12 @@ def pack_lut(forms):
             true_codept = ord(ch)
             label_base = unicodedata.name(ch)
         else:
-            assert len(ch) <= 2, "Ligature handling supports 2-char patterns only"
             # A ligature - also update the ligature table.
             true_codept = next(available_codepts)
             dirtied_codepts.append(true_codept)
             for c in ch:
                 lig_data += struct.pack("<H", ord(c))
-            lig_data += struct.pack("<H", true_codept | (1 << 15))
+            lig_data += struct.pack("<H", true_codept | LIG_REPLACEMENT_CODEPT_MASK)
             label_base = "LIG-%s" % ch
         line_parts = [true_codept]
         base_transformed_codept = None
@@ -131,35 +169,256 @@ def supplement_selected_glyphs(selected_glyphs, alphabet):
         glyph = shape_text(ch)[0]["g"]
         selected_glyphs[glyph] = ord(ch)
 
+def build_lut_index(lut_data):
+    # A byte per codepoint across the span of letters in the Arabic block: 1 + their LUT entry, or 0.
+    # Entries outside the span (the ligatures) are listed separately, to be scanned for.
+    true_codepts = [struct.unpack_from("<H", lut_data, off)[0] for off in range(0, len(lut_data), SHAPER_LUT_ENTRY_SIZE)]
+    assert len(true_codepts) < 0xff, "Too many LUT entries to index with bytes"
+    block_codepts = [cp for cp in true_codepts if arabic_block[0] <= cp < arabic_block[1]]
+    if not block_codepts:
+        return arabic_block[0], [], list(range(len(true_codepts)))
+    base = min(block_codepts)
+    index = [0] * (max(block_codepts) - base + 1)
+    exceptions = []
+    for entry_idx, cp in enumerate(true_codepts):
+        if cp in block_codepts:
+            index[cp - base] = entry_idx + 1
+        else:
+            exceptions.append(entry_idx)
+    return base, index, exceptions
+
+def ligature_patterns(lig_data):
+    # {pattern (tuple of codepts): (ligature codept, pattern start in the ligature table)}
+    patterns = {}
+    pattern = []
+    for idx, value in enumerate(struct.unpack("<%dH" % (len(lig_data) // 2), lig_data)):
+        if value & LIG_REPLACEMENT_CODEPT_MASK:
+            patterns[tuple(pattern)] = (value & ~LIG_REPLACEMENT_CODEPT_MASK, idx - len(pattern))
+            pattern = []
+        else:
+            pattern.append(value)
+    return patterns
+
+def build_unshape_lut(lut_data, lig_data, shapable_ranges):
+    # The inverse of the shaper LUT: for each codept in the shapable ranges (laid end to end), the true codept
+    # it was shaped from - or, for ligatures, the start of its pattern in the ligature LUT, with the MSB set.
+    # 0 where nothing was shaped to that codept. Where several entries share a form, the first one wins, as in a scan.
+    range_offsets = {}
+    unshape_lut = []
+    for start, end in shapable_ranges:
+        range_offsets[start] = len(unshape_lut)
+        unshape_lut += [0] * (end - start + 1)
+    def unshape_index(codept):
+        start = max(r[0] for r in shapable_ranges if r[0] <= codept)
+        return range_offsets[start] + codept - start
+
+    pattern_starts = dict(ligature_patterns(lig_data).values())
+
+    for off in range(0, len(lut_data), SHAPER_LUT_ENTRY_SIZE):
+        true_codept, isolated_codept, initial_delta, medial_delta, final_delta = struct.unpack_from("<HHbbb", lut_data, off)
+        if true_codept in pattern_starts:
+            unshaped = pattern_starts[true_codept] | LIG_REPLACEMENT_CODEPT_MASK
+        else:
+            unshaped = true_codept
+        for delta in (0, initial_delta, medial_delta, final_delta):
+            idx = unshape_index(isolated_codept + delta)
+            if not unshape_lut[idx]:
+                unshape_lut[idx] = unshaped
+    return unshape_lut
+
+def compile_ligature_trie(lig_data):
+    # Ligatures are matched by walking a trie of their patterns, so the cost at each character is flat however
+    # many there are. Returns (roots base, roots, trie):
+    #  roots: for each codept from the base, 1 + the offset of the trie node reached by it, or 0 if no ligature
+    #         starts with it.
+    #  trie:  nodes of <ligature codept or 0>, <child count n>, n * (<codept>, <1 + child node offset>)
+    #         - all uint16, children sorted by codept.
+    tree = {}
+    for pattern, (lig_codept, _) in ligature_patterns(lig_data).items():
+        node = tree
+        for codept in pattern:
+            node = node.setdefault(codept, {})
+        node[None] = lig_codept
+    trie = []
+    def add_node(node):
+        children = sorted(codept for codept in node if codept is not None)
+        offset = len(trie)
+        trie.extend([node.get(None, 0), len(children)] + [0, 0] * len(children))
+        for idx, codept in enumerate(children):
+            trie[offset + 2 + 2 * idx] = codept
+            trie[offset + 3 + 2 * idx] = add_node(node[codept])
+        return offset + 1
+    if not tree:
+        return 0, [0], [0]
+    roots_base = min(tree)
+    roots = [0] * (max(tree) - roots_base + 1)
+    for codept in sorted(tree):
+        roots[codept - roots_base] = add_node(tree[codept])
+    assert len(trie) < 0xffff, "Ligature trie too large"
+    return roots_base, roots, trie
+
+# The accessor for the trie above - generated alongside it, so the two can't drift apart.
+FIND_LIGATURE_C = """
+uint16_t find_ligature(char *text, char **last_rune) {
+  char *ptr = text;
+  uint16_t codept = read_utf8(&ptr);
+  if (!RANGE(codept, ARABIC_LIGATURE_ROOTS_BASE, ARABIC_LIGATURE_ROOTS_BASE + ARABIC_LIGATURE_ROOTS_SIZE)) {
+    return 0;
+  }
+  uint16_t node = ARABIC_LIGATURE_ROOTS[codept - ARABIC_LIGATURE_ROOTS_BASE];
+  uint16_t ligature = 0;
+  while (node && *ptr) {
+    const uint16_t *trie_node = &ARABIC_LIGATURE_TRIE[node - 1];
+    char *rune = ptr;
+    codept = read_utf8(&ptr);
+    node = 0;
+    for (int i = 0; i < trie_node[1]; ++i) {
+      if (trie_node[2 + 2 * i] == codept) {
+        node = trie_node[3 + 2 * i];
+        break;
+      }
+    }
+    if (node && ARABIC_LIGATURE_TRIE[node - 1]) {
+      // Keep going - a longer ligature wins.
+      ligature = ARABIC_LIGATURE_TRIE[node - 1];
+      *last_rune = rune;
+    }
+  }
+  return ligature;
+}
+"""
+
 def write_lut(lut_data, lig_data, shapable_ranges, out_dir):
     lut_h = open(os.path.join(out_dir, "text_shaper_lut.h"), "w")
     lut_h.write("#include \"pebble.h\"\n#include \"range.h\"\n// THIS FILE IS AUTOMATICALLY GENERATED\n\n")
     lut_c = open(os.path.join(out_dir, "text_shaper_lut.c"), "w")
-    lut_c.write("#include \"text_shaper_lut.h\"\n// THIS FILE IS AUTOMATICALLY GENERATED\n\n")
+    lut_c.write("#include \"text_shaper_lut.h\"\n#include \"utf8.h\"\n// THIS FILE IS AUTOMATICALLY GENERATED\n\n")
     def write_array(datatype, name, elements):
         lut_h.write("extern %s %s[];\n" % (datatype, name))
         lut_h.write("#define %s_SIZE %d\n" % (name, len(elements)))
         lut_c.write("%s %s[] = {%s};\n" % (datatype, name, ", ".join("0x%x" % x for x in elements)))
     def write_define(name, value):
         lut_h.write("#define %s %s\n" % (name, value))
-    # This isn't a real lookup table, since you can't index directly into it.
-    # For shame - but doing so would double the memory footprint in exchange for saving a relatively small loop?
+    def write_guard(line):
+        lut_h.write(line + "\n")
+        lut_c.write(line + "\n")
+    # This isn't a real lookup table, since you can't index directly into it - it's scanned.
+    # Platforms that can spare the flash (see patch.py) build with ARABIC_SHAPER_INDEXED, which adds an index.
     write_array("const uint8_t", "ARABIC_SHAPER_LUT", lut_data)
+    index_base, index, exceptions = build_lut_index(lut_data)
+    index_bytes = len(index) + len(exceptions)
+    print("ARABIC_SHAPER_LUT: %d bytes, scanned (%d entries)" % (len(lut_data), len(lut_data) // SHAPER_LUT_ENTRY_SIZE))
+    if index_bytes <= args.index_budget:
+        print("ARABIC_SHAPER_INDEX: +%d bytes, direct (U+%04X-U+%04X, %d entries scanned)" % (
+            index_bytes, index_base, index_base + len(index) - 1, len(exceptions)))
+        write_guard("#ifdef ARABIC_SHAPER_INDEXED")
+        write_array("const uint8_t", "ARABIC_SHAPER_INDEX", index)
+        write_define("ARABIC_SHAPER_INDEX_BASE", "0x%x" % index_base)
+        write_array("const uint8_t", "ARABIC_SHAPER_EXCEPTIONS", exceptions)
+        write_guard("#endif")
+    else:
+        print("ARABIC_SHAPER_INDEX: +%d bytes - over the %d byte budget, not generated" % (index_bytes, args.index_budget))
+    roots_base, roots, trie = compile_ligature_trie(lig_data)
+    print("ARABIC_LIGATURE_TRIE: %d bytes (%d ligatures, roots from U+%04X)" % (
+        (len(roots) + len(trie)) * 2, len(ligature_patterns(lig_data)), roots_base))
+    write_array("const uint16_t", "ARABIC_LIGATURE_ROOTS", roots)
+    write_define("ARABIC_LIGATURE_ROOTS_BASE", "0x%x" % roots_base)
+    write_array("const uint16_t", "ARABIC_LIGATURE_TRIE", trie)
+    # Returns the longest ligature starting at text (or 0), and points last_rune at its last character.
+    lut_h.write("uint16_t find_ligature(char *text, char **last_rune);\n")
+    lut_c.write(FIND_LIGATURE_C)
+    write_guard("#ifdef TEXT_UNSHAPE")
     write_array("const uint8_t", "ARABIC_LIGATURE_LUT", lig_data)
-    write_define("ARABIC_SHAPER_RANGE(cp)", "(%s)" % " || ".join("RANGE(cp, %d, %d)" % (r[0], r[1] + 1) for r in shapable_ranges))
-
-# Get the glyph indices corresponding to the forms of the various letters.
-character_forms = generate_forms(shaped_alphabet, ligatures)
-# Build the LUT
-# This also assigns codepoints to the glyph within the defined ranges
-lut_data, lig_data, selected_glyphs, labels, dirtied_codepts = pack_lut(character_forms)
-shapable_ranges = contiguous_ranges(dirtied_codepts)
-# Add un-shaped codepoints to the font.
-supplement_selected_glyphs(selected_glyphs, supplemental_alphabet)
-# Write the LUTs.
-write_lut(lut_data, lig_data, shapable_ranges, codegen_path)
-
-# Write misc data files used as input to fontgen.
-selected_codepts = {v: k for k, v in selected_glyphs.items()}
-json.dump(selected_codepts, open(map_path, "w"))
-json.dump(labels, open(labels_path, "w"))
+    write_guard("#endif")
+    unshape_lut = build_unshape_lut(lut_data, lig_data, shapable_ranges)
+    print("ARABIC_UNSHAPE_LUT: %d bytes, direct" % (len(unshape_lut) * 2))
+    write_guard("#ifdef TEXT_UNSHAPE")
+    write_array("const uint16_t", "ARABIC_UNSHAPE_LUT", unshape_lut)
+    # Only valid for CODEPT_SHAPED codepts (see codept_props.py).
+    unshape_index = "(cp) - %d" % shapable_ranges[-1][0]
+    offset = sum(r[1] - r[0] + 1 for r in shapable_ranges[:-1])
+    if offset:
+        unshape_index += " + %d" % offset
+    for idx in reversed(range(len(shapable_ranges) - 1)):
+        offset = sum(r[1] - r[0] + 1 for r in shapable_ranges[:idx])
+        unshape_index = "(cp) <= %d ? (cp) - %d%s : %s" % (shapable_ranges[idx][1], shapable_ranges[idx][0],
+                                                          " + %d" % offset if offset else "", unshape_index)
+    write_define("ARABIC_UNSHAPE_INDEX(cp)", "(%s)" % unshape_index)
+    write_guard("#endif")
+    lut_h.close()
+    lut_c.close()
+
+CODEGEN_FILES = ("text_shaper_lut.c", "text_shaper_lut.h", "codept_props.c", "codept_props.h")
+
+def shaper_cache_key():
+    key = hashlib.sha1()
+    key.update(open(font_path, "rb").read())
+    key.update(open(os.path.realpath(__file__), "rb").read())
+    key.update(open(hb_shaper.__file__, "rb").read())
+    key.update(open(codept_props.__file__, "rb").read())
+    key.update(shaper.version().encode("utf-8"))
+    key.update(json.dumps([shaped_alphabet, supplemental_alphabet, ligatures, scratch_codepoint_ranges,
+                           args.index_budget]).encode("utf-8"))
+    return key.hexdigest()
+
+def cache_outputs():
+    # (cached name, output path) for everything we produce.
+    return [("map.json", map_path), ("labels.json", labels_path)] + \
+           [(name, os.path.join(codegen_path, name)) for name in CODEGEN_FILES]
+
+def load_cached(entry_dir):
+    if not os.path.isdir(entry_dir):
+        return False
+    for cached_name, out_path in cache_outputs():
+        shutil.copyfile(os.path.join(entry_dir, cached_name), out_path)
+    return True
+
+def store_cached(entry_dir):
+    # Fill a scratch directory, then move it into place - so concurrent builds never see half an entry.
+    if not os.path.exists(args.cache_dir):
+        os.makedirs(args.cache_dir)
+    scratch_dir = tempfile.mkdtemp(dir=args.cache_dir)
+    for cached_name, out_path in cache_outputs():
+        shutil.copyfile(out_path, os.path.join(scratch_dir, cached_name))
+    try:
+        os.rename(scratch_dir, entry_dir)
+    except OSError:
+        # Someone else got there first.
+        shutil.rmtree(scratch_dir)
+
+cache_entry_dir = None
+# The shaper's version is part of the cache key - so it's open, and needs closing, even on a cache hit.
+try:
+    if args.cache_dir:
+        cache_entry_dir = os.path.join(args.cache_dir, shaper_cache_key())
+        if load_cached(cache_entry_dir):
+            sys.exit(0)
+
+    shape_texts(["ᓄ", kashida] + list(chain(*(form_texts(ch) for ch in list(shaped_alphabet) + ligatures))) +
+                list(supplemental_alphabet))
+    missing_glyph = shape_text("ᓄ")[0]["g"]
+    kashida_glyph = shape_text(kashida)[0]["g"]
+
+    # Get the glyph indices corresponding to the forms of the various letters.
+    character_forms = generate_forms(shaped_alphabet, ligatures)
+    # Build the LUT
+    # This also assigns codepoints to the glyph within the defined ranges
+    lut_data, lig_data, selected_glyphs, labels, dirtied_codepts = pack_lut(character_forms)
+    shapable_ranges = list(contiguous_ranges(dirtied_codepts))
+    # Add un-shaped codepoints to the font.
+    supplement_selected_glyphs(selected_glyphs, supplemental_alphabet)
+    # Write the LUTs - and the codept property table, which marks the codepts we shape into.
+    write_lut(lut_data, lig_data, shapable_ranges, codegen_path)
+    codept_props.write_props([(start, end + 1) for start, end in shapable_ranges], codegen_path)
+
+    # Write misc data files used as input to fontgen.
+    selected_codepts = {v: k for k, v in selected_glyphs.items()}
+    with open(map_path, "w") as map_fd:
+        json.dump(selected_codepts, map_fd)
+    with open(labels_path, "w") as labels_fd:
+        json.dump(labels, labels_fd)
+finally:
+    shaper.close()
+
+if cache_entry_dir:
+    store_cached(cache_entry_dir)
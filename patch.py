@@ -10,6 +10,12 @@ PLATFORM_UNSHAPE_MAP = {
 }
 
 TEXT_UNSHAPE = PLATFORM_UNSHAPE_MAP.get(platform, True)
+# Whether to look Arabic letters up in the shaper LUT directly, rather than scanning it.
+# The index costs flash (text_shaper.py reports how much) - aplite can't spare it.
+PLATFORM_SHAPER_INDEX_MAP = {
+    "aplite": False
+}
+SHAPER_INDEXED = PLATFORM_SHAPER_INDEX_MAP.get(platform, True)
 
 p = Patcher(
     platform=platform,
@@ -22,10 +28,10 @@ p = Patcher(
         "runtime/text_shaper_lut.c",
         "runtime/utf8.c",
         "runtime/rtl.c",
-        "runtime/rtl_ranges.c",
-        "runtime/font_ranges.c"
+        "runtime/codept_props.c"
     ],
-    cflags=["-DTEXT_UNSHAPE"] if TEXT_UNSHAPE else []
+    cflags=(["-DTEXT_UNSHAPE"] if TEXT_UNSHAPE else []) + (["-DARABIC_SHAPER_INDEXED"] if SHAPER_INDEXED else []),
+    cache_dir="cache/patcher"
 )
 
 gdt_match = p.match_symbol("graphics_draw_text")
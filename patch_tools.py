@@ -1,6 +1,11 @@
+import hashlib
+import mmap
+import os
 import re
+import shutil
 import struct
 import subprocess
+import tempfile
 from collections import namedtuple
 
 PatchOverwrite = namedtuple("PatchOverwrite", "address content")
@@ -14,8 +19,97 @@ CallsiteValue = namedtuple("CallsiteValue", "register")
 CallsiteValue.__new__.__defaults__ = (None,) * len(CallsiteValue._fields)
 CallsiteSP = namedtuple("CallsiteSP", "")
 
+OBJDUMP_ARGS = ["-b", "binary", "-marm", "-Mforce-thumb", "-D"]
+# Bump when the listing or instruction table format changes, to invalidate cached disassemblies.
+DEASM_CACHE_VERSION = 2
+INSN_INDEX_ITEM = struct.Struct("<IIB")
+
+def map_file(path):
+    with open(path, "rb") as fd:
+        return mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+def normalize_deasm(text):
+    # What patterns are written against.
+    return text.replace("\t", " ").replace("fp", "r11").replace("sl", "r10")
+
+class InstructionTable:
+    # The disassembly, one entry per instruction in address order: (address, offset of its text, size) items,
+    # and the texts - "mnemonic operands", normalized as target.d is - newline-separated in one buffer.
+    # Both are read in place (from memory, or mmap'd from the cache), so nothing is parsed at startup,
+    # and patterns run over the text without copying it.
+    def __init__(self, index_buf, text):
+        self.index_buf = index_buf
+        self.text = text
+        self.count = len(index_buf) // INSN_INDEX_ITEM.size
+
+    @staticmethod
+    def pack(instructions):
+        # [(address, size, text)] in address order -> (index_buf, text).
+        index = []
+        offset = 0
+        for address, size, text in instructions:
+            index.append(INSN_INDEX_ITEM.pack(address, offset, size))
+            offset += len(text) + 1
+        return b"".join(index), "\n".join(text for _, _, text in instructions)
+
+    def __len__(self):
+        return self.count
+
+    def _item(self, idx):
+        return INSN_INDEX_ITEM.unpack_from(self.index_buf, idx * INSN_INDEX_ITEM.size)
+
+    def address(self, idx):
+        return self._item(idx)[0]
+
+    def size(self, idx):
+        return self._item(idx)[2]
+
+    def contiguous(self, idx):
+        # Whether the next instruction directly follows this one - objdump elides runs of zeros ("...").
+        return idx + 1 < self.count and self.address(idx) + self.size(idx) == self.address(idx + 1)
+
+    def span(self, idx):
+        # [start, end) of the instruction's text.
+        start = self._item(idx)[1]
+        end = self._item(idx + 1)[1] - 1 if idx + 1 < self.count else len(self.text)
+        return start, end
+
+    def mnemonic(self, idx):
+        start, end = self.span(idx)
+        return self.text[start:end].split(" ", 1)[0]
+
+    def operands(self, idx):
+        start, end = self.span(idx)
+        parts = self.text[start:end].split(" ", 1)
+        return parts[1] if len(parts) > 1 else ""
+
+    def _bisect(self, field, value):
+        # The first instruction whose address (field 0) or text offset (field 1) is >= value.
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._item(mid)[field] < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, address, forward=None):
+        # The index of the instruction at address - failing that, of the next one (forward) or the previous one.
+        # None if there's none at address and no direction is given.
+        idx = self._bisect(0, address)
+        if idx < self.count and self.address(idx) == address:
+            return idx
+        if forward is None:
+            return None
+        return idx if forward else max(idx - 1, 0)
+
+    def at_offset(self, offset):
+        # The index of the instruction whose text contains offset.
+        return self._bisect(1, offset + 1) - 1
+
 class Patcher:
-    def __init__(self, platform, target_bin_path, libpebble_a_path, patch_c_path, other_c_paths, cflags=[]):
+    def __init__(self, platform, target_bin_path, libpebble_a_path, patch_c_path, other_c_paths, cflags=[], cache_dir=None):
         self.platform = platform
         self.target_bin_path = target_bin_path
         self.patch_c_path = patch_c_path
@@ -23,12 +117,7 @@ class Patcher:
         self.other_c_paths = other_c_paths
 
         self.target_bin = open(target_bin_path, "rb").read()
-        self.target_deasm = subprocess.check_output(["arm-none-eabi-objdump", "-b", "binary", "-marm", "-Mforce-thumb", "-D", target_bin_path])
-        self.target_deasm = self.target_deasm.replace("\t", " ").replace("fp", "r11").replace("sl", "r10")
-        open("target.d", "w").write(self.target_deasm)
-        self.target_deasm_index = {}
-        for addr_match in re.finditer("$\s+([a-f0-9]+):", self.target_deasm, re.MULTILINE):
-            self.target_deasm_index[int(addr_match.group(1), 16)] = addr_match.start()
+        self.target_insns = self._load_deasm(cache_dir)
 
         self.target = "emulator" if "qemu" in self.target_bin_path else "hardware"
         if self.target == "hardware":
@@ -58,6 +147,54 @@ class Patcher:
 
         self.op_queue = []
 
+    def _disassemble(self):
+        # Returns the listing (normalized for reading alongside patterns), and the instruction table's buffers.
+        target_deasm = subprocess.check_output(["arm-none-eabi-objdump"] + OBJDUMP_ARGS + [self.target_bin_path])
+        instructions = []
+        for line in target_deasm.splitlines():
+            # "   8:\tf8d3 3004 \tldr.w\tr3, [r3, #4]"
+            fields = line.split("\t")
+            addr_match = re.match(r"\s*([a-f0-9]+):$", fields[0])
+            if addr_match and len(fields) > 1:
+                instructions.append((int(addr_match.group(1), 16), len(fields[1].replace(" ", "")) // 2,
+                                     normalize_deasm(" ".join(fields[2:]))))
+        return normalize_deasm(target_deasm), InstructionTable.pack(instructions)
+
+    def _deasm_cache_key(self):
+        key = hashlib.sha1()
+        key.update(self.target_bin)
+        key.update(subprocess.check_output(["arm-none-eabi-objdump", "--version"]))
+        key.update(" ".join(OBJDUMP_ARGS + [str(DEASM_CACHE_VERSION)]))
+        return key.hexdigest()
+
+    def _load_deasm(self, cache_dir):
+        # Disassembles the target, leaving the listing in target.d.
+        # With a cache_dir, the listing and instruction table are kept there - keyed by the firmware and objdump - and
+        # the table is mmap'd straight back on later runs (target.d is copied out of the entry).
+        if not cache_dir:
+            target_deasm, (insn_index, insn_text) = self._disassemble()
+            open("target.d", "w").write(target_deasm)
+            return InstructionTable(insn_index, insn_text)
+
+        entry_dir = os.path.join(cache_dir, self._deasm_cache_key())
+        if not os.path.isdir(entry_dir):
+            target_deasm, (insn_index, insn_text) = self._disassemble()
+            # Fill a scratch directory, then move it into place - so concurrent builds never see half an entry.
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            scratch_dir = tempfile.mkdtemp(dir=cache_dir)
+            open(os.path.join(scratch_dir, "target.d"), "wb").write(target_deasm)
+            open(os.path.join(scratch_dir, "target.insns"), "wb").write(insn_text)
+            open(os.path.join(scratch_dir, "target.insns.index"), "wb").write(insn_index)
+            try:
+                os.rename(scratch_dir, entry_dir)
+            except OSError:
+                # Someone else got there first.
+                shutil.rmtree(scratch_dir)
+        shutil.copyfile(os.path.join(entry_dir, "target.d"), "target.d")
+        return InstructionTable(map_file(os.path.join(entry_dir, "target.insns.index")),
+                                map_file(os.path.join(entry_dir, "target.insns")))
+
     def _build_symbol_table(self, libpebble_a_path):
         libpebble_deasm = subprocess.check_output(["arm-none-eabi-objdump", "-d", libpebble_a_path])
         # All pebble SDK calls are indirected via a jump table baked into the firmware.
@@ -89,20 +226,9 @@ class Patcher:
 
     def addr_step(self, addr, step):
         addr += step
-        while True:
-            try:
-                self.target_deasm_index[addr]
-                return addr
-            except KeyError:
-                addr += step
-
-    def _deasm_index(self, addr, forward):
-        while True:
-            try:
-                return self.target_deasm_index[addr]
-            except KeyError:
-                assert forward is not None
-                addr += 1 if forward else -1
+        while self.target_insns.find(addr) is None:
+            addr += step
+        return addr
 
     def _q(self, op):
         self.op_queue.append(op)
@@ -118,21 +244,46 @@ class Patcher:
             elif line.strip():
                 filtered_pattern_lines.append(line.strip())
 
-        pattern_composed = "\n".join((r"^\s*(?P<addr_%d>[a-f0-9]+):\s*[a-f0-9]+(?: [a-f0-9]+)?\s*%s$" % (idx, pattern.strip()) for idx, pattern in enumerate(filtered_pattern_lines)))
-        print(pattern_composed)
-        match_exp = re.compile(pattern_composed, re.MULTILINE)
-
-        # Find it in the deasm
-        if start:
-            start_idx = self._deasm_index(start, False)
-        else:
-            start_idx = 0
-        if end:
-            end_idx = self._deasm_index(end, True)
-        else:
-            end_idx = len(self.target_deasm)
-
-        matches = match_exp.finditer(self.target_deasm[start_idx:end_idx])
+        assert filtered_pattern_lines, "Empty pattern"
+        print("\n".join(filtered_pattern_lines))
+        # Each line must match the whole of one instruction's text - the lines, adjacent instructions.
+        line_exps = [re.compile(r"(?:%s)$" % line) for line in filtered_pattern_lines]
+        # Finds where the pattern might match - over the whole window at once, for match_at to confirm.
+        candidate_exp = re.compile("\n".join(r"^(?:%s)$" % line for line in filtered_pattern_lines), re.MULTILINE)
+
+        insns = self.target_insns
+        start_idx = insns.find(start, False) if start else 0
+        end_idx = insns.find(end, True) if end else len(insns)
+
+        def match_at(idx):
+            # Each line's match, if the pattern matches the instructions from idx on.
+            line_matches = []
+            for line_idx, line_exp in enumerate(line_exps):
+                if idx + line_idx >= end_idx or (line_idx and not insns.contiguous(idx + line_idx - 1)):
+                    return None
+                line_start, line_end = insns.span(idx + line_idx)
+                line_match = line_exp.match(insns.text, line_start, line_end)
+                if not line_match:
+                    return None
+                line_matches.append(line_match)
+            return line_matches
+
+        def find_matches():
+            # (first instruction index, line matches) of each match in the window, in order and not overlapping.
+            idx = start_idx
+            while idx < end_idx:
+                candidate = candidate_exp.search(insns.text, insns.span(idx)[0], insns.span(end_idx - 1)[1])
+                if not candidate:
+                    return
+                idx = insns.at_offset(candidate.start())
+                line_matches = match_at(idx)
+                if line_matches:
+                    yield idx, line_matches
+                    idx += len(line_exps)
+                else:
+                    idx += 1
+
+        matches = find_matches()
         match = None
         try:
             match = next(matches)
@@ -153,18 +304,22 @@ class Patcher:
             match_list = [match] + list(matches)
             match = match_list[n]
 
+        match_idx, line_matches = match
+        groups = {}
+        for line_match in line_matches:
+            groups.update(line_match.groupdict())
         return MatchResult(
-            start=int(match.group("addr_0"), 16),
-            end=int(match.group("addr_%d" % (len(filtered_pattern_lines)-1)), 16),
-            markers={k: int(match.group("addr_%d" % v), 16) for k, v in marker_indices.items()},
-            groups={k: v for k, v in match.groupdict().items() if not k.startswith("addr_")}
+            start=insns.address(match_idx),
+            end=insns.address(match_idx + len(line_exps) - 1),
+            markers={k: insns.address(match_idx + v) for k, v in marker_indices.items()},
+            groups=groups
         )
 
     def match_symbol(self, symbol):
         addr = self.symtab[symbol]
         markers = {"TARGET": addr, "JUMP": addr}
         # Figure out if we're about to break a 32-bit instruction
-        if " %x:" % (addr + 4) not in self.target_deasm:
+        if self.target_insns.find(addr + 4) is None:
             markers["END"] = addr + 6
         # BLegh
         return MatchResult(
@@ -2,6 +2,7 @@
 
 import argparse
 import freetype
+import imp
 import os
 import re
 import struct
@@ -9,10 +10,15 @@ import sys
 import itertools
 import json
 from math import ceil
-import unicodedata
+import time
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '../'))
 import generate_c_byte_array
+from pfo_hashtable import hash_table_stats, optimal_hash_table_size, format_stats
+from glyph_archive import open_glyph_store
+from glyph_stats import glyph_label, write_glyph_stats
+from pfo import FontInfo, GLYPH_TABLE_PADDING, offsets_fit_16, pack_pfo
+import rle4
 
 # Font v3 -- https://pebbletechnology.atlassian.net/wiki/display/DEV/Pebble+Resource+Pack+Format
 #   FontInfo
@@ -89,16 +95,11 @@ OFFSET_TABLE_MAX_SIZE = 128
 MAX_GLYPHS_EXTENDED = HASH_TABLE_SIZE * OFFSET_TABLE_MAX_SIZE
 MAX_GLYPHS = 256
 
-GLYPH_BUFFER_SIZE_BYTES = 256
-
 def grouper(n, iterable, fillvalue=None):
     """grouper(3, 'ABCDEFG', 'x') --> ABC DEF Gxx"""
     args = [iter(iterable)] * n
     return itertools.izip_longest(fillvalue=fillvalue, *args)
 
-def hasher(codepoint, num_glyphs):
-    return (codepoint % num_glyphs)
-
 def bits(x):
     data = []
     for i in range(8):
@@ -120,13 +121,11 @@ class Font:
         self.table_size = HASH_TABLE_SIZE
         self.tracking_adjust = 0
         self.regex = None
-        self.codepoints = range(MIN_CODEPOINT, MAX_EXTENDED_CODEPOINT)
+        self.codepoints = None  # None selects everything from MIN_CODEPOINT up
         self.codepoint_bytes = 2
         self.max_glyphs = max_glyphs
         self.glyph_table = []
-        self.hash_table = [0] * self.table_size
-        self.offset_tables = [[] for i in range(self.table_size)]
-        self.offset_size_bytes = 4
+        self.glyph_entries = []
         self.features = 0
         self.codepoints_map = {}
         self.zero_width_codepts = []
@@ -134,7 +133,15 @@ class Font:
         self.threshold = 127
         self.dump_dir = None
         self.collect_dir = None
+        self.dump_store = None
+        self.collect_store = None
+        self.postprocess = None
+        self.coverage_cache = None
         self.codept_labels = {}
+        self.optimize_hash_table = False
+        self.dedup_bytes_saved = 0
+        self.stats_path = None
+        self.glyph_stats = None
 
         self.glyph_header = ''.join((
             '<',  # little_endian
@@ -178,7 +185,15 @@ class Font:
     def set_codepoint_list(self, list_path):
         codepoints_file = open(list_path)
         codepoints_json = json.load(codepoints_file)
-        self.codepoints = [int(cp) for cp in codepoints_json["codepoints"]]
+        self.codepoints = set(int(cp) for cp in codepoints_json["codepoints"])
+
+    def subset_codepoints(self):
+        # The explicit codepoint list with the regex filter already applied - or None if there's no list.
+        if self.codepoints is None:
+            return None
+        if self.regex is None:
+            return set(self.codepoints)
+        return set(cp for cp in self.codepoints if self.regex.match(unichr(cp)) is not None)
 
     def set_zero_width_codept_list(self, list_path):
         codepoints_file = open(list_path)
@@ -197,9 +212,23 @@ class Font:
     def set_collect_dir(self, collect_dir):
         self.collect_dir = collect_dir
 
+    def set_postprocess(self, script_path):
+        # The script's postprocess(name, meta, bitmap) sees every rendered glyph, and returns a fixed
+        # (meta, bitmap) - or None to keep the glyph as rendered. (fonts/fix_ijam.py is one.)
+        self.postprocess = imp.load_source("fontgen_postprocess", script_path).postprocess
+
     def set_codept_labels(self, labels_path):
         self.codept_labels = {int(k): v for k, v in json.load(open(labels_path, "r")).items()}
 
+    def set_stats_path(self, stats_path):
+        self.stats_path = stats_path
+
+    def set_optimize_hash_table(self, optimize):
+        self.optimize_hash_table = optimize
+
+    def set_table_size(self, table_size):
+        self.table_size = table_size
+
     def is_supported_glyph(self, codepoint):
         return (self.face.get_char_index(codepoint) > 0 or
                 (codepoint == unichr(self.wildcard_codepoint)))
@@ -209,129 +238,74 @@ class Font:
         # symbol and the length of the run. The length of each run of symbols is limited to
         # [1..2**(RLElen-1)]. For RLE4, the length is 3 bits (0-7), or 1-8 consecutive symbols.
         # For example: 11110111 is compressed to 1*4, 0*1, 1*3. or [(1, 4), (0, 1), (1, 3)]
-
-        RLE_LEN = 2**(4-1)  # TODO possibly make this a parameter.
-        # It would likely be a good idea to look into the 'bitstream' package for lengths that won't
-        # easily fit into a byte/short/int.
-
-        # First, generate a list of tuples (bit, count).
-        unit_list = [(name, len(list(group))) for name, group in itertools.groupby(bitmap)]
-
-        # Second, generate a list of RLE tuples where count <= RLE_LEN. This intermediate step will
-        # make it much easier to implement the binary stream packer below.
-        rle_unit_list = []
-        for name, length in unit_list:
-            while length > 0:
-                unit_len = min(length, RLE_LEN)
-                rle_unit_list.append((name, unit_len))
-                length -= unit_len
-
-        # Note that num_units does not include the padding added below.
-        num_units = len(rle_unit_list)
-
-        # If the list is odd, add a padding unit
-        if (num_units % 2) == 1:
-            rle_unit_list.append((0, 1))
-
-        # Now pack the tuples into a binary stream. We can't pack nibbles, so join two
-        glyph_packed = []
-        it = iter(rle_unit_list)
-        for name, length in it:
-            name2, length2 = next(it)
-            packed_byte = name << 3 | (length - 1) | name2 << 7 | (length2 - 1) << 4
-            glyph_packed.append(struct.pack('<B', packed_byte))
-
-        # Pad out to the nearest 4 bytes
-        while (len(glyph_packed) % 4) > 0:
-            glyph_packed.append(struct.pack('<B', 0))
-
-        return (glyph_packed, num_units)
+        # See rle4.py for the details.
+        return rle4.encode(bitmap)
 
     # Make sure that we will be able to decompress the glyph in-place
     def check_decompress_glyph_RLE4(self, glyph_packed, width, rle_units):
-        # The glyph buffer before decoding is arranged as follows:
-        #  [ <header> | <free space> | <encoded glyph> ]
-        # Make sure that we can decode the encoded glyph to end up with the following arrangement:
-        #  [ <header> |       <decoded glyph>          ]
-        # without overwriting the unprocessed encoded glyph in the process
-
-        header_size = struct.calcsize(self.glyph_header)
-        dst_ptr = header_size
-        src_ptr = GLYPH_BUFFER_SIZE_BYTES - len(glyph_packed)
-
-        def glyph_packed_iterator(tbl, num):
-            for i in xrange(0, num):
-                yield struct.unpack('<B', tbl[i])[0]
-
-        # Generate glyph buffer. Ignore the header
-        bitmap = [0] * GLYPH_BUFFER_SIZE_BYTES
-        bitmap[-len(glyph_packed):] = glyph_packed_iterator(glyph_packed, len(glyph_packed))
-
-        out_num_bits = 0
-        out = 0
-        total_length = 0
-        while rle_units > 0:
-            if src_ptr >= GLYPH_BUFFER_SIZE_BYTES:
-                raise Exception("Error: input stream too large for buffer. Font {}".
-                                format(self.ttf_path))
-
-            unit_pair = bitmap[src_ptr]
-            src_ptr += 1
-            for i in range(min(rle_units, 2)):
-                colour = (unit_pair >> 3) & 1
-                length = (unit_pair & 0x07) + 1
-                total_length += length
-
-                if colour:
-                    # Generate the bitpattern 111...
-                    add = (1 << length) - 1
-                    out |= (add << out_num_bits)
-                out_num_bits += length
-
-                if out_num_bits >= 8:
-                    if dst_ptr >= src_ptr:
-                        raise Exception("Error: unable to RLE4 decode in place! Overrun. Font {}".
-                                        format(self.ttf_path))
-                    if dst_ptr >= GLYPH_BUFFER_SIZE_BYTES:
-                        raise Exception("Error: output bitmap too large for buffer. Font {}".
-                                        format(self.ttf_path))
-                    bitmap[dst_ptr] = (out & 0xFF)
-                    dst_ptr += 1
-                    out >>= 8
-                    out_num_bits -= 8
-
-                unit_pair >>= 4
-                rle_units -= 1
-
-        while out_num_bits > 0:
-            bitmap[dst_ptr] = (out & 0xFF)
-            dst_ptr += 1
-            out >>= 8
-            out_num_bits -= 8
+        try:
+            rle4.decode_headroom(glyph_packed, rle_units, struct.calcsize(self.glyph_header))
+        except ValueError as e:
+            raise Exception("Error: {}. Font {}".format(e, self.ttf_path))
 
         # Success! We can in-place decode this glyph
         return True
 
 
-    def glyph_bits(self, codepoint, gindex):
-        if gindex ==  ZERO_WIDTH_GLYPH_INDEX:
-            return struct.pack(self.glyph_header, 0, 0, 0, 0, 0)
+    def glyph_name(self, codepoint, gindex):
+        name = str(gindex)
+        label = glyph_label(codepoint, self.codept_labels)
+        if label:
+            name += "_" + label
+        return name
+
+    def glyph_metrics(self):
+        # Font metrics of the glyph last loaded into the face
+        bitmap = self.face.glyph.bitmap
+        advance = self.face.glyph.advance.x / 64     # Convert 26.6 fixed float format to px
+        advance += self.tracking_adjust
+        return {
+            "width": bitmap.width,
+            "height": bitmap.rows,
+            "left": self.face.glyph.bitmap_left,
+            "bottom": self.max_height - self.face.glyph.bitmap_top,
+            "advance": advance
+        }
+
+    def render_coverage(self, gindex):
+        # Greyscale coverage of a glyph as a numpy array, rendered at most once while sweeping.
+        try:
+            return self.coverage_cache[gindex]
+        except KeyError:
+            pass
+        import numpy  # Only needed for threshold sweeps
+        self.face.load_glyph(gindex, freetype.FT_LOAD_RENDER)
+        bitmap = self.face.glyph.bitmap
+        meta = self.glyph_metrics()
+        if bitmap.pixel_mode != 2:
+            raise Exception("Threshold sweeps need a greyscale render, got pixel mode {}. Font {}".
+                            format(bitmap.pixel_mode, self.ttf_path))
+        coverage = numpy.zeros((meta["height"], meta["width"]), dtype=numpy.uint8)
+        if meta["height"] and meta["width"]:
+            buf = numpy.array(bitmap.buffer, dtype=numpy.uint8).reshape(bitmap.rows, bitmap.pitch)
+            coverage = buf[:, :bitmap.width]
+        self.coverage_cache[gindex] = (meta, coverage)
+        return meta, coverage
+
+    def render_glyph(self, gindex):
+        if self.coverage_cache is not None:
+            meta, coverage = self.render_coverage(gindex)
+            return dict(meta), (coverage > self.threshold).astype(int).flatten().tolist()
+
         flags = (freetype.FT_LOAD_RENDER if self.legacy else
             freetype.FT_LOAD_RENDER | freetype.FT_LOAD_MONOCHROME | freetype.FT_LOAD_TARGET_MONO)
         self.face.load_glyph(gindex, flags)
-        # Font metrics
         bitmap = self.face.glyph.bitmap
-        advance = self.face.glyph.advance.x / 64     # Convert 26.6 fixed float format to px
-        advance += self.tracking_adjust
-        width = bitmap.width
-        height = bitmap.rows
-        left = self.face.glyph.bitmap_left
-        bottom = self.max_height - self.face.glyph.bitmap_top
+        meta = self.glyph_metrics()
         pixel_mode = self.face.glyph.bitmap.pixel_mode
 
-        glyph_packed = []
-        if height and width:
-            glyph_bitmap = []
+        glyph_bitmap = []
+        if meta["height"] and meta["width"]:
             if pixel_mode == 1:  # monochrome font, 1 bit per pixel
                 for i in range(bitmap.rows):
                     row = []
@@ -345,47 +319,13 @@ class Font:
                 # freetype-py should never give us a value not in (1,2)
                 raise Exception("Unsupported pixel mode: {}. Font {}".
                                 format(pixel_mode, self.ttf_path))
+        return meta, glyph_bitmap
 
-            if self.dump_dir:
-                fn = str(gindex)
-                try:
-                    fn += "_" + self.codept_labels[codepoint]
-                except KeyError:
-                    name = unicodedata.name(unichr(codepoint), None)
-                    if name:
-                        fn += "_" + name
-                fn += ".txt"
-                fd = open(os.path.join(self.dump_dir, fn), "w")
-                idx = 0
-                fd.write("%s\n" % json.dumps({
-                    "width": width,
-                    "height": height,
-                    "left": left,
-                    "bottom": bottom,
-                    "advance": advance
-                }))
-                for i in range(bitmap.rows):
-                    for j in range(bitmap.width):
-                        fd.write("#" if glyph_bitmap[idx] else " ")
-                        idx += 1
-                    fd.write("\n")
-                fd.close()
-
-                if self.collect_dir:
-                    collect_path = os.path.join(self.collect_dir, fn)
-                    if os.path.exists(collect_path):
-                        fd = open(collect_path, "r")
-                        meta = json.loads(fd.readline())
-                        width = meta["width"]
-                        height = meta["height"]
-                        left = meta["left"]
-                        bottom = meta["bottom"]
-                        advance = meta["advance"]
-                        bitmap_str = fd.read().replace("\n", "")
-                        assert len(bitmap_str) == width * height
-                        glyph_bitmap = [1 if c == "#" else 0 for c in bitmap_str]
-
-
+    def pack_glyph(self, meta, glyph_bitmap):
+        width = meta["width"]
+        height = meta["height"]
+        glyph_packed = []
+        if height and width:
             if (self.features & FEATURE_RLE4):
                 # HACK WARNING: override the height with the number of RLE4 units.
                 glyph_packed, height = self.compress_glyph_RLE4(glyph_bitmap)
@@ -401,90 +341,221 @@ class Font:
                         w |= bit << index
                     glyph_packed.append(struct.pack('<I', w))
 
-        left += self.shift[0]
-        bottom += self.shift[1]
-        glyph_header = struct.pack(self.glyph_header, width, height, left, bottom, advance)
+        left = meta["left"] + self.shift[0]
+        bottom = meta["bottom"] + self.shift[1]
+        glyph_header = struct.pack(self.glyph_header, width, height, left, bottom, meta["advance"])
 
         return glyph_header + ''.join(glyph_packed)
 
-    def fontinfo_bits(self):
-        if self.version == FONT_VERSION_2:
-            s = struct.Struct('<BBHHBB')
-            return s.pack(self.version,
-                          self.max_height,
-                          self.number_of_glyphs,
-                          self.wildcard_codepoint,
-                          self.table_size,
-                          self.codepoint_bytes)
+    def glyph_bits(self, codepoint, gindex):
+        if gindex ==  ZERO_WIDTH_GLYPH_INDEX:
+            glyph_bits = struct.pack(self.glyph_header, 0, 0, 0, 0, 0)
+            self.record_glyph_stats(gindex, {"width": 0, "height": 0}, glyph_bits, None)
+            return glyph_bits
+        render_start = time.time()
+        meta, glyph_bitmap = self.render_glyph(gindex)
+        render_time = time.time() - render_start
+
+        if glyph_bitmap and (self.dump_store or self.collect_store or self.postprocess):
+            name = self.glyph_name(codepoint, gindex)
+            if self.dump_store:
+                self.dump_store.put(name, meta, glyph_bitmap)
+            # Post-processed glyphs take precedence over collected ones, as when fix_ijam.py rewrote the archive.
+            fixed = self.postprocess(name, meta, glyph_bitmap) if self.postprocess else None
+            if fixed:
+                meta, glyph_bitmap = fixed
+            elif self.collect_store and name in self.collect_store:
+                meta, glyph_bitmap = self.collect_store.get(name)
+
+        glyph_bits = self.pack_glyph(meta, glyph_bitmap)
+        self.record_glyph_stats(gindex, meta, glyph_bits, render_time)
+        return glyph_bits
+
+    def record_glyph_stats(self, gindex, meta, glyph_bits, render_time):
+        # Only collected with --stats; keyed by glyph index, since that's what we render.
+        if self.glyph_stats is None:
+            return
+        rle_units = None
+        if (self.features & FEATURE_RLE4) and meta["width"] and meta["height"]:
+            rle_units = struct.unpack('<B', glyph_bits[1])[0]
+        self.glyph_stats[gindex] = {
+            "gindex": gindex,
+            "width": meta["width"],
+            "height": meta["height"],
+            "packed_bytes": len(glyph_bits),
+            "rle_units": rle_units,
+            "render_ms": round(render_time * 1000, 3) if render_time is not None else None
+        }
+
+    def open_glyph_stores(self):
+        if self.dump_dir:
+            # Appended to - other fonts' members of the same face & size dump into the same store.
+            self.dump_store = open_glyph_store(self.dump_dir, "a")
+        if self.collect_dir and os.path.exists(self.collect_dir):
+            self.collect_store = open_glyph_store(self.collect_dir, "r")
+
+    def close_glyph_stores(self):
+        for store in (self.dump_store, self.collect_store):
+            if store:
+                store.close()
+        self.dump_store = self.collect_store = None
+
+    def sweep_thresholds(self, thresholds):
+        # Render every glyph once in greyscale, then evaluate all the thresholds against the cached
+        # coverage in one go. For each threshold we total up, over all glyphs:
+        #  - ink density: the fraction of pixels that are set
+        #  - stroke breaks: pieces gained (by 8-connected Euler number) versus the heaviest threshold
+        #  - isolated dots: set pixels with no set neighbours - i.e. what fix_ijam will thicken
+        #  - packed bytes: glyph records as they'd be written (raw, or RLE4 if compression is on)
+        # Only the legacy rasterizer thresholds greyscale - the mono one ignores the threshold, so there's nothing to sweep.
+        if not self.legacy:
+            raise Exception("Threshold sweeps need the legacy (greyscale) rasterizer - use --legacy. Font {}".format(self.ttf_path))
+        import numpy  # Only needed for threshold sweeps
+        if self.coverage_cache is None:
+            self.coverage_cache = {}
+        thresholds = numpy.array(sorted(set(thresholds)))
+        header_size = struct.calcsize(self.glyph_header)
+
+        if self.codepoints_map:
+            gindices = set(self.codepoints_map.values())
         else:
-            s = struct.Struct('<BBHHBBBB')
-            return s.pack(self.version,
-                          self.max_height,
-                          self.number_of_glyphs,
-                          self.wildcard_codepoint,
-                          self.table_size,
-                          self.codepoint_bytes,
-                          s.size,
-                          self.features)
+            gindices = set(gindex for _, gindex in self.subset_chars())
+        gindices.add(0)
+
+        ink = numpy.zeros(len(thresholds))
+        pixels = 0
+        stroke_breaks = numpy.zeros(len(thresholds), dtype=int)
+        isolated_dots = numpy.zeros(len(thresholds), dtype=int)
+        packed_bytes = numpy.zeros(len(thresholds), dtype=int)
+        for gindex in sorted(gindices):
+            meta, coverage = self.render_coverage(gindex)
+            height, width = coverage.shape
+            if not coverage.size:
+                packed_bytes += header_size
+                continue
+            # One bitmap per threshold, padded by a pixel all round: T x (H + 2) x (W + 2)
+            padded = numpy.zeros((len(thresholds), height + 2, width + 2), dtype=numpy.int8)
+            padded[:, 1:-1, 1:-1] = coverage[None, :, :] > thresholds[:, None, None]
+            glyph = padded[:, 1:-1, 1:-1]
+
+            pixels += coverage.size
+            ink += glyph.sum(axis=(1, 2))
+
+            neighbours = sum(padded[:, 1 + dy:height + 1 + dy, 1 + dx:width + 1 + dx]
+                             for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dx or dy)
+            isolated_dots += ((glyph == 1) & (neighbours == 0)).sum(axis=(1, 2))
+
+            # Gray's bit-quad Euler number (components - holes) for 8-connectivity.
+            q_a, q_b = padded[:, :-1, :-1], padded[:, :-1, 1:]
+            q_c, q_d = padded[:, 1:, :-1], padded[:, 1:, 1:]
+            quad = q_a + q_b + q_c + q_d
+            euler = ((quad == 1).sum(axis=(1, 2)) - (quad == 3).sum(axis=(1, 2)) -
+                     2 * ((quad == 2) & (q_a == q_d)).sum(axis=(1, 2))) // 4
+            stroke_breaks += numpy.maximum(euler - euler[0], 0)
+
+            if self.features & FEATURE_RLE4:
+                # RLE4 units: a new unit starts at each run boundary, and every 8 pixels within a run.
+                flat = glyph.reshape(len(thresholds), -1)
+                positions = numpy.arange(flat.shape[1])
+                run_start = numpy.ones(flat.shape, dtype=bool)
+                run_start[:, 1:] = flat[:, 1:] != flat[:, :-1]
+                run_start_pos = numpy.maximum.accumulate(numpy.where(run_start, positions, 0), axis=1)
+                units = ((positions - run_start_pos) % 8 == 0).sum(axis=1)
+                packed_bytes += header_size + ((units + 1) // 2 + 3) // 4 * 4
+            else:
+                packed_bytes += header_size + (coverage.size + 31) // 32 * 4
+
+        return [{
+            "threshold": int(thresholds[i]),
+            "ink_density": float(ink[i]) / pixels if pixels else 0,
+            "stroke_breaks": int(stroke_breaks[i]),
+            "isolated_dots": int(isolated_dots[i]),
+            "packed_bytes": int(packed_bytes[i])
+        } for i in range(len(thresholds))]
+
+    def fontinfo(self):
+        return FontInfo(version=self.version,
+                        max_height=self.max_height,
+                        number_of_glyphs=self.number_of_glyphs,
+                        wildcard_codepoint=self.wildcard_codepoint,
+                        hash_table_size=self.table_size,
+                        codepoint_bytes=self.codepoint_bytes,
+                        features=self.features)
+
+
+    def subset_chars(self):
+        # Yields (codepoint, gindex) for each character of the face selected by --list and --filter.
+        # The face's own wildcard character is never yielded, whichever way the face is searched - build_tables
+        # always adds the wildcard itself (as glyph 0).
+        # Filter the explicit subset (if any) once up-front, so each character is a single set lookup.
+        subset = self.subset_codepoints()
+
+        def codepoint_is_in_subset(codepoint):
+           if (codepoint != ELLIPSIS_CODEPOINT):
+              if subset is not None:
+                  return codepoint in subset
+              if not (MIN_CODEPOINT <= codepoint < MAX_EXTENDED_CODEPOINT):
+                  return False
+              if self.regex is not None:
+                  if self.regex.match(unichr(codepoint)) is None:
+                      return False
+           return True
+
+        def face_chars():
+            if subset is not None and len(subset) <= self.face.num_glyphs:
+                # Small subsets (e.g. Hebrew) - look the codepoints up directly instead of walking the charmap.
+                for codepoint in sorted(subset | set((ELLIPSIS_CODEPOINT,))):
+                    gindex = self.face.get_char_index(codepoint)
+                    if gindex:
+                        yield codepoint, gindex
+            else:
+                codepoint, gindex = self.face.get_first_char()
+                while gindex:
+                    if (codepoint_is_in_subset(codepoint)):
+                        yield codepoint, gindex
+                    codepoint, gindex = self.face.get_next_char(codepoint, gindex)
 
+        for codepoint, gindex in face_chars():
+            if codepoint != WILDCARD_CODEPOINT:
+                yield codepoint, gindex
 
     def build_tables(self):
-        def build_hash_table(bucket_sizes):
-            acc = 0
-            for i in range(self.table_size):
-                bucket_size = bucket_sizes[i]
-                self.hash_table[i] = (struct.pack('<BBH', i, bucket_size, acc))
-                acc += bucket_size * (self.offset_size_bytes + self.codepoint_bytes)
-
-        def build_offset_tables(glyph_entries):
-            offset_table_format = '<'
-            offset_table_format += 'L' if self.codepoint_bytes == 4 else 'H'
-            offset_table_format += 'L' if self.offset_size_bytes == 4 else 'H'
-
-            bucket_sizes = [0] * self.table_size
-            for entry in glyph_entries:
-                codepoint, offset = entry
-                glyph_hash = hasher(codepoint, self.table_size)
-                self.offset_tables[glyph_hash].append(
-                        struct.pack(offset_table_format, codepoint, offset))
-                bucket_sizes[glyph_hash] = bucket_sizes[glyph_hash] + 1
-                if bucket_sizes[glyph_hash] > OFFSET_TABLE_MAX_SIZE:
-                    print "error: %d > 127" % bucket_sizes[glyph_hash]
-            return bucket_sizes
-
         def add_glyph(codepoint, next_offset, gindex, glyph_indices_lookup):
             offset = next_offset
             if gindex not in glyph_indices_lookup:
                 glyph_bits = self.glyph_bits(codepoint, gindex)
+                if glyph_bits in glyph_data_lookup:
+                    # A different glyph index that renders to the very same record - share it.
+                    offset = glyph_data_lookup[glyph_bits]
+                    self.dedup_bytes_saved += len(glyph_bits)
+                else:
+                    glyph_data_lookup[glyph_bits] = offset
+                    self.glyph_table.append(glyph_bits)
+                    next_offset += len(glyph_bits)
                 glyph_indices_lookup[gindex] = offset
-                self.glyph_table.append(glyph_bits)
-                next_offset += len(glyph_bits)
             else:
                 offset = glyph_indices_lookup[gindex]
 
+            codepoint_gindices[codepoint] = gindex
+
             if (codepoint > MAX_2_BYTES_CODEPOINT):
                 self.codepoint_bytes = 4
 
             self.number_of_glyphs += 1
             return offset, next_offset, glyph_indices_lookup
 
-        def codepoint_is_in_subset(codepoint):
-           if (codepoint not in (WILDCARD_CODEPOINT, ELLIPSIS_CODEPOINT)):
-              if self.regex is not None:
-                  if self.regex.match(unichr(codepoint)) is None:
-                      return False
-              if codepoint not in self.codepoints:
-                 return False
-           return True
-
         glyph_entries = []
         # MJZ: The 0th offset of the glyph table is 32-bits of
-        # padding, no idea why.
-        self.glyph_table.append(struct.pack('<I', 0))
+        # padding, no idea why. (pack_pfo adds it.)
+        self.glyph_table = []
         self.number_of_glyphs = 0
         glyph_indices_lookup = dict()
-        next_offset = 4
-        codepoint, gindex = self.face.get_first_char()
+        glyph_data_lookup = dict()
+        codepoint_gindices = dict()
+        self.dedup_bytes_saved = 0
+        if self.stats_path:
+            self.glyph_stats = {}
+        next_offset = GLYPH_TABLE_PADDING
 
         # add wildcard_glyph
         offset, next_offset, glyph_indices_lookup = add_glyph(WILDCARD_CODEPOINT, next_offset, 0,
@@ -498,7 +569,7 @@ class Font:
             glyph_entries.append((codept, offset))
 
         if not self.codepoints_map:
-            while gindex:
+            for codepoint, gindex in self.subset_chars():
                 # Hard limit on the number of glyphs in a font
                 if (self.number_of_glyphs > self.max_glyphs):
                     break
@@ -511,36 +582,41 @@ class Font:
                     raise Exception('0 index is reused by a non wildcard glyph. Font {}'.
                                     format(self.ttf_path))
 
-                if (codepoint_is_in_subset(codepoint)):
-                    offset, next_offset, glyph_indices_lookup = add_glyph(codepoint, next_offset,
-                                                                          gindex, glyph_indices_lookup)
-                    glyph_entries.append((codepoint, offset))
-
-                codepoint, gindex = self.face.get_next_char(codepoint, gindex)
+                offset, next_offset, glyph_indices_lookup = add_glyph(codepoint, next_offset,
+                                                                      gindex, glyph_indices_lookup)
+                glyph_entries.append((codepoint, offset))
         else:
             for codepoint, gindex in sorted(self.codepoints_map.items(), key=lambda x: x[0]):
                 offset, next_offset, glyph_indices_lookup = add_glyph(codepoint, next_offset, gindex, glyph_indices_lookup)
                 glyph_entries.append((codepoint, offset))
 
+        if self.dedup_bytes_saved:
+            print "Deduplicated identical glyph records, saving {} bytes".format(self.dedup_bytes_saved)
+
         # Decide if we need 2 byte or 4 byte offsets
-        glyph_data_bytes = sum(len(glyph) for glyph in self.glyph_table)
-        if self.version == FONT_VERSION_3 and glyph_data_bytes < 65536:
+        glyph_data_bytes = GLYPH_TABLE_PADDING + sum(len(glyph) for glyph in self.glyph_table)
+        if self.version == FONT_VERSION_3 and offsets_fit_16(glyph_data_bytes):
             self.features |= FEATURE_OFFSET_16
-            self.offset_size_bytes = 2
+
+        if self.optimize_hash_table:
+            codepoints = [entry[0] for entry in glyph_entries]
+            print "Hash table {}".format(format_stats(hash_table_stats(codepoints, self.table_size)))
+            best = optimal_hash_table_size(codepoints)
+            print "Optimized {}".format(format_stats(best))
+            self.set_table_size(best.size)
 
         # Make sure the entries are sorted by codepoint
         sorted_entries = sorted(glyph_entries, key=lambda entry: entry[0])
-        hash_bucket_sizes = build_offset_tables(sorted_entries)
-        build_hash_table(hash_bucket_sizes)
+        self.glyph_entries = sorted_entries
 
-    def bitstring(self):
-        btstr = self.fontinfo_bits()
-        btstr += ''.join(self.hash_table)
-        for table in self.offset_tables:
-            btstr += ''.join(table)
-        btstr += ''.join(self.glyph_table)
+        if self.stats_path:
+            stats = [dict(self.glyph_stats[codepoint_gindices[codepoint]], codepoint=codepoint, offset=offset)
+                     for codepoint, offset in sorted_entries]
+            write_glyph_stats(self.stats_path, self.name, stats, self.table_size, self.codept_labels)
+            self.glyph_stats = None
 
-        return btstr
+    def bitstring(self):
+        return bytes(pack_pfo(self.fontinfo(), self.glyph_entries, self.glyph_table))
 
     def convert_to_h(self):
         to_file = os.path.splitext(self.ttf_path)[0] + '.h'
@@ -556,8 +632,13 @@ class Font:
 
     def convert_to_pfo(self, pfo_path=None):
         to_file = pfo_path if pfo_path else (os.path.splitext(self.ttf_path)[0] + '.pfo')
-        with open(to_file, 'wb') as f:
+        self.open_glyph_stores()
+        try:
             self.build_tables()
+        finally:
+            # Keep whatever we managed to dump, even if the build itself failed.
+            self.close_glyph_stores()
+        with open(to_file, 'wb') as f:
             f.write(self.bitstring())
         return to_file
 
@@ -583,11 +664,35 @@ def cmd_pfo(args):
     if (args.dump_bitmaps):
         f.set_dump_dir(args.dump_bitmaps)
     if (args.collect_bitmaps):
-        assert args.dump_bitmaps, "--collect-bitmaps requires --dump-bitmaps" # Because I'm lazy
         f.set_collect_dir(args.collect_bitmaps)
+    if (args.postprocess):
+        f.set_postprocess(args.postprocess)
     if (args.codept_labels):
         f.set_codept_labels(args.codept_labels)
+    if (args.optimize_hash_table):
+        f.set_optimize_hash_table(True)
+    if (args.stats):
+        f.set_stats_path(args.stats)
     f.set_version(int(args.version))
+    if (args.sweep_thresholds):
+        start, stop, step = (int(x) for x in args.sweep_thresholds.split(":"))
+        results = f.sweep_thresholds(list(range(start, stop + 1, step)) + [f.threshold])
+        print "threshold  ink density  stroke breaks  isolated dots  packed bytes"
+        for result in results:
+            print "{threshold:9d}  {ink_density:11.4f}  {stroke_breaks:13d}  {isolated_dots:13d}  {packed_bytes:12d}".format(**result)
+        # Heavier renders always break fewer strokes, so cap the ink density at the target
+        # (by default, the current threshold's) and pick the fewest stroke breaks within that.
+        target_density = args.sweep_target_density
+        if target_density is None:
+            target_density = next(r["ink_density"] for r in results if r["threshold"] == f.threshold)
+        candidates = [r for r in results if r["ink_density"] <= target_density] or results
+        best = min(candidates, key=lambda r: (r["stroke_breaks"], abs(r["ink_density"] - target_density)))
+        print "Best threshold: {}".format(best["threshold"])
+        if (args.sweep_report):
+            json.dump({"best": best["threshold"], "results": results}, open(args.sweep_report, "w"), indent=2)
+        if (args.sweep_only):
+            return
+        f.set_threshold(best["threshold"])
     f.convert_to_pfo(args.output_pfo)
 
 def cmd_header(args):
@@ -638,14 +743,28 @@ def process_cmd_line_args():
     pbi_parser.add_argument('--list',
                             help="json list of characters to include")
     pbi_parser.add_argument('--map', help="json map of codept->glyphs to embed")
-    pbi_parser.add_argument('--dump-bitmaps', help="directory to write editable bitmaps into")
-    pbi_parser.add_argument('--collect-bitmaps', help="directory to read bitmaps from, overriding TTF input")
-    pbi_parser.add_argument('--codept-labels', help="JSON map of codept->name for dumping bitmaps")
+    pbi_parser.add_argument('--dump-bitmaps',
+                            help="glyph archive (.glyphs) or directory to add editable bitmaps to")
+    pbi_parser.add_argument('--collect-bitmaps',
+                            help="glyph archive (.glyphs) or directory to read bitmaps from, overriding TTF input")
+    pbi_parser.add_argument('--postprocess', metavar='SCRIPT',
+                            help="python file whose postprocess(name, meta, bitmap) fixes up glyphs as they're rendered")
+    pbi_parser.add_argument('--codept-labels', help="JSON map of codept->name for dumping bitmaps and --stats")
     pbi_parser.add_argument('--zero-width-codept-list', help="json list of codepoints to assign a zero-width glyph")
     pbi_parser.add_argument('--shift', help="dx,dy to shift glyphs by")
     pbi_parser.add_argument('--threshold', help="black/white cutoff value (0-255)", type=int)
     pbi_parser.add_argument('--legacy', action='store_true',
                             help="use legacy rasterizer (non-mono) to preserve font dimensions")
+    pbi_parser.add_argument('--stats', help="JSON file to write per-glyph size, render time and hash table stats into")
+    pbi_parser.add_argument('--optimize-hash-table', action='store_true',
+                            help="pick the hash table size that minimizes glyph lookup cost")
+    pbi_parser.add_argument('--sweep-thresholds', metavar='START:STOP:STEP',
+                            help="with --legacy: render once in greyscale, evaluate each threshold, and output the best")
+    pbi_parser.add_argument('--sweep-target-density', type=float,
+                            help="maximum ink density for the best sweep threshold (default: that of --threshold)")
+    pbi_parser.add_argument('--sweep-report', help="JSON file to write the per-threshold sweep metrics into")
+    pbi_parser.add_argument('--sweep-only', action='store_true',
+                            help="report sweep metrics without writing OUTPUT_PFO")
     pbi_parser.add_argument('input_ttf', metavar='INPUT_TTF', help="The ttf to process")
     pbi_parser.add_argument('output_pfo', metavar='OUTPUT_PFO', help="The pfo output file")
     pbi_parser.set_defaults(func=cmd_pfo, version=3)
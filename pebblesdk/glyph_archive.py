@@ -0,0 +1,197 @@
+from __future__ import print_function
+import argparse
+import glob
+import json
+import os
+import struct
+
+# Glyph bitmaps are dumped for hand-editing and for fix_ijam.py to chew on.
+# Doing this with one text file per glyph gets out of hand at dozens of sizes, so the default store is a
+# single archive per face & size:
+#   (char[4])  magic "PGLA"
+#   (uint8_t)  version
+#   (uint8_t)  reserved
+#   (uint16_t) reserved
+#   (uint32_t) number_of_glyphs
+#   (uint32_t) index_size - in bytes
+#   index[] - one per glyph:
+#       (uint16_t) name_length
+#       (char[])   name, UTF-8
+#       (uint16_t) width
+#       (uint16_t) height
+#       (int16_t)  left
+#       (int16_t)  bottom
+#       (int16_t)  advance
+#       (uint32_t) bitmap offset - from the start of the bitmap data
+#       (uint32_t) bitmap length - in bytes
+#   bitmap data[] - rows of bits, row-major, MSB first, padded to a byte per glyph.
+#
+# The text form (a JSON metadata line followed by rows of "#" and " ") remains available as a
+# directory of .txt files - use the export/import commands below to move between the two.
+
+ARCHIVE_MAGIC = b"PGLA"
+ARCHIVE_VERSION = 1
+ARCHIVE_EXTENSION = ".glyphs"
+ARCHIVE_HEADER = struct.Struct("<4sBBHII")
+ARCHIVE_NAME_LENGTH = struct.Struct("<H")
+ARCHIVE_INDEX_ITEM = struct.Struct("<HHhhhII")
+
+METADATA_FIELDS = ("width", "height", "left", "bottom", "advance")
+
+def pack_bitmap(bitmap):
+    packed = bytearray((len(bitmap) + 7) // 8)
+    for idx, bit in enumerate(bitmap):
+        if bit:
+            packed[idx // 8] |= 0x80 >> (idx % 8)
+    return bytes(packed)
+
+def unpack_bitmap(packed, length):
+    packed = bytearray(packed)
+    return [(packed[idx // 8] >> (7 - idx % 8)) & 1 for idx in range(length)]
+
+def read_text_glyph(path):
+    with open(path, "r") as fd:
+        meta = json.loads(fd.readline())
+        bitmap_str = fd.read().replace("\n", "")
+    assert len(bitmap_str) == meta["width"] * meta["height"], "%s has a malformed bitmap" % path
+    return meta, [1 if c == "#" else 0 for c in bitmap_str]
+
+def write_text_glyph(path, meta, bitmap):
+    with open(path, "w") as fd:
+        fd.write("%s\n" % json.dumps(meta))
+        idx = 0
+        for y in range(meta["height"]):
+            for x in range(meta["width"]):
+                fd.write("#" if bitmap[idx] else " ")
+                idx += 1
+            fd.write("\n")
+
+class GlyphArchive:
+    def __init__(self, path, mode="r"):
+        self.path = path
+        self.mode = mode
+        self.index = {}
+        self.pending = {}
+        self.fd = None
+        if mode in ("r", "a") and os.path.exists(path):
+            self._read_index()
+        elif mode == "r":
+            raise IOError("Glyph archive %s does not exist" % path)
+
+    def _read_index(self):
+        self.fd = open(self.path, "rb")
+        magic, version, _, _, count, index_size = ARCHIVE_HEADER.unpack(self.fd.read(ARCHIVE_HEADER.size))
+        assert magic == ARCHIVE_MAGIC, "%s is not a glyph archive" % self.path
+        assert version == ARCHIVE_VERSION, "%s has unknown glyph archive version %d" % (self.path, version)
+        index_data = self.fd.read(index_size)
+        self.data_base = ARCHIVE_HEADER.size + index_size
+        pos = 0
+        for _ in range(count):
+            name_length, = ARCHIVE_NAME_LENGTH.unpack_from(index_data, pos)
+            pos += ARCHIVE_NAME_LENGTH.size
+            name = index_data[pos:pos + name_length].decode("utf-8")
+            pos += name_length
+            self.index[name] = ARCHIVE_INDEX_ITEM.unpack_from(index_data, pos)
+            pos += ARCHIVE_INDEX_ITEM.size
+
+    def names(self):
+        return sorted(set(self.index.keys()) | set(self.pending.keys()))
+
+    def __contains__(self, name):
+        return name in self.pending or name in self.index
+
+    def get(self, name):
+        try:
+            return self.pending[name]
+        except KeyError:
+            pass
+        width, height, left, bottom, advance, offset, length = self.index[name]
+        self.fd.seek(self.data_base + offset)
+        meta = dict(zip(METADATA_FIELDS, (width, height, left, bottom, advance)))
+        return meta, unpack_bitmap(self.fd.read(length), width * height)
+
+    def put(self, name, meta, bitmap):
+        assert self.mode in ("w", "a"), "Glyph archive %s is read-only" % self.path
+        assert len(bitmap) == meta["width"] * meta["height"]
+        self.pending[name] = (dict(meta), list(bitmap))
+
+    def close(self):
+        if self.mode in ("w", "a") and (self.pending or self.mode == "w"):
+            glyphs = [(name, self.get(name)) for name in self.names()]
+            index_data = b""
+            bitmap_data = []
+            offset = 0
+            for name, (meta, bitmap) in glyphs:
+                packed = pack_bitmap(bitmap)
+                name_bytes = name.encode("utf-8")
+                index_data += ARCHIVE_NAME_LENGTH.pack(len(name_bytes)) + name_bytes
+                index_data += ARCHIVE_INDEX_ITEM.pack(*([int(meta[k]) for k in METADATA_FIELDS] + [offset, len(packed)]))
+                bitmap_data.append(packed)
+                offset += len(packed)
+            if self.fd:
+                self.fd.close()
+                self.fd = None
+            with open(self.path, "wb") as fd:
+                fd.write(ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, 0, 0, len(glyphs), len(index_data)))
+                fd.write(index_data)
+                fd.write(b"".join(bitmap_data))
+            self.pending = {}
+        if self.fd:
+            self.fd.close()
+            self.fd = None
+
+class GlyphDirectory:
+    # The human-editable text form - one .txt file per glyph.
+    def __init__(self, path, mode="r"):
+        self.path = path
+        self.mode = mode
+        if mode != "r" and not os.path.exists(path):
+            os.makedirs(path)
+
+    def _glyph_path(self, name):
+        return os.path.join(self.path, name + ".txt")
+
+    def names(self):
+        return sorted(os.path.basename(p)[:-len(".txt")] for p in glob.glob(os.path.join(self.path, "*.txt")))
+
+    def __contains__(self, name):
+        return os.path.exists(self._glyph_path(name))
+
+    def get(self, name):
+        return read_text_glyph(self._glyph_path(name))
+
+    def put(self, name, meta, bitmap):
+        write_text_glyph(self._glyph_path(name), meta, bitmap)
+
+    def close(self):
+        pass
+
+def open_glyph_store(path, mode="r"):
+    # Directories (or anything not named like an archive) use the text form.
+    if os.path.isdir(path) or not path.endswith(ARCHIVE_EXTENSION):
+        return GlyphDirectory(path, mode)
+    return GlyphArchive(path, mode)
+
+def copy_glyphs(src, dest):
+    for name in src.names():
+        meta, bitmap = src.get(name)
+        dest.put(name, meta, bitmap)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert between glyph archives and editable text bitmaps")
+    subparsers = parser.add_subparsers(dest="which")
+    export_parser = subparsers.add_parser("export", help="Write each glyph of an archive to a .txt file")
+    export_parser.add_argument("archive")
+    export_parser.add_argument("out_dir")
+    import_parser = subparsers.add_parser("import", help="Pack a directory of .txt files into an archive")
+    import_parser.add_argument("in_dir")
+    import_parser.add_argument("archive")
+    args = parser.parse_args()
+
+    if args.which == "export":
+        src, dest = GlyphArchive(args.archive, "r"), GlyphDirectory(args.out_dir, "w")
+    else:
+        src, dest = GlyphDirectory(args.in_dir, "r"), GlyphArchive(args.archive, "a")
+    copy_glyphs(src, dest)
+    src.close()
+    dest.close()
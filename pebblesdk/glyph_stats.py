@@ -0,0 +1,94 @@
+from __future__ import division
+import json
+import unicodedata
+from pfo_hashtable import chain_lengths, hasher
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+# Per-glyph statistics for a built font, written as JSON by fontgen.py and pfo_merge.py (--stats):
+#   {"font": name, "hash_table_size": N,
+#    "glyphs": [one per codepoint, in codepoint order:
+#        {"codepoint", "label", "gindex", "width", "height", "packed_bytes", "rle_units",
+#         "render_ms", "offset", "hash_bucket", "chain_position"}],
+#    "summary": {totals, histograms, and the worst offenders}}
+# "height" is the bitmap height, even for RLE4 glyphs (whose header holds the unit count instead).
+# Fields a tool can't know are null - pfo_merge.py doesn't render, so has no gindex or render time.
+# Glyphs sharing a record (same offset) are listed per codepoint, but only counted once in the totals.
+
+HISTOGRAM_BINS = {
+    "packed_bytes": 16,
+    "rle_units": 16,
+    "render_ms": 0.5,
+}
+WORST_COUNT = 10
+
+def glyph_label(codepoint, labels=None):
+    try:
+        return labels[codepoint]
+    except (KeyError, TypeError):
+        pass
+    try:
+        return unicodedata.name(unichr(codepoint), None)
+    except ValueError:
+        return None  # Outside the BMP on a narrow Python build
+
+def chain_positions(codepoints, table_size):
+    # Mirrors the writers: chains are filled in codepoint order. Returns {codepoint: (bucket, position)}.
+    positions = {}
+    lengths = [0] * table_size
+    for codepoint in sorted(codepoints):
+        bucket = hasher(codepoint, table_size)
+        positions[codepoint] = (bucket, lengths[bucket])
+        lengths[bucket] += 1
+    return positions
+
+def histogram(values, bin_size):
+    # [[bin start, count], ...] over the non-null values.
+    counts = {}
+    for value in values:
+        if value is not None:
+            start = (value // bin_size) * bin_size
+            counts[start] = counts.get(start, 0) + 1
+    return [[start, counts[start]] for start in sorted(counts)]
+
+def summarize(glyphs, table_size):
+    records = list({glyph["offset"]: glyph for glyph in glyphs}.values())
+    lengths = chain_lengths([glyph["codepoint"] for glyph in glyphs], table_size)
+    render_times = [glyph["render_ms"] for glyph in records if glyph["render_ms"] is not None]
+
+    def worst(key):
+        ranked = sorted((glyph for glyph in glyphs if glyph[key] is not None), key=lambda g: -g[key])
+        return [[glyph["codepoint"], glyph[key]] for glyph in ranked[:WORST_COUNT]]
+
+    summary = {
+        "codepoints": len(glyphs),
+        "records": len(records),
+        "packed_bytes": sum(glyph["packed_bytes"] for glyph in records),
+        "render_ms": sum(render_times) if render_times else None,
+        "max_chain": max(lengths) if lengths else 0,
+        "histograms": {key: histogram([glyph[key] for glyph in records], bin_size)
+                       for key, bin_size in HISTOGRAM_BINS.items()},
+        "largest": worst("packed_bytes"),
+        "slowest": worst("render_ms"),
+        "deepest": worst("chain_position"),
+    }
+    summary["histograms"]["chain_length"] = histogram([n for n in lengths if n], 1)
+    return summary
+
+def write_glyph_stats(path, font_name, glyphs, table_size, labels=None):
+    # glyphs: one dict per codepoint with everything but the label & hash table placement filled in.
+    positions = chain_positions([glyph["codepoint"] for glyph in glyphs], table_size)
+    glyphs = sorted(glyphs, key=lambda glyph: glyph["codepoint"])
+    for glyph in glyphs:
+        glyph["label"] = glyph_label(glyph["codepoint"], labels)
+        glyph["hash_bucket"], glyph["chain_position"] = positions[glyph["codepoint"]]
+    with open(path, "w") as fd:
+        json.dump({
+            "font": font_name,
+            "hash_table_size": table_size,
+            "glyphs": glyphs,
+            "summary": summarize(glyphs, table_size),
+        }, fd, indent=1, sort_keys=True)
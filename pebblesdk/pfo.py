@@ -0,0 +1,154 @@
+from collections import namedtuple
+import mmap
+import struct
+from pfo_hashtable import hasher, OFFSET_TABLE_MAX_SIZE
+import rle4
+
+# Reading and writing PFO fonts - see the layout description at the top of fontgen.py.
+# The reader works in place on any buffer (an mmap'd file, or a slice of a resource pack): the header,
+# hash table and chains are walked with struct.unpack_from, and glyph records are only sliced out when
+# asked for. (memoryview would be neater, but Python 2 can't take one of an mmap - unpack_from can.)
+
+FONT_VERSION_2 = 2
+FONT_VERSION_3 = 3
+
+FEATURE_OFFSET_16 = 0x01
+FEATURE_RLE4 = 0x02
+
+FONT_INFO_V2 = struct.Struct('<BBHHBB')
+FONT_INFO_V3 = struct.Struct('<BBHHBBBB')
+HASH_TABLE_ITEM = struct.Struct('<BBH')
+GLYPH_HEADER = struct.Struct('<BBbbb')
+# The first 4 bytes of the glyph table are padding, so offset 0 never points at a glyph.
+GLYPH_TABLE_PADDING = 4
+
+FontInfo = namedtuple("FontInfo", "version max_height number_of_glyphs wildcard_codepoint "
+                                  "hash_table_size codepoint_bytes features")
+
+def offset_table_item(codepoint_bytes, offset_16):
+    return struct.Struct('<' + ('L' if codepoint_bytes == 4 else 'H') + ('H' if offset_16 else 'L'))
+
+def offsets_fit_16(glyph_table_bytes):
+    return glyph_table_bytes < 65536
+
+def glyph_record_size(width, height, compressed):
+    # The size of a glyph record from its header - for RLE4 glyphs, the height field is the unit count.
+    if not (width and height):
+        return GLYPH_HEADER.size
+    if compressed:
+        return GLYPH_HEADER.size + rle4.encoded_size(height)
+    return GLYPH_HEADER.size + rle4.raw_size(width, height)
+
+class PFOReader:
+    def __init__(self, buf, base=0):
+        self.buf = buf
+        self.base = base
+        version, = struct.unpack_from('<B', buf, base)
+        if version == FONT_VERSION_2:
+            fields = FONT_INFO_V2.unpack_from(buf, base) + (0,)
+            info_size = FONT_INFO_V2.size
+        elif version == FONT_VERSION_3:
+            fields = FONT_INFO_V3.unpack_from(buf, base)
+            info_size = fields[6]
+            fields = fields[:6] + fields[7:]
+        else:
+            raise ValueError("Unknown PFO version %d" % version)
+        self.info = FontInfo(*fields)
+        self.compressed = bool(self.info.features & FEATURE_RLE4)
+        self.offset_item = offset_table_item(self.info.codepoint_bytes, self.info.features & FEATURE_OFFSET_16)
+        self.hash_table_base = base + info_size
+        self.offset_tables_base = self.hash_table_base + self.info.hash_table_size * HASH_TABLE_ITEM.size
+        self.glyph_table_base = self.offset_tables_base + self.info.number_of_glyphs * self.offset_item.size
+
+    def chain(self, bucket):
+        # Yields the (codepoint, offset) pairs in one hash bucket, in the order the firmware walks them.
+        _, count, chain_offset = HASH_TABLE_ITEM.unpack_from(self.buf, self.hash_table_base + bucket * HASH_TABLE_ITEM.size)
+        item_addr = self.offset_tables_base + chain_offset
+        for _ in range(count):
+            yield self.offset_item.unpack_from(self.buf, item_addr)
+            item_addr += self.offset_item.size
+
+    def items(self):
+        for bucket in range(self.info.hash_table_size):
+            for item in self.chain(bucket):
+                yield item
+
+    def find(self, codepoint):
+        # Returns (glyph offset or None, number of chain items compared) - as the firmware's lookup does it.
+        probes = 0
+        for item_codepoint, offset in self.chain(hasher(codepoint, self.info.hash_table_size)):
+            probes += 1
+            if item_codepoint == codepoint:
+                return offset, probes
+        return None, probes
+
+    def glyph_size(self, offset):
+        width, height = struct.unpack_from('<BB', self.buf, self.glyph_table_base + offset)
+        return glyph_record_size(width, height, self.compressed)
+
+    def glyph(self, offset):
+        # The glyph record (header and data) at an offset into the glyph table.
+        start = self.glyph_table_base + offset
+        return self.buf[start:start + self.glyph_size(offset)]
+
+    def lookup(self, codepoint):
+        # The glyph record for a codepoint, or None. (The firmware would fall back to the wildcard.)
+        offset, _ = self.find(codepoint)
+        return self.glyph(offset) if offset is not None else None
+
+    def close(self):
+        if isinstance(self.buf, mmap.mmap):
+            self.buf.close()
+        self.buf = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def open_pfo(path):
+    with open(path, "rb") as fd:
+        buf = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    return PFOReader(buf)
+
+def pack_pfo(info, entries, glyph_records):
+    # entries: (codepoint, offset) pairs, offsets counted from the start of the glyph table
+    #          (i.e. the first record is at GLYPH_TABLE_PADDING).
+    # glyph_records: the glyph records, in glyph table order.
+    # info.number_of_glyphs is ignored - it's len(entries). Returns the font as a bytearray.
+    offset_item = offset_table_item(info.codepoint_bytes, info.features & FEATURE_OFFSET_16)
+    font_info = FONT_INFO_V2 if info.version == FONT_VERSION_2 else FONT_INFO_V3
+
+    chains = [[] for _ in range(info.hash_table_size)]
+    for codepoint, offset in sorted(entries):
+        chain = chains[hasher(codepoint, info.hash_table_size)]
+        chain.append((codepoint, offset))
+        assert len(chain) < OFFSET_TABLE_MAX_SIZE, "Hash bucket overflow: %d > 127" % len(chain)
+
+    hash_table_base = font_info.size
+    offset_tables_base = hash_table_base + info.hash_table_size * HASH_TABLE_ITEM.size
+    glyph_table_base = offset_tables_base + len(entries) * offset_item.size
+    glyph_table_size = GLYPH_TABLE_PADDING + sum(len(record) for record in glyph_records)
+    buf = bytearray(glyph_table_base + glyph_table_size)
+
+    if info.version == FONT_VERSION_2:
+        font_info.pack_into(buf, 0, info.version, info.max_height, len(entries), info.wildcard_codepoint,
+                            info.hash_table_size, info.codepoint_bytes)
+    else:
+        font_info.pack_into(buf, 0, info.version, info.max_height, len(entries), info.wildcard_codepoint,
+                            info.hash_table_size, info.codepoint_bytes, font_info.size, info.features)
+
+    item_addr = offset_tables_base
+    for bucket, chain in enumerate(chains):
+        HASH_TABLE_ITEM.pack_into(buf, hash_table_base + bucket * HASH_TABLE_ITEM.size,
+                                  bucket, len(chain), item_addr - offset_tables_base)
+        for codepoint, offset in chain:
+            offset_item.pack_into(buf, item_addr, codepoint, offset)
+            item_addr += offset_item.size
+
+    record_addr = glyph_table_base + GLYPH_TABLE_PADDING
+    for record in glyph_records:
+        buf[record_addr:record_addr + len(record)] = record
+        record_addr += len(record)
+    return buf
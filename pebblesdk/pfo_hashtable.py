@@ -0,0 +1,57 @@
+from __future__ import division
+from collections import namedtuple
+
+# The PFO hash table is a directory of (uint8_t) hash_table_size entries, each pointing at a chain of
+# (codepoint, offset) pairs. The firmware hashes a codepoint with codepoint % hash_table_size, then walks
+# the chain comparing codepoints until it finds a match - so long chains cost us on every glyph lookup.
+# Since the table size is stored in the font header, we're free to pick whichever size suits the
+# codepoints we're actually packing.
+
+HASH_TABLE_MIN_SIZE = 1
+HASH_TABLE_MAX_SIZE = 255
+HASH_TABLE_ENTRY_SIZE = 4
+OFFSET_TABLE_MAX_SIZE = 128
+
+HashTableStats = namedtuple("HashTableStats", "size max_chain mean_chain expected_probes table_bytes")
+
+def hasher(codepoint, table_size):
+    return codepoint % table_size
+
+def chain_lengths(codepoints, table_size):
+    lengths = [0] * table_size
+    for codepoint in codepoints:
+        lengths[hasher(codepoint, table_size)] += 1
+    return lengths
+
+def hash_table_stats(codepoints, table_size):
+    lengths = chain_lengths(codepoints, table_size)
+    used = [x for x in lengths if x]
+    total = sum(used)
+    # A hit on the n-th item of a chain costs n probes - so a chain of n items costs n(n+1)/2 in total.
+    probes = sum(n * (n + 1) // 2 for n in used)
+    return HashTableStats(
+        size=table_size,
+        max_chain=max(used) if used else 0,
+        mean_chain=(total / len(used)) if used else 0,
+        expected_probes=(probes / total) if total else 0,
+        table_bytes=table_size * HASH_TABLE_ENTRY_SIZE
+    )
+
+def candidate_sizes(codepoints):
+    for size in range(HASH_TABLE_MIN_SIZE, HASH_TABLE_MAX_SIZE + 1):
+        stats = hash_table_stats(codepoints, size)
+        # The chain length is stored in a uint8_t, and the firmware caps it further still.
+        if stats.max_chain >= OFFSET_TABLE_MAX_SIZE:
+            continue
+        yield stats
+
+def optimal_hash_table_size(codepoints):
+    # Minimize the expected number of chain probes per (successful) lookup.
+    # Ties go to the smaller table, since it's less flash for the same work.
+    codepoints = list(codepoints)
+    best = min(candidate_sizes(codepoints), key=lambda s: (s.expected_probes, s.max_chain, s.table_bytes))
+    return best
+
+def format_stats(stats):
+    return "size %d: max chain %d, mean chain %.2f, %.3f probes/lookup, %d table bytes" % (
+        stats.size, stats.max_chain, stats.mean_chain, stats.expected_probes, stats.table_bytes)
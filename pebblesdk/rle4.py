@@ -0,0 +1,99 @@
+import itertools
+import struct
+
+# RLE4 glyph encoding, as used by PFO v3 fonts with FEATURE_RLE4 set.
+# Runs of identical bits are stored as 4-bit units: (bit 3) colour, (bits 0-2) run length - 1.
+# Two units are packed per byte, low nibble first, and the stream is padded out to 4 bytes.
+# The glyph header's height field holds the number of units instead of the bitmap height.
+# The firmware decodes glyphs in place, within a GLYPH_BUFFER_SIZE_BYTES buffer:
+#  [ <header> | <free space> | <encoded glyph> ] -> [ <header> |       <decoded glyph>          ]
+
+RLE_LEN = 2**(4-1)
+GLYPH_BUFFER_SIZE_BYTES = 256
+GLYPH_HEADER_SIZE = 5
+
+def encode(bitmap):
+    # Returns (packed bytes, number of units) - the unit count excludes padding.
+    rle_unit_list = []
+    for name, group in itertools.groupby(bitmap):
+        length = len(list(group))
+        while length > 0:
+            unit_len = min(length, RLE_LEN)
+            rle_unit_list.append((name, unit_len))
+            length -= unit_len
+
+    num_units = len(rle_unit_list)
+    if (num_units % 2) == 1:
+        rle_unit_list.append((0, 1))
+
+    glyph_packed = bytearray()
+    it = iter(rle_unit_list)
+    for name, length in it:
+        name2, length2 = next(it)
+        glyph_packed.append(name << 3 | (length - 1) | name2 << 7 | (length2 - 1) << 4)
+
+    while (len(glyph_packed) % 4) > 0:
+        glyph_packed.append(0)
+
+    return bytes(glyph_packed), num_units
+
+def decode(glyph_packed, num_units):
+    glyph_packed = bytearray(glyph_packed)
+    bitmap = []
+    for idx in range(num_units):
+        unit = glyph_packed[idx // 2] >> (4 * (idx % 2))
+        bitmap.extend([(unit >> 3) & 1] * ((unit & 0x07) + 1))
+    return bitmap
+
+def encoded_size(num_units):
+    return ((num_units + 1) // 2 + 3) // 4 * 4
+
+def decode_headroom(glyph_packed, num_units, header_size=GLYPH_HEADER_SIZE):
+    # Simulates the firmware's in-place decode, returning the smallest gap (in bytes) left between
+    # the decoded output and the unread input. Raises ValueError if the glyph can't be decoded in place.
+    glyph_packed = bytearray(glyph_packed)
+    dst_ptr = header_size
+    src_ptr = GLYPH_BUFFER_SIZE_BYTES - len(glyph_packed)
+    if src_ptr < header_size:
+        raise ValueError("input stream too large for buffer")
+    headroom = src_ptr - dst_ptr
+
+    out_num_bits = 0
+    units_left = num_units
+    unit_idx = 0
+    while units_left > 0:
+        unit_pair = glyph_packed[unit_idx // 2]
+        src_ptr += 1
+        for i in range(min(units_left, 2)):
+            out_num_bits += ((unit_pair >> (4 * i)) & 0x07) + 1
+            while out_num_bits >= 8:
+                if dst_ptr >= src_ptr:
+                    raise ValueError("unable to RLE4 decode in place")
+                if dst_ptr >= GLYPH_BUFFER_SIZE_BYTES:
+                    raise ValueError("output bitmap too large for buffer")
+                headroom = min(headroom, src_ptr - dst_ptr)
+                dst_ptr += 1
+                out_num_bits -= 8
+            units_left -= 1
+        unit_idx += 2
+
+    if dst_ptr + (out_num_bits + 7) // 8 > GLYPH_BUFFER_SIZE_BYTES:
+        raise ValueError("output bitmap too large for buffer")
+    return headroom
+
+def pack_raw(bitmap):
+    # Uncompressed glyphs are rows of bits, LSB first, in 32-bit little-endian words.
+    words = []
+    for word_start in range(0, len(bitmap), 32):
+        w = 0
+        for index, bit in enumerate(bitmap[word_start:word_start + 32]):
+            w |= bit << index
+        words.append(struct.pack('<I', w))
+    return b''.join(words)
+
+def unpack_raw(data, length):
+    data = bytearray(data)
+    return [(data[idx // 8] >> (idx % 8)) & 1 for idx in range(length)]
+
+def raw_size(width, height):
+    return (width * height + 31) // 32 * 4
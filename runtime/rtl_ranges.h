@@ -1,11 +1,17 @@
 #pragma once
 #include "pebble.h"
+#include "codept_props.h"
+// The ranges themselves are in fonts/codept_props.py.
 
-bool is_rtl(uint16_t cp);
+static inline bool is_rtl(uint16_t cp) { return codept_props(cp) & CODEPT_RTL; }
 
-bool is_neutral(uint16_t cp);
+static inline bool is_neutral(uint16_t cp) {
+  return codept_props(cp) & CODEPT_NEUTRAL;
+}
 
 // "Weak" LTR doesn't break an RTL span, but is itself laid out LTR.
 // I have no clue what I'm doing, I'm just trying cases and comparing them to my
 // PC.
-bool is_weak_ltr(uint16_t cp);
+static inline bool is_weak_ltr(uint16_t cp) {
+  return codept_props(cp) & CODEPT_WEAK_LTR;
+}
@@ -1,4 +1,5 @@
 #include "text_shaper.h"
+#include "codept_props.h"
 #include "font_ranges.h"
 #include "text_shaper_lut.h"
 #include "utf8.h"
@@ -19,78 +20,46 @@ const uint16_t LIG_REPLACEMENT_CODEPT_MASK = (1 << 15);
 const uint8_t RUNE_SIZE = 2;
 
 const ShaperLUTEntry *find_lut_entry_by_codept(uint16_t codept) {
+  const ShaperLUTEntry *shaper_lut = (ShaperLUTEntry *)ARABIC_SHAPER_LUT;
+#ifdef ARABIC_SHAPER_INDEX_BASE
+  // Letters are looked up directly - only the few entries outside the index (ligatures) are scanned.
+  if (codept >= ARABIC_SHAPER_INDEX_BASE &&
+      codept < ARABIC_SHAPER_INDEX_BASE + ARABIC_SHAPER_INDEX_SIZE) {
+    uint8_t entry = ARABIC_SHAPER_INDEX[codept - ARABIC_SHAPER_INDEX_BASE];
+    return entry ? &shaper_lut[entry - 1] : NULL;
+  }
+  for (int i = 0; i < ARABIC_SHAPER_EXCEPTIONS_SIZE; ++i) {
+    if (shaper_lut[ARABIC_SHAPER_EXCEPTIONS[i]].true_codept == codept) {
+      return &shaper_lut[ARABIC_SHAPER_EXCEPTIONS[i]];
+    }
+  }
+  return NULL;
+#else
   if (codept < 0x600 && codept > 0x6ff) {
     return NULL;
   }
-  const ShaperLUTEntry *shaper_lut = (ShaperLUTEntry *)ARABIC_SHAPER_LUT;
   for (int i = 0; i < ARABIC_SHAPER_LUT_SIZE / sizeof(ShaperLUTEntry); ++i) {
     if (shaper_lut[i].true_codept == codept) {
       return &shaper_lut[i];
     }
   }
   return NULL;
-}
-
-#ifdef TEXT_UNSHAPE
-static uint16_t find_base_codept_by_shaped(uint16_t codept) {
-  const ShaperLUTEntry *shaper_lut = (ShaperLUTEntry *)ARABIC_SHAPER_LUT;
-  for (int i = 0; i < ARABIC_SHAPER_LUT_SIZE / sizeof(ShaperLUTEntry); ++i) {
-    if (shaper_lut[i].isolated_codept == codept ||
-        shaper_lut[i].isolated_codept + shaper_lut[i].initial_codept_delta == codept ||
-        shaper_lut[i].isolated_codept + shaper_lut[i].medial_codept_delta == codept ||
-        shaper_lut[i].isolated_codept + shaper_lut[i].final_codept_delta == codept) {
-      return shaper_lut[i].true_codept;
-    }
-  }
-  return 0;
-}
 #endif
-
-static uint16_t find_ligature_by_codepts(uint16_t *pattern,
-                                         size_t pattern_size) {
-  bool searching = true;
-  size_t pattern_idx = 0;
-  const uint16_t *ligature_lut = (uint16_t *)ARABIC_LIGATURE_LUT;
-  for (int i = 0; i < ARABIC_LIGATURE_LUT_SIZE / sizeof(uint16_t); ++i) {
-    if (searching) {
-      if (ligature_lut[i] == pattern[pattern_idx] &&
-          pattern_idx < pattern_size) {
-        pattern_idx++;
-      } else {
-        // Is this the replacement codept?
-        if (ligature_lut[i] & LIG_REPLACEMENT_CODEPT_MASK) {
-          return ligature_lut[i] & ~LIG_REPLACEMENT_CODEPT_MASK;
-        }
-        searching = false;
-        pattern_idx = 0;
-      }
-    } else if (ligature_lut[i] & LIG_REPLACEMENT_CODEPT_MASK) {
-      searching = true;
-    }
-  }
-  return 0;
 }
 
 #ifdef TEXT_UNSHAPE
-static bool expand_ligature(uint16_t codept, char *ptr) {
-  const uint16_t *ligature_lut = (uint16_t *)ARABIC_LIGATURE_LUT;
-  int last_pattern_start = 0;
-  for (int i = 0; i < ARABIC_LIGATURE_LUT_SIZE / sizeof(uint16_t); ++i) {
-    if (ligature_lut[i] & LIG_REPLACEMENT_CODEPT_MASK) {
-      if ((ligature_lut[i] & ~LIG_REPLACEMENT_CODEPT_MASK) == codept) {
-        // Write out the original pattern that produced this ligature.
-        ptr -= RUNE_SIZE * (i - last_pattern_start - 1);
-        while (
-            !(ligature_lut[last_pattern_start] & LIG_REPLACEMENT_CODEPT_MASK)) {
-          write_utf8(ptr, ligature_lut[last_pattern_start++]);
-          ptr += RUNE_SIZE;
-        }
-        return true;
-      }
-      last_pattern_start = i + 1;
-    }
+static void expand_ligature(size_t pattern_start, char *ptr) {
+  // Write out the original pattern that produced this ligature - ending where the ligature was.
+  const uint16_t *pattern = (uint16_t *)ARABIC_LIGATURE_LUT + pattern_start;
+  size_t pattern_size = 0;
+  while (!(pattern[pattern_size] & LIG_REPLACEMENT_CODEPT_MASK)) {
+    pattern_size++;
+  }
+  ptr -= RUNE_SIZE * (pattern_size - 1);
+  for (size_t i = 0; i < pattern_size; ++i) {
+    write_utf8(ptr, pattern[i]);
+    ptr += RUNE_SIZE;
   }
-  return false;
 }
 #endif
 
@@ -107,7 +76,6 @@ void shape_text(char *text) {
   char *this_codept_ptr = NULL, *last_codept_ptr;
   char *late_finalize_ptr = NULL;
   const ShaperLUTEntry *late_finalize_lut_entry;
-  int ligature_span = 0;
   const ShaperLUTEntry *this_lut_entry;
   do {
     // Read forward one.
@@ -116,15 +84,19 @@ void shape_text(char *text) {
     this_codept_ptr = next_codept_ptr;
     this_lut_entry = next_lut_entry;
     if (*ptr) {
+      // Check for a ligature starting here.
+      // It takes the place of its last character - the ones before are made zero-width, and skipped.
+      char *lig_last_rune;
+      uint16_t lig_codept = find_ligature(ptr, &lig_last_rune);
+      if (lig_codept) {
+        for (; ptr < lig_last_rune; ptr += RUNE_SIZE) {
+          write_utf8(ptr, ZERO_WIDTH_CODEPT);
+        }
+      }
       next_codept_ptr = ptr;
       codept_buffer[NEXT_CODEPT] = read_utf8(&ptr);
-
-      // Check ligature state.
-      uint16_t lig_codept = find_ligature_by_codepts(codept_buffer, 2);
       if (lig_codept) {
         codept_buffer[NEXT_CODEPT] = lig_codept;
-        // This only works with 2-char ligatures.
-        ligature_span = 1;
       }
 
       next_lut_entry = find_lut_entry_by_codept(codept_buffer[NEXT_CODEPT]);
@@ -134,15 +106,12 @@ void shape_text(char *text) {
       next_lut_entry = NULL;
     }
 
-    if (ligature_span) {
-      ligature_span--;
-      write_utf8(this_codept_ptr, ZERO_WIDTH_CODEPT);
-    } else if (is_zero_width(codept_buffer[THIS_CODEPT])) {
+    if (codept_props(codept_buffer[THIS_CODEPT]) & CODEPT_ZERO_WIDTH) {
       // Don't do anything rash.
     } else if (this_lut_entry) {
       if (
           // If we're about to change into an unshapable span, finish up.
-          (!next_lut_entry && !is_zero_width(codept_buffer[NEXT_CODEPT])) ||
+          (!next_lut_entry && !(codept_props(codept_buffer[NEXT_CODEPT]) & CODEPT_ZERO_WIDTH)) ||
           // Or, if this character has no medial form.
           (
               // Indicated by identical medial and final forms.
@@ -188,17 +157,15 @@ void unshape_text(char *iter) {
   while (*iter) {
     char *iter_pre = iter;
     uint16_t codept = read_utf8(&iter);
-    if (!ARABIC_SHAPER_RANGE(codept)) {
+    if (!(codept_props(codept) & CODEPT_SHAPED)) {
       continue;
     }
-    uint16_t old_codept = find_base_codept_by_shaped(codept);
-    if (old_codept) {
-      if (expand_ligature(old_codept, iter_pre)) {
-        // Ligature was expanded - nothing left to do.
-      } else {
-        // Write back the original codept.
-        write_utf8(iter_pre, old_codept);
-      }
+    uint16_t old_codept = ARABIC_UNSHAPE_LUT[ARABIC_UNSHAPE_INDEX(codept)];
+    if (old_codept & LIG_REPLACEMENT_CODEPT_MASK) {
+      expand_ligature(old_codept & ~LIG_REPLACEMENT_CODEPT_MASK, iter_pre);
+    } else if (old_codept) {
+      // Write back the original codept.
+      write_utf8(iter_pre, old_codept);
     }
   }
 }
@@ -0,0 +1,63 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "fonts"))
+import compose
+from test_glyph_dump import fontgen_available, fontgen_params, read_store
+
+@unittest.skipUnless(fontgen_available(), "fontgen can't run - set TEST_FONT and FONTGEN_PYTHON")
+class TestParallelDumps(unittest.TestCase):
+    # Fonts whose members share a face & size dump into the same store - as compose --dump-bitmaps does.
+    FONT_MEMBERS = [
+        [("small", [0x628, 0x629]), ("large", [0x62a])],
+        [("small", [0x629, 0x62a, 0x62b]), ("large", [0x62c, 0x62d])],
+        [("small", [0x62e]), (None, [0x62f])]
+    ]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def plans(self, out_dir):
+        os.makedirs(out_dir)
+        plans = []
+        for font_idx, members in enumerate(self.FONT_MEMBERS):
+            jobs = []
+            for member_idx, (store, codepoints) in enumerate(members):
+                dump_path = os.path.join(out_dir, "%s.dump.glyphs" % store) if store else None
+                params = fontgen_params(out_dir, "%d_%d" % (font_idx, member_idx), codepoints,
+                                        dump_path or os.path.join(out_dir, "unshared.glyphs"))
+                jobs.append(compose.MemberJob(font_idx, params, dump_path))
+            plans.append(compose.FontPlan("%d.pfo" % font_idx, jobs, [sys.executable, "-c", ""], []))
+        return plans
+
+    def dumps(self, out_dir):
+        return dict((store, read_store(os.path.join(out_dir, "%s.dump.glyphs" % store))) for store in ("small", "large"))
+
+    def test_parallel_matches_serial(self):
+        serial_dir = os.path.join(self.tmp_dir, "serial")
+        compose.compose_fonts_serial(self.plans(serial_dir))
+        parallel_dir = os.path.join(self.tmp_dir, "parallel")
+        compose.compose_fonts(self.plans(parallel_dir), 2)
+        serial_dumps = self.dumps(serial_dir)
+        self.assertEqual(serial_dumps, self.dumps(parallel_dir))
+        # Every font's glyphs made it into the shared stores - as if each member had dumped into its own.
+        for store in ("small", "large"):
+            alone = {}
+            for font_idx, members in enumerate(self.FONT_MEMBERS):
+                for member_idx, (member_store, codepoints) in enumerate(members):
+                    if member_store == store:
+                        name = "alone_%d_%d" % (font_idx, member_idx)
+                        dump_path = os.path.join(self.tmp_dir, name + ".glyphs")
+                        subprocess.check_call(fontgen_params(self.tmp_dir, name, codepoints, dump_path))
+                        alone.update(read_store(dump_path))
+            self.assertEqual(serial_dumps[store], alone)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.dirname(__file__))
+from test_glyph_dump import FONTGEN_PYTHON, TEST_FONT, fontgen_available, write_codepoint_list
+
+PEBBLESDK = os.path.join(os.path.dirname(__file__), "..", "pebblesdk")
+
+# Run under FONTGEN_PYTHON: prints the characters subset_chars picks with the direct lookup, then with the
+# charmap walk (forced by making the face look smaller than the subset).
+SUBSET_CHARS_SCRIPT = """
+import json, sys
+sys.path.insert(0, sys.argv[1])
+import fontgen
+
+class SmallFace(object):
+    num_glyphs = 0
+    def __init__(self, face):
+        self.face = face
+    def __getattr__(self, name):
+        return getattr(self.face, name)
+
+font = fontgen.Font(sys.argv[2], 14, fontgen.MAX_GLYPHS_EXTENDED, False)
+font.set_codepoint_list(sys.argv[3])
+direct = list(font.subset_chars())
+font.face = SmallFace(font.face)
+walk = list(font.subset_chars())
+print(json.dumps({"direct": direct, "walk": walk}))
+"""
+
+WILDCARD_CODEPOINT = 0x25AF
+ELLIPSIS_CODEPOINT = 0x2026
+
+@unittest.skipUnless(fontgen_available(), "fontgen can't run - set TEST_FONT and FONTGEN_PYTHON")
+class TestSubsetChars(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def subset_chars(self, codepoints):
+        list_path = os.path.join(self.tmp_dir, "list.json")
+        write_codepoint_list(list_path, codepoints)
+        output = subprocess.check_output([FONTGEN_PYTHON, "-c", SUBSET_CHARS_SCRIPT, PEBBLESDK, TEST_FONT, list_path])
+        result = json.loads(output.decode("utf-8"))
+        return [tuple(char) for char in result["direct"]], [tuple(char) for char in result["walk"]]
+
+    def test_paths_agree(self):
+        # Including the wildcard itself, and a private-use codepoint the face won't have.
+        direct, walk = self.subset_chars([0x41, 0x5d0, 0x628, WILDCARD_CODEPOINT, 0xe000])
+        self.assertEqual(direct, walk)
+        codepoints = [codepoint for codepoint, gindex in direct]
+        self.assertIn(0x628, codepoints)
+        self.assertIn(ELLIPSIS_CODEPOINT, codepoints)
+        self.assertNotIn(WILDCARD_CODEPOINT, codepoints)
+        self.assertNotIn(0xe000, codepoints)
+
+if __name__ == "__main__":
+    unittest.main()
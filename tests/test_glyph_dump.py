@@ -0,0 +1,70 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "pebblesdk"))
+from glyph_archive import open_glyph_store
+
+FONTGEN = os.path.join(os.path.dirname(__file__), "..", "pebblesdk", "fontgen.py")
+# fontgen is Python 2 - run with FONTGEN_PYTHON.
+FONTGEN_PYTHON = os.environ.get("FONTGEN_PYTHON", "python")
+TEST_FONT = os.environ.get("TEST_FONT", "/Library/Fonts/Tahoma.ttf")
+
+def fontgen_available():
+    if not os.path.exists(TEST_FONT):
+        return False
+    try:
+        subprocess.check_call([FONTGEN_PYTHON, "-c", "import freetype"])
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return True
+
+def write_codepoint_list(path, codepoints):
+    with open(path, "w") as fd:
+        json.dump({"codepoints": codepoints}, fd)
+
+def fontgen_params(tmp_dir, name, codepoints, dump_path):
+    list_path = os.path.join(tmp_dir, name + ".json")
+    write_codepoint_list(list_path, codepoints)
+    return [FONTGEN_PYTHON, FONTGEN, "pfo", "14", TEST_FONT, os.path.join(tmp_dir, name + ".pfo"),
+            "--list", list_path, "--dump-bitmaps", dump_path]
+
+def read_store(path):
+    store = open_glyph_store(path, "r")
+    try:
+        return dict((name, store.get(name)) for name in store.names())
+    finally:
+        store.close()
+
+@unittest.skipUnless(fontgen_available(), "fontgen can't run - set TEST_FONT and FONTGEN_PYTHON")
+class TestDumpStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def dump(self, name, codepoints, dump_path):
+        subprocess.check_call(fontgen_params(self.tmp_dir, name, codepoints, dump_path), stdout=open(os.devnull, "w"))
+        return set(read_store(dump_path))
+
+    def check_members_share_store(self, dump_path):
+        first = self.dump("first", [0x628, 0x629], dump_path)
+        second = self.dump("second", [0x62a, 0x62b], dump_path)
+        self.assertTrue(second - first, "the second member dumped nothing")
+        # What the first member dumped is still there.
+        self.assertEqual(first - second, set())
+        self.assertEqual(second, first | self.dump("alone", [0x62a, 0x62b], os.path.join(self.tmp_dir, "alone.glyphs")))
+
+    def test_archive(self):
+        self.check_members_share_store(os.path.join(self.tmp_dir, "14.dump.glyphs"))
+
+    def test_directory(self):
+        self.check_members_share_store(os.path.join(self.tmp_dir, "dump"))
+
+if __name__ == "__main__":
+    unittest.main()
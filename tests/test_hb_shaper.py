@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import ctypes.util
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "fonts"))
+import hb_shaper
+
+# An Arabic font - Tahoma, as compose.py uses, unless TEST_FONT says otherwise.
+TEST_FONT = os.environ.get("TEST_FONT", "/Library/Fonts/Tahoma.ttf")
+def on_path(name):
+    return any(os.access(os.path.join(path, name), os.X_OK) for path in os.environ.get("PATH", "").split(os.pathsep))
+
+# libharfbuzz, if it's not where ctypes looks.
+HARFBUZZ_LIB = os.environ.get("HARFBUZZ_LIB") or ctypes.util.find_library("harfbuzz")
+
+@unittest.skipUnless(os.path.exists(TEST_FONT), "no test font - set TEST_FONT")
+@unittest.skipUnless(on_path("hb-shape"), "hb-shape not found")
+@unittest.skipUnless(HARFBUZZ_LIB, "libharfbuzz not found - set HARFBUZZ_LIB")
+class TestBackendsAgree(unittest.TestCase):
+    TEXTS = [u"سلام abc", u"שלום", u"aبـبb"]
+
+    def test_clusters_are_character_indices(self):
+        hb_shape = hb_shaper.HBShapeShaper(TEST_FONT)
+        libharfbuzz = hb_shaper.LibHarfBuzzShaper(TEST_FONT, HARFBUZZ_LIB)
+        try:
+            expected = hb_shape.shape(self.TEXTS)
+            actual = libharfbuzz.shape(self.TEXTS)
+        finally:
+            libharfbuzz.close()
+        for txt, hb_shape_glyphs, libharfbuzz_glyphs in zip(self.TEXTS, expected, actual):
+            self.assertEqual([g["cl"] for g in hb_shape_glyphs], [g["cl"] for g in libharfbuzz_glyphs], txt)
+            self.assertEqual(hb_shape_glyphs, libharfbuzz_glyphs, txt)
+            self.assertTrue(all(g["cl"] < len(txt) for g in libharfbuzz_glyphs))
+
+if __name__ == "__main__":
+    unittest.main()